@@ -1,59 +1,185 @@
-import socket, time, json, os
+import socket, time, json, os, struct, re, fnmatch, math, select, stat, threading
+from time import perf_counter
 from gevent.pool import Pool
 from gevent.server import StreamServer
-from collections import namedtuple
+from collections import namedtuple, deque
 from io import BytesIO
 import gevent
+import gevent.socket
+from gevent.event import Event
+from gevent.os import fork_gevent, make_nonblocking, nb_read
 from rich.console import Console 
 from rich.table import Table
 
 
 from protocolHandler import *
 from database import * 
+from appendLog import *
+from snapshot import *
+from serverStats import *
+from replication import *
+from pubsub import *
+from commandTable import *
+from clientCache import *
 
 
-class CommandError(Exception): pass 
-class Disconnect(Exception): pass 
 class AuthError(Exception): pass
+class WatchError(CommandError): pass
+
+# Reply of a BLPOP/BRPOP that found nothing to pop; the connection waits for a push
+Blocked = namedtuple('Blocked', ('keys', 'timeout'))
+# Reply of PSYNC; the connection turns into a replication stream
+ReplicaSync = namedtuple('ReplicaSync', ('replid', 'offset'))
+# Reply of SUBSCRIBE and the like, sent as one frame per channel or pattern
+Push = namedtuple('Push', ('replies',))
+# A command table entry with its handler and write hook bound to a server,
+# and the flags and argument bounds dispatch checks on every request
+BoundCommand = namedtuple('BoundCommand', ('spec', 'handler', 'log', 'flags', 'fewest', 'most'))
 
-Error = namedtuple('Error', ('message', ))
 DEFAULT_PORT = 7100
 DEFAULT_PASSWORD = "admin123" 
+MAX_PIPELINE_BATCH = 1024  # Replies buffered before a pipelined batch is flushed
+UNIX_SOCKET_PERM = 0o700  # Mode of the Unix socket file; only its owner may connect
+UNIX_SOCKET_BACKLOG = 128
+RECV_BUFFER_SIZE = 65536
+EXPIRE_INTERVAL = 1  # Seconds between expiry passes when nothing is due
+EXPIRE_BATCH_SIZE = 1000  # Expiry index entries examined per database per pass
+REWRITE_BATCH_SIZE = 1000  # Keys written per step of an append log rewrite
+# Records that change a list relative to its contents, so applying one twice
+# pushes or pops twice
+RELATIVE_RECORDS = frozenset(['LPUSH', 'RPUSH', 'LPOP', 'RPOP'])
+SAVE_PROGRESS_INTERVAL = 1000  # Keys between progress reports of a background save
+SAVE_POLL_INTERVAL = 0.1  # Seconds between checks on a forked child
+FORK_SAVES = hasattr(os, 'fork')  # Background saves fork where the platform allows
+SCAN_DEFAULT_COUNT = 10  # Key slots a SCAN step looks at unless COUNT says otherwise
+SCAN_MAX_COUNT = 100000  # Upper bound on COUNT, so one step stays short
+# Pause between batches of background work. sleep(0) can resume the greenlet
+# before the loop polls sockets; a short timer always lets clients in first.
+YIELD_INTERVAL = 0.0001
+MAXMEMORY_POLICIES = ('noeviction', 'allkeys-lru', 'allkeys-lfu', 'volatile-lru', 'volatile-ttl')
+MAXMEMORY_SAMPLES = 5  # Keys sampled per database to pick each eviction
+MEMORY_UNITS = {'b': 1, 'kb': 1024, 'mb': 1024 ** 2, 'gb': 1024 ** 3}
+WRONG_TYPE = "Operation against a key holding the wrong kind of value"
+# Channel that tracking connections' invalidations are published to, on the
+# connection they redirect them to: a list of changed keys, or None for all
+INVALIDATE_CHANNEL = '__nimbledb__:invalidate'
 console = Console()
 
 
-class Client:
-    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT):
-        self._protocol = ProtocolHandler()
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.connect((host, port))
-        self._fh = self._socket.makefile('rwb')
-        self._authenticated = False
-        self._current_db = 0
+def unpack_transaction(results):
+    """
+    Replies to a MULTI ... EXEC batch: EXEC's list of replies, one per
+    queued command. Raises WatchError if a watched key changed and
+    CommandError if the transaction was refused.
+    """
+    resp = results[-1]
+    if resp is None:
+        raise WatchError("Transaction aborted: a watched key changed")
+    if isinstance(resp, Error):
+        errors = [r.message for r in results[:-1] if isinstance(r, Error)]
+        raise CommandError(': '.join([resp.message] + errors[:1]))
+    return resp
+
+
+def parse_memory(value):
+    """Bytes from an int or a string such as '512mb' or '2gb'"""
+    if isinstance(value, int):
+        return value
+    text = str(value).strip().lower()
+    for unit in ('kb', 'mb', 'gb', 'b'):
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * MEMORY_UNITS[unit])
+    return int(text)
+
+
+def listen_unix(path, permissions=UNIX_SOCKET_PERM):
+    """
+    Listening Unix socket at path, its file given the permissions mode. A
+    socket file left behind by a server that has gone is replaced; one that
+    still accepts connections is not.
+    """
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise OSError(f"{path} exists and is not a socket")
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            raise OSError(f"{path} is in use by another server")
+        finally:
+            probe.close()
+    sock = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        # Clients can't connect until listen(), so none gets in under the umask's mode
+        os.chmod(path, permissions)
+        sock.listen(UNIX_SOCKET_BACKLOG)
+    except BaseException:
+        sock.close()
+        remove_unix_socket(path)
+        raise
+    return sock
+
+
+def remove_unix_socket(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def fork_child(body):
+    """
+    Fork a child process that calls body(write_fd) on a copy-on-write image
+    of this one and exits, with status 0 if body returned. Returns the pid
+    and the read end of the pipe, which nb_read reads without blocking the
+    event loop and which ends once the child is gone.
+    """
+    read_fd, write_fd = os.pipe()
+    # Without a child watcher, so wait_child() asks the kernel directly
+    pid = fork_gevent()
+    if pid == 0:
+        exit_code = 0
+        try:
+            os.close(read_fd)
+            body(write_fd)
+        except BaseException:
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+    os.close(write_fd)
+    make_nonblocking(read_fd)
+    return pid, read_fd
 
-    def execute(self, *args):
-        self._protocol.write_response(self._fh, args)
-        resp = self._protocol.handle_request(self._fh)
-        if isinstance(resp, Error):
-            raise CommandError(resp.message)
-        return resp
 
+def wait_child(pid):
+    """Reap a child from fork_child() without blocking the event loop; returns its exit status"""
+    done, exit_status = os.waitpid(pid, os.WNOHANG)
+    while not done:
+        gevent.sleep(SAVE_POLL_INTERVAL)
+        done, exit_status = os.waitpid(pid, os.WNOHANG)
+    return exit_status
+
+
+class Commands(object):
+    """
+    Command methods shared by the clients. Each builds its arguments and
+    hands them to execute(), so what comes back is up to the subclass: the
+    reply for Client, the pipeline itself for Pipeline, and an awaitable
+    for AsyncClient.
+    """
     # Authentication
     def auth(self, password):
-        result = self.execute('AUTH', password)
-        if result == "OK":
-            self._authenticated = True
-        return result
+        return self.execute('AUTH', password)
 
     def set_password(self, password):
         return self.execute('SET_PASSWORD', password)
 
     # Database selection
     def select_db(self, db_id):
-        result = self.execute('SELECT', str(db_id))
-        if result == "OK":
-            self._current_db = db_id
-        return result
+        return self.execute('SELECT', str(db_id))
 
     def new_db(self, db_id=None):
         if db_id is not None:
@@ -85,6 +211,22 @@ class Client:
     def del_time(self, key):
         return self.execute('DEL_TIME', key)
 
+    # Counters
+    def incr(self, key):
+        return self.execute('INCR', key)
+
+    def incrby(self, key, amount):
+        return self.execute('INCRBY', key, str(amount))
+
+    def decr(self, key):
+        return self.execute('DECR', key)
+
+    def decrby(self, key, amount):
+        return self.execute('DECRBY', key, str(amount))
+
+    def incrbyfloat(self, key, amount):
+        return self.execute('INCRBYFLOAT', key, repr(float(amount)))
+
     def flush(self, password=None):
         if password is not None:
             return self.execute('FLUSH', password)
@@ -119,6 +261,60 @@ class Client:
     def time_dump(self, interval):
         return self.execute('TIME_DUMP', str(interval))
 
+    def bgsave(self, filename=None, password=None):
+        args = [arg for arg in (password, filename) if arg is not None]
+        return self.execute('BGSAVE', *args)
+
+    def bgsave_status(self):
+        return self.execute('BGSAVE_STATUS')
+
+    def memory_stats(self):
+        return self.execute('MEMORY_STATS')
+
+    def rewrite_log(self):
+        return self.execute('REWRITE_LOG')
+
+    def info(self):
+        """Server statistics as a dict; see Server.info()"""
+        return self.execute('INFO')
+
+    def stats_reset(self):
+        return self.execute('STATS', 'RESET')
+
+    def slowlog_get(self, count=None):
+        """Newest slow log entries first, as dicts"""
+        return self.execute('SLOWLOG', 'GET', *([] if count is None else [str(count)]))
+
+    def slowlog_len(self):
+        return self.execute('SLOWLOG', 'LEN')
+
+    def slowlog_reset(self):
+        return self.execute('SLOWLOG', 'RESET')
+
+    def command(self):
+        """Every command the server knows as [name, arity, flags, first key, last key, key step]"""
+        return self.execute('COMMAND')
+
+    def command_count(self):
+        return self.execute('COMMAND', 'COUNT')
+
+    def command_info(self, *names):
+        return self.execute('COMMAND', 'INFO', *names)
+
+    def command_getkeys(self, *args):
+        """Keys of the request args, e.g. command_getkeys('BULK_SET', 'a', '1', 'b', '2')"""
+        return self.execute('COMMAND', 'GETKEYS', *args)
+
+    def replicaof(self, host=None, port=None):
+        """Make the server a read-only replica of host:port, or a master again with no arguments"""
+        if host is None:
+            return self.execute('REPLICAOF', 'NO', 'ONE')
+        return self.execute('REPLICAOF', host, str(port))
+
+    def publish(self, channel, message):
+        """Send a message to a channel; returns the number of subscribers that got it"""
+        return self.execute('PUBLISH', channel, message)
+
     # Bulk operations
     def bulk_get(self, *keys):
         return self.execute('BULK_GET', *keys)
@@ -126,80 +322,675 @@ class Client:
     def bulk_set(self, *items):
         return self.execute('BULK_SET', *items)
 
+    # Hashes
+    def hset(self, key, *items):
+        """Set field value pairs of a hash; returns the number of new fields"""
+        return self.execute('HSET', key, *items)
+
+    def hget(self, key, field):
+        return self.execute('HGET', key, field)
+
+    def hmget(self, key, *fields):
+        return self.execute('HMGET', key, *fields)
+
+    def hgetall(self, key):
+        return self.execute('HGETALL', key)
+
+    def hdel(self, key, *fields):
+        return self.execute('HDEL', key, *fields)
+
+    def hincrby(self, key, field, amount=1):
+        return self.execute('HINCRBY', key, field, str(amount))
+
+    def hlen(self, key):
+        return self.execute('HLEN', key)
+
+    def hexists(self, key, field):
+        return self.execute('HEXISTS', key, field)
+
+    def expire(self, key, seconds):
+        return self.execute('EXPIRE', key, str(seconds))
+
+    # Lists
+    def lpush(self, key, *values):
+        """Push values onto the head of a list; returns its new length"""
+        return self.execute('LPUSH', key, *values)
+
+    def rpush(self, key, *values):
+        """Push values onto the tail of a list; returns its new length"""
+        return self.execute('RPUSH', key, *values)
+
+    def lpop(self, key):
+        return self.execute('LPOP', key)
+
+    def rpop(self, key):
+        return self.execute('RPOP', key)
+
+    def lrange(self, key, start=0, stop=-1):
+        return self.execute('LRANGE', key, str(start), str(stop))
+
+    def llen(self, key):
+        return self.execute('LLEN', key)
+
+    def blpop(self, *keys, timeout=0):
+        """
+        Pop from the head of the first non-empty list, waiting up to timeout
+        seconds (0 waits forever) for a push if all are empty. Returns
+        [key, value], or None on timeout.
+        """
+        return self.execute('BLPOP', *keys, str(timeout))
+
+    def brpop(self, *keys, timeout=0):
+        """Like blpop(), from the tail"""
+        return self.execute('BRPOP', *keys, str(timeout))
+
+    # Sorted sets
+    def zadd(self, key, mapping):
+        """Add members with scores from a {member: score} dict; returns the number of new members"""
+        args = []
+        for member, score in mapping.items():
+            args.extend([repr(float(score)), member])
+        return self.execute('ZADD', key, *args)
+
+    def zincrby(self, key, amount, member):
+        return self.execute('ZINCRBY', key, repr(float(amount)), member)
+
+    def zrange(self, key, start=0, stop=-1, withscores=False):
+        """Members by rank, lowest score first; with scores as a flat [member, score, ...] list"""
+        return self.execute('ZRANGE', key, str(start), str(stop), *(['WITHSCORES'] if withscores else []))
+
+    def zrevrange(self, key, start=0, stop=-1, withscores=False):
+        """Members by rank, highest score first"""
+        return self.execute('ZREVRANGE', key, str(start), str(stop), *(['WITHSCORES'] if withscores else []))
+
+    def zrangebyscore(self, key, low='-inf', high='+inf', withscores=False, offset=None, count=None):
+        """Members with low <= score <= high; prefix a bound with '(' to exclude it"""
+        args = ['ZRANGEBYSCORE', key, str(low), str(high)]
+        if withscores:
+            args.append('WITHSCORES')
+        if offset is not None or count is not None:
+            args.extend(['LIMIT', str(offset or 0), str(-1 if count is None else count)])
+        return self.execute(*args)
+
+    def zrank(self, key, member):
+        return self.execute('ZRANK', key, member)
+
+    def zrevrank(self, key, member):
+        return self.execute('ZREVRANK', key, member)
+
+    def zrem(self, key, *members):
+        return self.execute('ZREM', key, *members)
+
+    def zscore(self, key, member):
+        return self.execute('ZSCORE', key, member)
+
+    def zcard(self, key):
+        return self.execute('ZCARD', key)
+
+    # Keyspace iteration
+    def scan(self, cursor=0, match=None, count=None):
+        """One SCAN step; returns [next_cursor, keys], next_cursor 0 when done"""
+        args = ['SCAN', str(cursor)]
+        if match is not None:
+            args.extend(['MATCH', match])
+        if count is not None:
+            args.extend(['COUNT', str(count)])
+        return self.execute(*args)
+
+
+class Client(Commands):
+    """
+    Blocking client over one connection, over TCP or, given
+    unix_socket_path, a Unix socket. With decode_responses=False values
+    come back as the bytes the server holds instead of being decoded.
+    """
+    _cache = None  # ClientCache while enable_cache() is on; a Pipeline never has one
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, decode_responses=True, unix_socket_path=None):
+        self._address = (host, port, unix_socket_path)
+        self._protocol = ProtocolHandler(decode_responses)
+        if unix_socket_path is not None:
+            # A server on the same host, reached without the TCP stack
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(unix_socket_path)
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._socket.connect((host, port))
+        self._fh = self._socket.makefile('rwb')
+        self._authenticated = False
+        self._current_db = 0
+        # Subscriptions of this connection, and messages read while waiting
+        # for the reply to a (P)SUBSCRIBE or (P)UNSUBSCRIBE
+        self._channels = set()
+        self._patterns = set()
+        self._messages = deque()
+        self._cache_listener = None
+
+    def close(self):
+        """Close the connection, and the cache's invalidation connection with it"""
+        self._drop_cache()
+        self._fh.close()
+        self._socket.close()
+
+    def execute(self, *args):
+        self._protocol.write_response(self._fh, args)
+        resp = self._protocol.handle_request(self._fh)
+        if isinstance(resp, Error):
+            raise CommandError(resp.message)
+        self._track_session(args, resp)
+        return resp
+
+    def _track_session(self, args, resp):
+        """
+        Follow the AUTH and SELECT state the server keeps for this
+        connection, and drop from the cache whatever it writes
+        """
+        if resp == "OK" and args[0] == 'AUTH':
+            self._authenticated = True
+        elif resp == "OK" and args[0] == 'SELECT':
+            self._current_db = int(args[1])
+            if self._cache is not None:
+                self._cache.drop(None)
+        if self._cache is not None:
+            spec = COMMAND_TABLE.get(args[0].upper())
+            if spec is not None and 'write' in spec.flags:
+                # The server's invalidation would come too late for a read
+                # straight after; writes without keys, like FLUSH, drop everything
+                self._cache.drop(command_keys(spec, args) if spec.keys != NO_KEYS else None)
+
+    # Client side caching
+    def enable_cache(self, max_keys=CLIENT_CACHE_SIZE):
+        """
+        Serve repeated GETs from a local cache of up to max_keys values. The
+        server remembers the keys this connection reads and publishes their
+        changes to a second connection, whose messages a background thread
+        applies to the cache. Returns the ClientCache.
+        """
+        self.disable_cache()
+        host, port, unix_socket_path = self._address
+        listener = Client(host, port, unix_socket_path=unix_socket_path)
+        try:
+            listener_id = listener.execute('CLIENT', 'ID')
+            listener.subscribe(INVALIDATE_CHANNEL)
+            self.execute('CLIENT', 'TRACKING', 'ON', 'REDIRECT', str(listener_id))
+        except BaseException:
+            listener.close()
+            raise
+        cache = ClientCache(max_keys)
+        threading.Thread(target=_read_invalidations, args=(listener, cache), daemon=True).start()
+        self._cache = cache
+        self._cache_listener = listener
+        return cache
+
+    def disable_cache(self):
+        """Stop tracking and throw the cache away"""
+        if self._cache is not None:
+            self._drop_cache()
+            self.execute('CLIENT', 'TRACKING', 'OFF')
+
+    def _drop_cache(self):
+        if self._cache is not None:
+            self._cache.close()
+            try:
+                # The reader thread sees the connection end and closes it
+                self._cache_listener._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._cache = None
+            self._cache_listener = None
+
+    def cache_info(self):
+        """Size, hits, misses and invalidations of the cache; None when it is off"""
+        return self._cache.info() if self._cache is not None else None
+
+    def get(self, key):
+        cache = self._cache
+        if cache is None or cache.closed or key == '*' or key == '**':
+            return self.execute('GET', key)
+        value = cache.get(key)
+        if value is NOT_CACHED:
+            token = cache.begin(key)
+            try:
+                value = self.execute('GET', key)
+            except BaseException:
+                cache.abandon(key, token)
+                raise
+            cache.store(key, value, token)
+        return value
+
+    def bulk_get(self, *keys):
+        cache = self._cache
+        if cache is None or cache.closed or keys in (('*',), ('**',)):
+            return self.execute('BULK_GET', *keys)
+        values = [cache.get(key) for key in keys]
+        missing = list(dict.fromkeys(key for key, value in zip(keys, values) if value is NOT_CACHED))
+        if not missing:
+            return values
+        tokens = [cache.begin(key) for key in missing]
+        try:
+            fetched = dict(zip(missing, self.execute('BULK_GET', *missing)))
+        except BaseException:
+            for key, token in zip(missing, tokens):
+                cache.abandon(key, token)
+            raise
+        for key, token in zip(missing, tokens):
+            # BULK_GET reads keys of another type as missing, where GET fails,
+            # so only values found are kept
+            if fetched[key] is not None:
+                cache.store(key, fetched[key], token)
+            else:
+                cache.abandon(key, token)
+        return [fetched[key] if value is NOT_CACHED else value for key, value in zip(keys, values)]
+
+    def pipeline(self, transaction=False):
+        """
+        Return a Pipeline that batches commands into one round trip; with
+        transaction=True they run as one MULTI/EXEC transaction
+        """
+        return Pipeline(self, transaction)
+
+    def scan_iter(self, match=None, count=None):
+        """Yield every key in the current database, one SCAN step at a time"""
+        cursor = None
+        while cursor != 0:
+            cursor, keys = self.scan(cursor or 0, match, count)
+            yield from keys
+
+    # Transactions. MULTI and WATCH hold state on the connection, so these
+    # are Client only; an AsyncClient hands its pooled connections around
+    # and runs transactions through pipeline(transaction=True) instead.
+    def multi(self):
+        return self.execute('MULTI')
+
+    def exec(self):
+        return self.execute('EXEC')
+
+    def discard(self):
+        return self.execute('DISCARD')
+
+    def watch(self, *keys):
+        return self.execute('WATCH', *keys)
+
+    def unwatch(self):
+        return self.execute('UNWATCH')
+
+    # Publish/subscribe. Once subscribed the connection only takes these
+    # four commands until it unsubscribes from everything.
+    def subscribe(self, *channels):
+        """Subscribe to channels; returns the number of subscriptions"""
+        return self._subscription('SUBSCRIBE', channels)
+
+    def psubscribe(self, *patterns):
+        """Subscribe to every channel matching glob-style patterns"""
+        return self._subscription('PSUBSCRIBE', patterns)
+
+    def unsubscribe(self, *channels):
+        """Unsubscribe from channels, or from all of them with none given"""
+        return self._subscription('UNSUBSCRIBE', channels)
+
+    def punsubscribe(self, *patterns):
+        return self._subscription('PUNSUBSCRIBE', patterns)
+
+    def get_message(self):
+        """
+        Wait for the next published message: ['message', channel, data],
+        or ['pmessage', pattern, channel, data] for a pattern subscription
+        """
+        if self._messages:
+            return self._messages.popleft()
+        return self._protocol.handle_request(self._fh)
+
+    def listen(self):
+        """Yield published messages as they arrive"""
+        while True:
+            yield self.get_message()
+
+    def _subscription(self, command, names):
+        """
+        Send a (P)SUBSCRIBE or (P)UNSUBSCRIBE and read its reply, one frame
+        per name. Messages already on their way are kept for get_message().
+        """
+        self._protocol.write_response(self._fh, (command,) + names)
+        subscribed = self._channels if command in ('SUBSCRIBE', 'UNSUBSCRIBE') else self._patterns
+        # Without names the server unsubscribes from each current one in turn
+        expected = len(names) or max(len(subscribed), 1)
+        count = len(self._channels) + len(self._patterns)
+        while expected:
+            resp = self._protocol.handle_request(self._fh)
+            if isinstance(resp, Error):
+                raise CommandError(resp.message)
+            kind, name = resp[0], resp[1]
+            if kind.__class__ is bytes:
+                kind = kind.decode('utf-8')
+            if kind in ('message', 'pmessage'):
+                self._messages.append(resp)
+                continue
+            count = resp[2]
+            if kind in ('subscribe', 'psubscribe'):
+                subscribed.add(name)
+            else:
+                subscribed.discard(name)
+            expected -= 1
+        return count
+
+
+def _read_invalidations(listener, cache):
+    """Apply the invalidations published to a cache's listener connection until it closes"""
+    try:
+        while True:
+            message = listener.get_message()
+            if message[0] == 'message' and message[1] == INVALIDATE_CHANNEL:
+                cache.invalidate(message[2])
+    except (Disconnect, OSError, ValueError):
+        pass
+    finally:
+        # Without invalidations nothing cached can be trusted any more
+        cache.close()
+        listener.close()
+
+
+class Pipeline(Client):
+    """
+    Queue commands on top of a Client and send them in a single batch.
+    Every Client command method is available; calls are recorded and
+    nothing goes over the wire until send() is called:
+
+        pipe = client.pipeline()
+        pipe.set('a', '1')
+        pipe.get('a')
+        pipe.send()  # [1, '1']
+
+    With transaction=True the batch is wrapped in MULTI and EXEC, so no
+    other client's commands run in between. After client.watch(key) the
+    transaction only runs if key is unchanged, and send() raises
+    WatchError otherwise.
+    """
+    def __init__(self, client, transaction=False):
+        self._client = client
+        self._queue = []
+        self._transaction = transaction
+
+    def __len__(self):
+        return len(self._queue)
+
+    def execute(self, *args):
+        self._queue.append(args)
+        return self
+
+    def _subscription(self, command, names):
+        # The reply is a frame per name, which a batch can't line up
+        raise CommandError(f"{command} can't be pipelined; call it on the Client")
+
+    def send(self, raise_on_error=True):
+        """
+        Write every queued command at once, then read one reply per command
+        Args:
+            raise_on_error: Raise CommandError for the first error reply,
+                otherwise errors are returned in place as Error tuples
+        """
+        if not self._queue:
+            return []
+        queue, self._queue = self._queue, []
+        client = self._client
+        sent = [('MULTI',)] + queue + [('EXEC',)] if self._transaction else queue
+        client._protocol.write_responses(client._fh, sent)
+        results = [client._protocol.handle_request(client._fh) for _ in sent]
+        if self._transaction:
+            results = unpack_transaction(results)
+
+        # Keep the parent client's session bookkeeping in step
+        for args, resp in zip(queue, results):
+            client._track_session(args, resp)
+
+        if raise_on_error:
+            for resp in results:
+                if isinstance(resp, Error):
+                    raise CommandError(resp.message)
+        return results
+
 class Server(object):
-    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, max_clients=64, password=None):
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, max_clients=64, password=None,
+                 append_log=None, append_fsync='everysec', snapshot_compress=False,
+                 listener=None, dump_prefix='reddb', maxmemory=None, maxmemory_policy='noeviction',
+                 maxmemory_samples=MAXMEMORY_SAMPLES, slowlog_threshold=SLOWLOG_THRESHOLD,
+                 slowlog_max_len=SLOWLOG_MAX_LEN, replicaof=None, master_password=None,
+                 repl_backlog_size=REPL_BACKLOG_SIZE, pubsub_output_limit=PUBSUB_OUTPUT_LIMIT,
+                 raw_values=False, unix_socket=None, unix_socket_perm=UNIX_SOCKET_PERM):
+        if maxmemory_policy not in MAXMEMORY_POLICIES:
+            raise ValueError(f"maxmemory policy must be one of {', '.join(MAXMEMORY_POLICIES)}")
         self._pool = Pool(max_clients)
         self._server = StreamServer(
-            (host, port),
+            listener if listener is not None else (host, port),
             self.connection_handler,
             spawn=self._pool)
+        # Optional second listener on a Unix socket for clients on the same
+        # host, which skip the TCP loopback stack. Both share the pool, so
+        # max_clients counts connections over either.
+        self._unix_socket = unix_socket
+        self._unix_server = None
+        if unix_socket is not None:
+            self._unix_server = StreamServer(
+                listen_unix(unix_socket, unix_socket_perm),
+                self._unix_connection_handler,
+                spawn=self._pool)
 
         self._protocol = ProtocolHandler()
+        self._started = time.time()
         self._password = password  # None means no password required
+        self._snapshot_compress = snapshot_compress
+        self._dump_prefix = dump_prefix  # Start of default dump file names
+        # Keep the values of SET, BULK_SET and PUBLISH as the bytes received
+        # instead of decoding them; see the values of the command table
+        self._raw_values = raw_values
+        
+        # Memory ceiling; None means unlimited
+        self._maxmemory = parse_memory(maxmemory) if maxmemory is not None else None
+        self._maxmemory_policy = maxmemory_policy
+        self._maxmemory_samples = maxmemory_samples
+        # BLPOP/BRPOP clients parked on each (db_id, key), longest waiting first
+        self._blocked = {}
         
         # Multi-database support
-        self._databases = {0: Database(0)}  # Default database
+        self._databases = {0: self._create_database(0)}  # Default database
         self._next_db_id = 1
         
         self._commands = self.get_commands()
+        self._stats = ServerStats(self._commands)
+        # Commands that ran for at least slowlog_threshold microseconds
+        self._slowlog = SlowLog(slowlog_threshold, slowlog_max_len)
         self._time_dump_greenlet = None
         self._time_dump_interval = None
+        self._save_state = {
+            'status': 'idle', 'mode': None, 'started': None, 'files': [],
+            'keys_written': 0, 'keys_total': 0,
+            'last_status': None, 'last_time': None, 'last_duration': None, 'last_keys': 0,
+        }
+        
+        # Replication. The backlog of writes is created when the first
+        # replica connects; _replicas holds the offset sent to each one.
+        # _master is the (host, port) this server replicates, None on a
+        # master, and the master_ fields track where in its stream we are.
+        self._repl_backlog_size = repl_backlog_size
+        self._backlog = None
+        self._replicas = {}
+        self._master = None
+        self._master_password = master_password
+        self._master_link = 'down'
+        self._master_error = None
+        self._master_replid = None
+        self._master_offset = 0
+        self._master_db = 0
+        self._repl_greenlet = None
+        # Set while EXEC runs, so the writes it propagates get wrapped in
+        # MULTI ... EXEC and are replayed and replicated all or nothing
+        self._multi_pending = False
+        self._multi_open = False
+        # Channel and pattern subscriptions; each subscriber may have up to
+        # pubsub_output_limit bytes waiting to be sent before it is dropped
+        self._pubsub = PubSub()
+        self._pubsub_output_limit = pubsub_output_limit
+        # Session of every open connection by its CLIENT ID, so a tracking
+        # connection's invalidations can find the one it redirects them to
+        self._sessions = {}
+        self._next_client_id = 1
+        
+        # Append-only write log, replayed before the server starts
+        self._append_log = None
+        if append_log is not None:
+            log = AppendLog(append_log, append_fsync)
+            self._replay_append_log(log)
+            log.open()
+            self._append_log = log
+        if replicaof is not None:
+            self.replicaof(replicaof[0], str(replicaof[1]))
         
         # Start the TTL cleanup thread
         self._cleanup_greenlet = gevent.spawn(self._cleanup_expired_keys)
 
     def get_commands(self):
-        return { 
-            "AUTH": self.auth,
-            "SET_PASSWORD": self.set_password,
-            "SELECT": self.select_db,
-            "NEW_DB": self.new_db,
-            "LIST_DBS": self.list_dbs,
-            "DROP_DB": self.drop_db,
-            "GET": self.get, 
-            "SET": self.set, 
-            "DELETE": self.delete,
-            "EXISTS": self.exists,
-            "DEL_TIME": self.del_time,
-            "FLUSH": self.flush, 
-            "DUMP": self.dump,
-            "LOAD": self.load,
-            "TIME_DUMP": self.time_dump,
-            "BULK_GET": self.bulk_get,
-            "BULK_SET": self.bulk_set
-        }
+        """The command table, with each handler and write hook bound to this server"""
+        return {name: BoundCommand(spec, getattr(self, spec.handler),
+                                   getattr(self, spec.log) if spec.log is not None else None,
+                                   spec.flags, spec.fewest, math.inf if spec.most is None else spec.most)
+                for name, spec in COMMAND_TABLE.items()}
 
     def _cleanup_expired_keys(self):
         """Background task to clean up expired keys across all databases"""
         while True:
             current_time = time.time()
+            pending = False
             
-            for db in self._databases.values():
-                expired_keys = []
-                
-                for key, expire_time in db._ttl.items():
-                    if current_time >= expire_time:
-                        expired_keys.append(key)
-                
-                for key in expired_keys:
-                    if key in db._kv:
-                        del db._kv[key]
-                    if key in db._ttl:
-                        del db._ttl[key]
+            # Each database only looks at keys that are actually due, and at
+            # most EXPIRE_BATCH_SIZE of them per pass
+            for db in list(self._databases.values()):
+                self._stats.expired_keys += db.expire_due(current_time, EXPIRE_BATCH_SIZE)
+                pending = pending or db.has_due(current_time)
             
-            gevent.sleep(1)  # Check every second
+            # Yield to clients and come straight back while a backlog of due
+            # keys remains, otherwise check again in a second
+            gevent.sleep(YIELD_INTERVAL if pending else EXPIRE_INTERVAL)
 
     def _is_expired(self, db, key):
         """Check if a key has expired in specific database"""
-        if key in db._ttl:
-            if time.time() >= db._ttl[key]:
-                # Key has expired, remove it
-                if key in db._kv:
-                    del db._kv[key]
-                del db._ttl[key]
-                return True
+        if db.is_expired(key):
+            self._stats.expired_keys += 1
+            return True
         return False
 
+    def _create_database(self, db_id):
+        db = Database(db_id)
+        if self._maxmemory is not None and self._maxmemory_policy.endswith(('-lru', '-lfu')):
+            db.track_access(self._maxmemory_policy[-3:])
+        db.on_invalidate = self._invalidate
+        return db
+
+    def used_memory(self):
+        return sum(db.used_memory for db in self._databases.values())
+
+    def memory_stats(self):
+        """Estimated memory use and eviction counters"""
+        stats = {
+            'used_memory': self.used_memory(),
+            'maxmemory': self._maxmemory or 0,
+            'maxmemory_policy': self._maxmemory_policy,
+            'evicted_keys': self._stats.evicted_keys,
+        }
+        for db_id, db in self._databases.items():
+            stats[f'db{db_id}_memory'] = db.used_memory
+        return stats
+
+    def info(self):
+        """Server, command latency, keyspace and persistence statistics"""
+        info = {
+            'uptime_seconds': int(time.time() - self._started),
+            'used_memory': self.used_memory(),
+            'maxmemory': self._maxmemory or 0,
+            'maxmemory_policy': self._maxmemory_policy,
+            'bgsave_in_progress': 1 if self._save_state['status'] == 'in_progress' else 0,
+            'blocked_clients': len({id(w) for waiters in self._blocked.values() for w in waiters}),
+            'pubsub_channels': len(self._pubsub.channels),
+            'pubsub_patterns': len(self._pubsub.patterns),
+            'tracking_clients': sum(1 for session in self._sessions.values() if 'tracking' in session),
+            'tracked_keys': sum(len(db._tracked) for db in self._databases.values()),
+        }
+        info.update(self._stats.info())
+        info['replication'] = self._replication_info()
+        info['databases'] = {
+            f'db{db_id}': {'keys': len(db._kv), 'expires': len(db._ttl), 'memory': db.used_memory}
+            for db_id, db in self._databases.items()
+        }
+        return info
+
+    def stats(self, subcommand):
+        """STATS RESET starts the INFO counters and histograms from zero"""
+        if subcommand.upper() != 'RESET':
+            return Error(f"Unknown STATS subcommand {subcommand}")
+        self._stats.reset()
+        return "OK"
+
+    def slowlog(self, subcommand, *args):
+        """SLOWLOG GET [count] | LEN | RESET"""
+        subcommand = subcommand.upper()
+        if subcommand == 'GET' and len(args) <= 1:
+            count = parse_int(args[0]) if args else SLOWLOG_DEFAULT_COUNT
+            if count is None or count < 0:
+                return Error("Count must be a non-negative integer")
+            return self._slowlog.get(count)
+        elif subcommand == 'LEN' and not args:
+            return len(self._slowlog)
+        elif subcommand == 'RESET' and not args:
+            self._slowlog.reset()
+            return "OK"
+        return Error(f"Invalid arguments for SLOWLOG {subcommand}")
+
+    def command(self, subcommand=None, *args):
+        """
+        COMMAND describes every command from the command table: its name,
+        arity, flags and key positions. COMMAND COUNT counts them, COMMAND
+        INFO name ... describes just those, and COMMAND GETKEYS command
+        arg ... picks out the keys of a request.
+        """
+        if subcommand is None:
+            return [command_info(entry.spec) for entry in self._commands.values()]
+        subcommand = subcommand.upper()
+        if subcommand == 'COUNT' and not args:
+            return len(self._commands)
+        if subcommand == 'INFO':
+            return [command_info(self._commands[name.upper()].spec) if name.upper() in self._commands else None
+                    for name in args]
+        if subcommand == 'GETKEYS' and args:
+            entry = self._commands.get(args[0].upper())
+            if entry is None:
+                return Error(f"Unrecognized command: {args[0]}")
+            if not entry.fewest <= len(args) - 1 <= entry.most:
+                return Error(f"Invalid arguments for {entry.spec.name}")
+            return command_keys(entry.spec, list(args))
+        return Error(f"Unknown COMMAND subcommand {subcommand}")
+
+    def _free_memory(self):
+        """
+        Evict keys until the estimated memory use is under maxmemory. Each
+        eviction samples a few keys per database and drops the one the
+        policy likes least. Returns False if memory is still over the limit.
+        """
+        policy = self._maxmemory_policy
+        while self.used_memory() > self._maxmemory:
+            if policy == 'noeviction':
+                return False
+            best = None
+            for db in self._databases.values():
+                candidate = db.eviction_candidate(policy, self._maxmemory_samples)
+                if candidate is not None and (best is None or candidate[0] > best[0]):
+                    best = candidate + (db,)
+            if best is None:
+                return False
+            _, key, db = best
+            db.delete(key)
+            self._stats.evicted_keys += 1
+            if self._append_log is not None or self._backlog is not None:
+                self._propagate(db.db_id, 'DELETE', key)
+        return True
+
     def _get_next_available_db_id(self):
         """Find the next available database ID"""
         db_id = 0
@@ -208,10 +999,11 @@ class Server(object):
         return db_id
 
     # Authentication
-    def auth(self, password):
+    def auth(self, password, session_state):
         if self._password is None:
             return Error("No password set on server")
         if password == self._password:
+            session_state['authenticated'] = True
             return "OK"
         return Error("Invalid password")
 
@@ -222,10 +1014,11 @@ class Server(object):
         return f"Password set"
 
     # Database management
-    def select_db(self, db_id_str):
+    def select_db(self, db_id_str, session_state):
         try:
             db_id = int(db_id_str)
             if db_id in self._databases:
+                session_state['current_db'] = db_id
                 return "OK"
             return Error(f"Database {db_id} does not exist")
         except ValueError:
@@ -245,7 +1038,7 @@ class Server(object):
             except ValueError:
                 return Error("Database ID must be an integer")
         
-        self._databases[db_id] = Database(db_id)
+        self._databases[db_id] = self._create_database(db_id)
         return f"Database {db_id} created"
 
     def list_dbs(self):
@@ -263,7 +1056,7 @@ class Server(object):
             if db_id not in self._databases:
                 return Error(f"Database {db_id} does not exist")
             
-            del self._databases[db_id]
+            self._databases.pop(db_id).untrack_all()
             return f"Database {db_id} dropped"
         except ValueError:
             return Error("Database ID must be an integer")
@@ -278,38 +1071,35 @@ class Server(object):
         if self._is_expired(db, key):
             return None
             
+        # "*" and "**" materialize the whole database in one reply; SCAN
+        # walks it in bounded steps instead
         if key == "*":
-            # Filter out expired keys
-            valid_values = []
-            for k, v in db._kv.items():
-                if not self._is_expired(db, k):
-                    valid_values.append(v)
-            return valid_values
+            now = time.time()
+            return [format_value(v) for k, v in db._kv.items() if db._ttl.get(k, now + 1) > now]
         elif key == "**":
-            # Filter out expired keys
-            valid_dict = {}
-            for k, v in db._kv.items():
-                if not self._is_expired(db, k):
-                    valid_dict[k] = v
-            return valid_dict
+            now = time.time()
+            return {k: format_value(v) for k, v in db._kv.items() if db._ttl.get(k, now + 1) > now}
         
-        return db._kv.get(key)
+        value = db.get(key)
+        if value is not None and not is_string(value):
+            return Error(WRONG_TYPE)
+        return format_value(value)
 
     def set(self, key, value, ttl=None, db_id=0):
         if db_id not in self._databases:
             return Error(f"Database {db_id} does not exist")
         
         db = self._databases[db_id]
-        db._kv[key] = value
+        db.put(key, value)
         
         if ttl is not None:
             try:
                 ttl_seconds = int(ttl)
                 if ttl_seconds > 0:
-                    db._ttl[key] = time.time() + ttl_seconds
-                elif key in db._ttl:
+                    db.set_ttl(key, time.time() + ttl_seconds)
+                else:
                     # Remove TTL if ttl is 0 or negative
-                    del db._ttl[key]
+                    db.remove_ttl(key)
             except (ValueError, TypeError):
                 pass  # Invalid TTL, ignore it
         
@@ -330,143 +1120,709 @@ class Server(object):
             return Error(f"Database {db_id} does not exist")
         
         db = self._databases[db_id]
-        if key in db._ttl:
-            del db._ttl[key]
-            return 1
-        return 0
+        return 1 if db.remove_ttl(key) else 0
 
     def delete(self, key, db_id=0):
         if db_id not in self._databases:
             return Error(f"Database {db_id} does not exist")
         
         db = self._databases[db_id]
-        deleted = 0
-        if key in db._kv:
-            del db._kv[key]
-            deleted = 1
-        if key in db._ttl:
-            del db._ttl[key]
-        return deleted
+        return 1 if db.delete(key) else 0
 
-    def flush(self, password, db_id=0):
-        if password != self._password:
-            return Error("Invalid password")
-        
+    # Counters. Results are stored as native ints and floats, so repeated
+    # updates skip string parsing; GET turns them back into strings.
+    def incr(self, key, db_id=0):
+        return self.incrby(key, 1, db_id)
+
+    def decr(self, key, db_id=0):
+        return self.incrby(key, -1, db_id)
+
+    def decrby(self, key, amount, db_id=0):
+        amount = parse_int(amount)
+        if amount is None:
+            return Error("Decrement is not an integer")
+        return self.incrby(key, -amount, db_id)
+
+    def incrby(self, key, amount, db_id=0):
+        """Add to an integer counter, starting from 0; keeps the key's TTL"""
         if db_id not in self._databases:
             return Error(f"Database {db_id} does not exist")
         
+        amount = parse_int(amount)
+        if amount is None:
+            return Error("Increment is not an integer")
         db = self._databases[db_id]
-        kvlen = len(db._kv)
-        db._kv.clear()
-        db._ttl.clear()
-        return kvlen
+        self._is_expired(db, key)
+        value = db._kv.get(key, 0)
+        if not is_string(value):
+            return Error(WRONG_TYPE)
+        current = parse_int(value)
+        if current is None:
+            return Error("Value is not an integer")
+        result = current + amount
+        if not INT64_MIN <= result <= INT64_MAX:
+            return Error("Increment or decrement would overflow")
+        db.put(key, result)
+        return result
 
-    def dump(self, password, filename=None, db_id=0):
-        """Save database to file"""
-        if password != self._password:
-            return Error("Invalid password")
+    def incrbyfloat(self, key, amount, db_id=0):
+        """Add to a float counter, starting from 0; keeps the key's TTL"""
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
         
+        amount = parse_float(amount)
+        if amount is None:
+            return Error("Increment is not a valid float")
+        db = self._databases[db_id]
+        self._is_expired(db, key)
+        value = db._kv.get(key, 0)
+        if not is_string(value):
+            return Error(WRONG_TYPE)
+        current = parse_float(value)
+        if current is None:
+            return Error("Value is not a valid float")
+        result = current + amount
+        if not math.isfinite(result):
+            return Error("Increment would produce NaN or Infinity")
+        db.put(key, result)
+        return format_float(result)
+
+    def _get_typed(self, db, key, is_type):
+        """The value at key if is_type accepts it, None if there is none, or a WRONG_TYPE Error"""
+        if self._is_expired(db, key):
+            return None
+        value = db.get(key)
+        if value is not None and not is_type(value):
+            return Error(WRONG_TYPE)
+        return value
+
+    # Hashes. A hash is one key holding many fields, with a single TTL for
+    # the whole hash; see hashType for how the fields are stored.
+    def hset(self, key, *items, db_id=0):
+        """Set field value pairs, creating the hash; returns the number of new fields"""
         if db_id not in self._databases:
             return Error(f"Database {db_id} does not exist")
+        if len(items) % 2:
+            return Error("HSET requires field value pairs")
         
         db = self._databases[db_id]
+        h = self._get_typed(db, key, is_hash)
+        if isinstance(h, Error):
+            return h
+        added = 0
+        for field, value in zip(items[::2], items[1::2]):
+            added += db.set_field(key, field, value)
+        return added
+
+    def hget(self, key, field, db_id=0):
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
         
-        if filename is None:
-            filename = f"reddb_dump_db{db_id}_{int(time.time())}.json"
+        h = self._get_typed(self._databases[db_id], key, is_hash)
+        if h is None or isinstance(h, Error):
+            return h
+        return format_value(hash_get(h, field))
+
+    def hmget(self, key, *fields, db_id=0):
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
         
-        try:
-            # Prepare data for dumping (filter out expired keys)
-            current_time = time.time()
-            dump_data = {
-                'database_id': db_id,
-                'data': {},
-                'ttl': {},
-                'timestamp': current_time
-            }
-            
-            for key, value in db._kv.items():
-                if not self._is_expired(db, key):
-                    dump_data['data'][key] = value
-                    if key in db._ttl:
-                        # Store remaining TTL seconds
-                        remaining_ttl = db._ttl[key] - current_time
-                        if remaining_ttl > 0:
-                            dump_data['ttl'][key] = remaining_ttl
-            
-            with open(filename, 'w') as f:
-                json.dump(dump_data, f, indent=2)
-            
-            return f"Database {db_id} dumped to {filename}"
-        except Exception as e:
-            return Error(f"Failed to dump database: {str(e)}")
+        h = self._get_typed(self._databases[db_id], key, is_hash)
+        if h is None:
+            return [None] * len(fields)
+        if isinstance(h, Error):
+            return h
+        return [format_value(hash_get(h, field)) for field in fields]
 
-    def load(self, password, filename, db_id=0):
-        """Load database from dump file"""
-        if password != self._password:
-            return Error("Invalid password")
+    def hgetall(self, key, db_id=0):
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
         
+        h = self._get_typed(self._databases[db_id], key, is_hash)
+        if h is None:
+            return {}
+        if isinstance(h, Error):
+            return h
+        return format_value(h)
+
+    def hdel(self, key, *fields, db_id=0):
+        """Remove fields; the key goes away with the last one"""
         if db_id not in self._databases:
             return Error(f"Database {db_id} does not exist")
         
         db = self._databases[db_id]
+        h = self._get_typed(db, key, is_hash)
+        if h is None or isinstance(h, Error):
+            return h or 0
+        return sum(db.delete_field(key, field) for field in fields)
+
+    def hincrby(self, key, field, amount, db_id=0):
+        """Add to an integer field, starting from 0"""
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
         
-        try:
-            if not os.path.exists(filename):
-                return Error(f"File not found: {filename}")
-            
-            with open(filename, 'r') as f:
-                dump_data = json.load(f)
-            
-            # Validate dump file format
-            if not isinstance(dump_data, dict):
-                return Error("Invalid dump file format: root must be object")
-            
-            if 'data' not in dump_data:
-                return Error("Invalid dump file format: missing 'data' field")
-            
-            # Clear current database
-            old_count = len(db._kv)
-            db._kv.clear()
-            db._ttl.clear()
-            
-            # Load data
-            current_time = time.time()
-            loaded_count = 0
-            
-            for key, value in dump_data['data'].items():
-                db._kv[key] = value
-                loaded_count += 1
-                
-                # Restore TTL if present
-                if 'ttl' in dump_data and key in dump_data['ttl']:
-                    try:
-                        remaining_ttl = float(dump_data['ttl'][key])
-                        if remaining_ttl > 0:
-                            db._ttl[key] = current_time + remaining_ttl
-                    except (ValueError, TypeError):
-                        pass  # Skip invalid TTL values
-            
-            source_db = dump_data.get('database_id', 'unknown')
-            return f"Database loaded from {filename} (source DB: {source_db}). Replaced {old_count} keys with {loaded_count} keys in DB {db_id}."
-            
-        except json.JSONDecodeError as e:
-            return Error(f"Invalid JSON in dump file: {str(e)}")
-        except Exception as e:
-            return Error(f"Failed to load database: {str(e)}")
+        amount = parse_int(amount)
+        if amount is None:
+            return Error("Increment is not an integer")
+        db = self._databases[db_id]
+        h = self._get_typed(db, key, is_hash)
+        if isinstance(h, Error):
+            return h
+        value = None if h is None else hash_get(h, field)
+        current = 0 if value is None else parse_int(value)
+        if current is None:
+            return Error("Hash value is not an integer")
+        result = current + amount
+        if not INT64_MIN <= result <= INT64_MAX:
+            return Error("Increment or decrement would overflow")
+        db.set_field(key, field, result)
+        return result
 
-    def time_dump(self, interval):
-        """Set up automatic database dumping every interval seconds"""
-        try:
-            interval_seconds = int(interval)
-            if interval_seconds <= 0:
-                # Stop time dumping
-                if self._time_dump_greenlet:
-                    self._time_dump_greenlet.kill()
-                    self._time_dump_greenlet = None
-                self._time_dump_interval = None
-                return "Time dump stopped"
-            
-            # Stop existing time dump if running
+    def hlen(self, key, db_id=0):
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        h = self._get_typed(self._databases[db_id], key, is_hash)
+        if h is None or isinstance(h, Error):
+            return h or 0
+        return hash_len(h)
+
+    def hexists(self, key, field, db_id=0):
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        h = self._get_typed(self._databases[db_id], key, is_hash)
+        if h is None or isinstance(h, Error):
+            return h or 0
+        return 0 if hash_get(h, field) is None else 1
+
+    def expire(self, key, seconds, db_id=0):
+        """Set a TTL on an existing key of any type; 0 or less deletes it"""
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        seconds = parse_int(seconds)
+        if seconds is None:
+            return Error("TTL is not an integer")
+        db = self._databases[db_id]
+        if self._is_expired(db, key) or key not in db._kv:
+            return 0
+        if seconds > 0:
+            db.set_ttl(key, time.time() + seconds)
+        else:
+            db.delete(key)
+        return 1
+
+    # Lists. A list is a deque, so pushes and pops at either end are O(1).
+    # BLPOP and BRPOP with nothing to pop return Blocked, and the connection
+    # handler parks the client's greenlet until a push wakes it.
+    def lpush(self, key, *values, db_id=0):
+        return self._push(key, values, True, db_id)
+
+    def rpush(self, key, *values, db_id=0):
+        return self._push(key, values, False, db_id)
+
+    def _push(self, key, values, left, db_id):
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        db = self._databases[db_id]
+        items = self._get_typed(db, key, is_list)
+        if isinstance(items, Error):
+            return items
+        length = db.push(key, values, left)
+        self._wake_waiter(db_id, key)
+        return length
+
+    def lpop(self, key, db_id=0):
+        return self._pop(key, True, db_id)
+
+    def rpop(self, key, db_id=0):
+        return self._pop(key, False, db_id)
+
+    def _pop(self, key, left, db_id):
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        db = self._databases[db_id]
+        items = self._get_typed(db, key, is_list)
+        if items is None or isinstance(items, Error):
+            return items
+        return db.pop(key, left)
+
+    def lrange(self, key, start, stop, db_id=0):
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        start, stop = parse_int(start), parse_int(stop)
+        if start is None or stop is None:
+            return Error("Start and stop must be integers")
+        items = self._get_typed(self._databases[db_id], key, is_list)
+        if items is None:
+            return []
+        if isinstance(items, Error):
+            return items
+        return list_range(items, start, stop)
+
+    def llen(self, key, db_id=0):
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        items = self._get_typed(self._databases[db_id], key, is_list)
+        if items is None or isinstance(items, Error):
+            return items or 0
+        return len(items)
+
+    def blpop(self, *args, db_id=0):
+        return self._blocking_pop(args, True, db_id)
+
+    def brpop(self, *args, db_id=0):
+        return self._blocking_pop(args, False, db_id)
+
+    def _blocking_pop(self, args, left, db_id):
+        """Pop from the first non-empty list of the keys as [key, value], or return Blocked"""
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        keys = args[:-1]
+        timeout = parse_float(args[-1])
+        if timeout is None or timeout < 0:
+            return Error("Timeout must be a non-negative number")
+        db = self._databases[db_id]
+        for key in keys:
+            items = self._get_typed(db, key, is_list)
+            if isinstance(items, Error):
+                return items
+            if items:
+                return [key, db.pop(key, left)]
+        return Blocked(keys, timeout)
+
+    def _wait_blocked(self, request, blocked, session_state, conn=None):
+        """
+        Park the calling greenlet until a push to one of the blocked keys
+        wakes it, then run the request again. Returns the reply, or None
+        once the timeout passes. A push wakes a single waiter; if a value
+        is left after it pops, it wakes the next one in turn.
+        """
+        db_id = session_state.get('current_db', 0)
+        deadline = time.time() + blocked.timeout if blocked.timeout else None
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+            waiter = Event()
+            for key in blocked.keys:
+                self._blocked.setdefault((db_id, key), deque()).append(waiter)
+            try:
+                waiter.wait(remaining)
+            finally:
+                for key in blocked.keys:
+                    waiters = self._blocked.get((db_id, key))
+                    if waiters is None:
+                        continue
+                    try:
+                        waiters.remove(waiter)
+                    except ValueError:
+                        pass  # Already taken off by the push that woke it
+                    if not waiters:
+                        del self._blocked[(db_id, key)]
+            if not waiter.is_set():
+                return None
+            if conn is not None and self._client_gone(conn):
+                # Pass the wake-up on rather than pop a value nobody will read
+                for key in blocked.keys:
+                    self._wake_waiter(db_id, key)
+                return None
+            resp = self.get_response(request, session_state)
+            if resp.__class__ is not Blocked:
+                db = self._databases.get(db_id)
+                if resp.__class__ is list and db is not None and resp[0] in db._kv:
+                    self._wake_waiter(db_id, resp[0])
+                return resp
+            # Another client popped the value first; wait again
+
+    def _wake_waiter(self, db_id, key):
+        """Wake the client that has waited longest on key, if any"""
+        waiters = self._blocked.get((db_id, key))
+        while waiters:
+            waiter = waiters.popleft()
+            # A client blocked on several keys may have been woken already
+            if not waiter.is_set():
+                waiter.set()
+                return
+
+    # Sorted sets. Members are kept in score order by a skiplist that also
+    # tracks ranks, with their scores in a dict alongside; see zsetType.
+    def zadd(self, key, *items, db_id=0):
+        """ZADD key score member [score member ...]; returns the number of new members"""
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        if len(items) % 2:
+            return Error("ZADD requires score member pairs")
+        
+        pairs = []
+        for score, member in zip(items[::2], items[1::2]):
+            score = parse_score(score)
+            if score is None:
+                return Error("Score is not a valid float")
+            pairs.append((member, score))
+        db = self._databases[db_id]
+        zset = self._get_typed(db, key, is_zset)
+        if isinstance(zset, Error):
+            return zset
+        return sum(db.set_score(key, member, score) for member, score in pairs)
+
+    def zincrby(self, key, amount, member, db_id=0):
+        """Add to a member's score, starting from 0; returns the new score"""
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        amount = parse_score(amount)
+        if amount is None:
+            return Error("Increment is not a valid float")
+        db = self._databases[db_id]
+        zset = self._get_typed(db, key, is_zset)
+        if isinstance(zset, Error):
+            return zset
+        score = amount + (0.0 if zset is None else zset.scores.get(member, 0.0))
+        if math.isnan(score):
+            return Error("Resulting score is not a number")
+        db.set_score(key, member, score)
+        return format_score(score)
+
+    def zrange(self, key, start, stop, *options, db_id=0):
+        return self._range_by_rank(key, start, stop, options, False, db_id)
+
+    def zrevrange(self, key, start, stop, *options, db_id=0):
+        return self._range_by_rank(key, start, stop, options, True, db_id)
+
+    def _range_by_rank(self, key, start, stop, options, reverse, db_id):
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        start, stop = parse_int(start), parse_int(stop)
+        if start is None or stop is None:
+            return Error("Start and stop must be integers")
+        withscores = [option.upper() for option in options] == ['WITHSCORES']
+        if options and not withscores:
+            return Error(f"Unknown option {options[0]}")
+        zset = self._get_typed(self._databases[db_id], key, is_zset)
+        if zset is None:
+            return []
+        if isinstance(zset, Error):
+            return zset
+        return self._zset_reply(zset.range_by_rank(start, stop, reverse), withscores)
+
+    def zrangebyscore(self, key, low, high, *options, db_id=0):
+        """ZRANGEBYSCORE key min max [WITHSCORES] [LIMIT offset count]"""
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        low, high = parse_score_bound(low), parse_score_bound(high)
+        if low is None or high is None:
+            return Error("Min and max must be floats")
+        withscores = False
+        offset, count = 0, -1
+        options = list(options)
+        while options:
+            option = options.pop(0).upper()
+            if option == 'WITHSCORES':
+                withscores = True
+            elif option == 'LIMIT' and len(options) >= 2:
+                offset, count = parse_int(options.pop(0)), parse_int(options.pop(0))
+                if offset is None or count is None:
+                    return Error("LIMIT offset and count must be integers")
+                if offset < 0:
+                    return Error("LIMIT offset must not be negative")
+            else:
+                return Error(f"Unknown option {option}")
+        zset = self._get_typed(self._databases[db_id], key, is_zset)
+        if isinstance(zset, Error):
+            return zset
+        if zset is None:
+            return []
+        pairs = zset.range_by_score(low[0], high[0], low[1], high[1], offset, count)
+        return self._zset_reply(pairs, withscores)
+
+    def _zset_reply(self, pairs, withscores):
+        if not withscores:
+            return [member for member, _ in pairs]
+        reply = []
+        for member, score in pairs:
+            reply.extend([member, format_score(score)])
+        return reply
+
+    def zrank(self, key, member, db_id=0):
+        return self._rank(key, member, False, db_id)
+
+    def zrevrank(self, key, member, db_id=0):
+        return self._rank(key, member, True, db_id)
+
+    def _rank(self, key, member, reverse, db_id):
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        zset = self._get_typed(self._databases[db_id], key, is_zset)
+        if zset is None or isinstance(zset, Error):
+            return zset
+        rank = zset.rank(member)
+        if rank is None or not reverse:
+            return rank
+        return len(zset) - 1 - rank
+
+    def zrem(self, key, *members, db_id=0):
+        """Remove members; the key goes away with the last one"""
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        db = self._databases[db_id]
+        zset = self._get_typed(db, key, is_zset)
+        if zset is None or isinstance(zset, Error):
+            return zset or 0
+        return sum(db.delete_member(key, member) for member in members)
+
+    def zscore(self, key, member, db_id=0):
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        zset = self._get_typed(self._databases[db_id], key, is_zset)
+        if zset is None or isinstance(zset, Error):
+            return zset
+        score = zset.scores.get(member)
+        return None if score is None else format_score(score)
+
+    def zcard(self, key, db_id=0):
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        zset = self._get_typed(self._databases[db_id], key, is_zset)
+        if zset is None or isinstance(zset, Error):
+            return zset or 0
+        return len(zset)
+
+    def _client_gone(self, conn):
+        """True if the peer has closed a connection whose greenlet is parked"""
+        try:
+            readable, _, _ = select.select([conn], [], [], 0)
+            return bool(readable) and not conn.recv(1, socket.MSG_PEEK)
+        except (OSError, ValueError):
+            return True
+
+    def flush(self, password, db_id=0):
+        if password != self._password:
+            return Error("Invalid password")
+        
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        db = self._databases[db_id]
+        kvlen = len(db._kv)
+        db.clear()
+        return kvlen
+
+    def dump(self, password, filename=None, db_id=0):
+        """Save database to file, as a binary snapshot or as JSON for *.json"""
+        if password != self._password:
+            return Error("Invalid password")
+        
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        db = self._databases[db_id]
+        
+        if filename is None:
+            filename = f"{self._dump_prefix}_dump_db{db_id}_{int(time.time())}{SNAPSHOT_EXTENSION}"
+        
+        started = time.time()
+        try:
+            if filename.lower().endswith('.json'):
+                keys = self._dump_json(db, filename)
+            else:
+                keys = self._dump_snapshot(db_id, db._kv, db._ttl, filename)
+            self._stats.record_dump(True, time.time() - started, keys)
+            return f"Database {db_id} dumped to {filename}"
+        except Exception as e:
+            self._stats.record_dump(False, time.time() - started)
+            return Error(f"Failed to dump database: {str(e)}")
+
+    def _dump_snapshot(self, db_id, kv, ttl, filename, on_progress=None):
+        """
+        Stream a database into a binary snapshot, one record at a time.
+        on_progress, if given, is called with the number of keys written
+        every SAVE_PROGRESS_INTERVAL keys and once at the end.
+        """
+        current_time = time.time()
+        # Write to a temporary file first so a failed dump never leaves a
+        # half-written snapshot under the real name
+        temp_filename = f"{filename}.tmp"
+        with open(temp_filename, 'wb') as f:
+            writer = SnapshotWriter(f, compress=self._snapshot_compress)
+            writer.begin_database(db_id)
+            for key, value in kv.items():
+                expire_at = ttl.get(key)
+                if expire_at is not None and expire_at <= current_time:
+                    continue
+                writer.write_key(key, value, expire_at)
+                if on_progress is not None and writer.keys_written % SAVE_PROGRESS_INTERVAL == 0:
+                    on_progress(writer.keys_written)
+            writer.close()
+        os.replace(temp_filename, filename)
+        if on_progress is not None:
+            on_progress(writer.keys_written)
+        return writer.keys_written
+
+    def _dump_json(self, db, filename):
+        """Export a database as JSON, with TTLs as remaining seconds"""
+        # Prepare data for dumping (filter out expired keys)
+        current_time = time.time()
+        dump_data = {
+            'database_id': db.db_id,
+            'data': {},
+            'zsets': {},  # Sorted sets as {member: score}, apart from the hashes in 'data'
+            'ttl': {},
+            'timestamp': current_time
+        }
+        
+        for key, value in db._kv.items():
+            section = dump_data['data']
+            if is_hash(value):
+                value = dict(hash_items(value))
+            elif is_list(value):
+                value = list(value)
+            elif is_zset(value):
+                section = dump_data['zsets']
+                value = dict(value)
+            elif value.__class__ is bytes:
+                try:
+                    value = value.decode('utf-8')
+                except UnicodeDecodeError:
+                    raise ValueError(f"{key} holds binary data, which JSON can't store; dump to a snapshot instead")
+            expire_time = db._ttl.get(key)
+            if expire_time is None:
+                section[key] = value
+            elif expire_time > current_time:
+                section[key] = value
+                # Store remaining TTL seconds
+                dump_data['ttl'][key] = expire_time - current_time
+        
+        with open(filename, 'w') as f:
+            json.dump(dump_data, f, indent=2)
+        return len(dump_data['data']) + len(dump_data['zsets'])
+
+    def load(self, password, filename, db_id=0):
+        """Load database from a binary snapshot or a JSON dump"""
+        if password != self._password:
+            return Error("Invalid password")
+        
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        try:
+            if not os.path.exists(filename):
+                return Error(f"File not found: {filename}")
+            
+            if is_snapshot(filename):
+                return self._load_snapshot(filename, db_id)
+            return self._load_json(filename, db_id)
+        except SnapshotError as e:
+            return Error(f"Invalid snapshot file: {str(e)}")
+        except json.JSONDecodeError as e:
+            return Error(f"Invalid JSON in dump file: {str(e)}")
+        except Exception as e:
+            return Error(f"Failed to load database: {str(e)}")
+
+    def _load_snapshot(self, filename, db_id):
+        """
+        Stream the first database section of a snapshot into a fresh
+        Database, swapped in only once the checksum has been verified
+        """
+        current_time = time.time()
+        new_db = self._create_database(db_id)
+        source_db = None
+        loading = False
+        with open(filename, 'rb') as f:
+            for record in SnapshotReader(f):
+                if record[0] == 'database':
+                    # Only the first section is loaded, but the rest is still
+                    # read so the checksum covers the whole file
+                    loading = source_db is None
+                    if loading:
+                        source_db = record[1]
+                elif loading:
+                    _, key, value, expire_at = record
+                    if expire_at is not None and expire_at <= current_time:
+                        continue
+                    new_db.put(key, value)
+                    if expire_at is not None:
+                        new_db.set_ttl(key, expire_at)
+        
+        old_count = len(self._databases[db_id]._kv)
+        self._databases[db_id].untrack_all()
+        self._databases[db_id] = new_db
+        return f"Database loaded from {filename} (source DB: {source_db}). Replaced {old_count} keys with {len(new_db._kv)} keys in DB {db_id}."
+
+    def _load_json(self, filename, db_id):
+        db = self._databases[db_id]
+        with open(filename, 'r') as f:
+            dump_data = json.load(f)
+        
+        # Validate dump file format
+        if not isinstance(dump_data, dict):
+            return Error("Invalid dump file format: root must be object")
+        
+        if 'data' not in dump_data:
+            return Error("Invalid dump file format: missing 'data' field")
+        
+        # Clear current database
+        old_count = len(db._kv)
+        db.clear()
+        
+        # Load data
+        current_time = time.time()
+        loaded_count = 0
+        
+        items = list(dump_data['data'].items())
+        for key, scores in dump_data.get('zsets', {}).items():
+            zset = SortedSet()
+            for member, score in scores.items():
+                zset.add(member, float(score))
+            items.append((key, zset))
+        
+        for key, value in items:
+            if isinstance(value, dict):
+                value = new_hash(value.items())
+            elif isinstance(value, list):
+                value = deque(value)
+            db.put(key, value)
+            loaded_count += 1
+            
+            # Restore TTL if present
+            if 'ttl' in dump_data and key in dump_data['ttl']:
+                try:
+                    remaining_ttl = float(dump_data['ttl'][key])
+                    if remaining_ttl > 0:
+                        db.set_ttl(key, current_time + remaining_ttl)
+                except (ValueError, TypeError):
+                    pass  # Skip invalid TTL values
+        
+        source_db = dump_data.get('database_id', 'unknown')
+        return f"Database loaded from {filename} (source DB: {source_db}). Replaced {old_count} keys with {loaded_count} keys in DB {db_id}."
+
+    def time_dump(self, interval):
+        """Set up automatic database dumping every interval seconds"""
+        try:
+            interval_seconds = int(interval)
+            if interval_seconds <= 0:
+                # Stop time dumping
+                if self._time_dump_greenlet:
+                    self._time_dump_greenlet.kill()
+                    self._time_dump_greenlet = None
+                self._time_dump_interval = None
+                return "Time dump stopped"
+            
+            # Stop existing time dump if running
             if self._time_dump_greenlet:
                 self._time_dump_greenlet.kill()
             
@@ -482,14 +1838,866 @@ class Server(object):
         while True:
             try:
                 gevent.sleep(self._time_dump_interval)
-                # Dump all databases
-                for db_id in self._databases:
-                    filename = f"reddb_auto_dump_db{db_id}_{int(time.time())}.json"
-                    self.dump(self._password, filename, db_id)
-                    console.print(f"Auto-dump completed: {filename}")
+                # Dump all databases in the background
+                targets = [(db_id, f"{self._dump_prefix}_auto_dump_db{db_id}_{int(time.time())}{SNAPSHOT_EXTENSION}")
+                           for db_id in self._databases]
+                result = self._start_background_save(targets)
+                if isinstance(result, Error):
+                    console.print(f"Auto-dump skipped: {result.message}")
             except Exception as e:
                 console.print(f"Auto-dump failed: {e}")
 
+    def bgsave(self, password, filename=None, db_id=0):
+        """Save database to a binary snapshot without blocking clients"""
+        if password != self._password:
+            return Error("Invalid password")
+        
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        if filename is None:
+            filename = f"{self._dump_prefix}_dump_db{db_id}_{int(time.time())}{SNAPSHOT_EXTENSION}"
+        elif filename.lower().endswith('.json'):
+            return Error("BGSAVE only writes binary snapshots, use DUMP for JSON")
+        
+        return self._start_background_save([(db_id, filename)])
+
+    def bgsave_status(self):
+        """Progress of the running background save and results of the last one"""
+        state = self._save_state
+        status = {
+            'status': state['status'],
+            'mode': state['mode'] or 'none',
+            'keys_written': state['keys_written'],
+            'keys_total': state['keys_total'],
+            'files': list(state['files']),
+            'last_save_status': state['last_status'] or 'none',
+            'last_save_keys': state['last_keys'],
+        }
+        if state['status'] == 'in_progress':
+            status['elapsed'] = '%.3f' % (time.time() - state['started'])
+        if state['last_time'] is not None:
+            status['last_save_time'] = int(state['last_time'])
+            status['last_save_duration'] = '%.3f' % state['last_duration']
+        return status
+
+    def _start_background_save(self, targets):
+        """
+        Snapshot (db_id, filename) targets without blocking the event loop.
+        Where fork() exists a child process writes the files from a
+        copy-on-write image of this process, so the view is consistent
+        and the parent keeps serving clients. Elsewhere each database is
+        copied up front, hashes, lists and sorted sets included since
+        writes change those in place, and written by a greenlet that
+        yields between batches. The copy has to be one step to be a
+        point-in-time view, so it blocks clients for as long as it takes.
+        """
+        state = self._save_state
+        if state['status'] == 'in_progress':
+            return Error("Background save already in progress")
+        
+        state.update(status='in_progress', started=time.time(), keys_written=0,
+                     keys_total=sum(len(self._databases[db_id]._kv) for db_id, _ in targets),
+                     files=[filename for _, filename in targets])
+        
+        if FORK_SAVES:
+            state['mode'] = 'fork'
+            pid, read_fd = fork_child(lambda write_fd: self._save_in_child(targets, write_fd))
+            gevent.spawn(self._watch_save_child, pid, read_fd)
+        else:
+            state['mode'] = 'incremental'
+            snapshots = [(db_id, {key: copy_value(value) for key, value in self._databases[db_id]._kv.items()},
+                          dict(self._databases[db_id]._ttl), filename)
+                         for db_id, filename in targets]
+            gevent.spawn(self._save_incrementally, snapshots)
+        
+        return f"Background save started ({state['mode']}): {', '.join(state['files'])}"
+
+    def _save_in_child(self, targets, write_fd):
+        """Body of the forked save process, reporting progress down write_fd"""
+        written = 0
+        
+        def report(count):
+            os.write(write_fd, struct.pack('<Q', written + count))
+        
+        for db_id, filename in targets:
+            db = self._databases[db_id]
+            written += self._dump_snapshot(db_id, db._kv, db._ttl, filename, report)
+
+    def _watch_save_child(self, pid, read_fd):
+        """Follow a forked save through its progress pipe until it exits"""
+        pending = b''
+        try:
+            while True:
+                data = nb_read(read_fd, 4096)
+                if not data:
+                    break
+                pending += data
+                if len(pending) >= 8:
+                    # Only the latest count matters
+                    end = len(pending) - len(pending) % 8
+                    self._save_state['keys_written'], = struct.unpack('<Q', pending[end - 8:end])
+                    pending = pending[end:]
+        finally:
+            os.close(read_fd)
+        self._finish_background_save(wait_child(pid) == 0)
+
+    def _save_incrementally(self, snapshots):
+        """Write copied databases from a greenlet, yielding between batches"""
+        written = 0
+        
+        def report(count):
+            self._save_state['keys_written'] = written + count
+            gevent.sleep(YIELD_INTERVAL)
+        
+        try:
+            for db_id, kv, ttl, filename in snapshots:
+                written += self._dump_snapshot(db_id, kv, ttl, filename, report)
+            self._finish_background_save(True)
+        except Exception as e:
+            console.print(f"Background save failed: {e}")
+            self._finish_background_save(False)
+
+    def _finish_background_save(self, ok):
+        state = self._save_state
+        state['status'] = 'idle'
+        state['last_status'] = 'ok' if ok else 'failed'
+        state['last_time'] = time.time()
+        state['last_duration'] = state['last_time'] - state['started']
+        state['last_keys'] = state['keys_written']
+        self._stats.record_dump(ok, state['last_duration'], state['keys_written'])
+        if ok:
+            console.print(f"Background save completed: {', '.join(state['files'])} "
+                          f"({state['keys_written']} keys in {state['last_duration']:.3f}s)")
+        else:
+            console.print(f"Background save failed: {', '.join(state['files'])}")
+
+    def rewrite_log(self):
+        """Start compacting the append log in the background"""
+        if self._append_log is None:
+            return Error("Append log is not enabled")
+        if self._append_log.rewriting:
+            return Error("Append log rewrite already in progress")
+        self._start_log_rewrite()
+        return "Append log rewrite started"
+
+    def _start_log_rewrite(self):
+        """
+        Claim the rewrite before spawning it, so the writes and commands
+        handled before the greenlet first runs see it in progress and
+        don't start another
+        """
+        self._append_log.start_rewrite()
+        gevent.spawn(self._rewrite_append_log)
+
+    def _rewrite_append_log(self):
+        """
+        Write the current state of every database to a new log, yielding
+        between batches of keys so clients keep being served. Writes made
+        meanwhile are kept by the log and appended once the snapshot is
+        done. Replaying them over keys the snapshot already saw is safe
+        because they are absolute (last write wins): list pushes and pops
+        are logged as the whole list while a rewrite runs, see _propagate.
+        """
+        log = self._append_log
+        temp_filename = f"{log.filename}.rewrite"
+        try:
+            with open(temp_filename, 'wb') as f:
+                for records in self._all_database_records():
+                    f.write(self._protocol.encode(*records))
+                    gevent.sleep(YIELD_INTERVAL)
+            log.finish_rewrite(temp_filename)
+            console.print(f"Append log rewritten: {log.filename} ({log.size} bytes)")
+        except Exception as e:
+            log.abort_rewrite(temp_filename)
+            console.print(f"Append log rewrite failed: {e}")
+
+    def _all_database_records(self):
+        """Yield batches of log records that rebuild every database"""
+        for db_id in list(self._databases):
+            yield ([['NEW_DB', str(db_id)]] if db_id != 0 else []) + [['SELECT', str(db_id)]]
+            yield from self._database_records(db_id)
+
+    def _database_records(self, db_id):
+        """Yield batches of log records that rebuild a database's keys"""
+        db = self._databases.get(db_id)
+        if db is None:
+            return
+        keys = list(db._kv)
+        for start in range(0, len(keys), REWRITE_BATCH_SIZE):
+            # The database may have been dropped or the keys changed while
+            # the caller yielded
+            if self._databases.get(db_id) is not db:
+                return
+            current_time = time.time()
+            items = ['BULK_SET']
+            containers = []
+            expiries = []
+            for key in keys[start:start + REWRITE_BATCH_SIZE]:
+                if key not in db._kv or db.is_expired(key, current_time):
+                    continue
+                value = db._kv[key]
+                if is_hash(value):
+                    record = ['HSET', key]
+                    for item in hash_items(value):
+                        record.extend(item)
+                    containers.append(record)
+                elif is_list(value):
+                    containers.append(['RPUSH', key, *value])
+                elif is_zset(value):
+                    record = ['ZADD', key]
+                    for member, score in value:
+                        record.extend([repr(score), member])
+                    containers.append(record)
+                elif value.__class__ is float:
+                    containers.append(['SET_FLOAT', key, format_float(value)])
+                else:
+                    items.extend([key, value])
+                if key in db._ttl:
+                    expiries.append(['EXPIREAT', key, repr(db._ttl[key])])
+            records = ([items] if len(items) > 1 else []) + containers
+            if records:
+                yield records + expiries
+
+    # Write hooks. The command table names one for every write command; it
+    # runs once the command has succeeded and hands the change on to the
+    # append log and the replication backlog through _propagate.
+    def _log_request(self, command, data, resp, db_id):
+        self._propagate(db_id, command, *data[1:])
+
+    def _log_set(self, command, data, resp, db_id):
+        key = data[1]
+        self._propagate(db_id, 'SET', key, data[2])
+        if len(data) > 3:
+            # Log the absolute expiry so replays don't restart the clock
+            if key in self._databases[db_id]._ttl:
+                self._propagate(db_id, 'EXPIREAT', key, repr(self._databases[db_id]._ttl[key]))
+            else:
+                self._propagate(db_id, 'DEL_TIME', key)
+
+    def _log_counter(self, command, data, resp, db_id):
+        # Log the result rather than the step, so replays are idempotent
+        self._propagate(db_id, 'SET', data[1], resp)
+
+    def _log_float_counter(self, command, data, resp, db_id):
+        # A SET would replay as a string; SET_FLOAT stores the float again
+        self._propagate(db_id, 'SET_FLOAT', data[1], resp)
+
+    def _log_pop(self, command, data, resp, db_id):
+        if resp is not None:
+            self._propagate(db_id, command, data[1])
+
+    def _log_blocking_pop(self, command, data, resp, db_id):
+        # Only a pop that happened is logged, as a plain pop of the key it came from
+        if resp.__class__ is list:
+            self._propagate(db_id, command[1:], resp[0])
+
+    def _log_hincrby(self, command, data, resp, db_id):
+        self._propagate(db_id, 'HSET', data[1], data[2], resp)
+
+    def _log_zincrby(self, command, data, resp, db_id):
+        self._propagate(db_id, 'ZADD', data[1], resp, data[3])
+
+    def _log_expire(self, command, data, resp, db_id):
+        key = data[1]
+        if key in self._databases[db_id]._ttl:
+            self._propagate(db_id, 'EXPIREAT', key, repr(self._databases[db_id]._ttl[key]))
+        elif resp:
+            self._propagate(db_id, 'DELETE', key)
+
+    def _log_flush(self, command, data, resp, db_id):
+        self._propagate(db_id, 'FLUSH')
+
+    def _log_new_db(self, command, data, resp, db_id):
+        # "Database <id> created": log the assigned ID, not the request
+        self._propagate(None, 'NEW_DB', resp.split()[1])
+
+    def _log_drop_db(self, command, data, resp, db_id):
+        self._propagate(None, 'DROP_DB', data[1])
+
+    def _log_load(self, command, data, resp, db_id):
+        # Log the loaded contents as if the keys had been set by hand
+        self._propagate(db_id, 'FLUSH')
+        for records in self._database_records(db_id):
+            for record in records:
+                self._propagate(db_id, *record)
+
+    def _propagate(self, db_id, *command):
+        """Pass a write command on to the append log and the replication backlog"""
+        if self._multi_pending:
+            self._multi_pending = False
+            self._multi_open = True
+            self._propagate(None, 'MULTI')
+        log = self._append_log
+        if log is not None:
+            if log.rewriting and command[0] in RELATIVE_RECORDS:
+                for record in self._list_records(db_id, command[1]):
+                    log.append(db_id, *record)
+            else:
+                log.append(db_id, *command)
+            if log.needs_rewrite():
+                self._start_log_rewrite()
+        if self._backlog is not None:
+            self._backlog.append(db_id, *command)
+
+    def _list_records(self, db_id, key):
+        """Records that set a list to what it holds now, whatever it held before"""
+        db = self._databases[db_id]
+        records = [['DELETE', key]]
+        items = db._kv.get(key)
+        if items:
+            records.append(['RPUSH', key, *items])
+            if key in db._ttl:
+                records.append(['EXPIREAT', key, repr(db._ttl[key])])
+        return records
+
+    def _begin_multi(self):
+        """Wrap the writes propagated until _end_multi() in MULTI ... EXEC, if there are any"""
+        self._multi_pending = True
+
+    def _end_multi(self):
+        self._multi_pending = False
+        if self._multi_open:
+            self._multi_open = False
+            self._propagate(None, 'EXEC')
+
+    def _replay_append_log(self, log):
+        """Rebuild the databases from the append log on startup"""
+        db_id = 0
+        count = 0
+        for record in log.replay(self._raw_values):
+            if self._raw_values:
+                record = self._text_arguments(record)
+            db_id = self._apply_record(record, db_id)
+            count += 1
+        if count:
+            console.print(f"Replayed {count} records from {log.filename}")
+
+    def _apply_record(self, record, db_id):
+        """
+        Apply one record of the append log or the replication stream to
+        the databases. Returns the database later records apply to.
+        """
+        command, args = record[0], record[1:]
+        db = self._databases.get(db_id)
+        if command == 'SELECT':
+            db_id = int(args[0])
+        elif command == 'NEW_DB':
+            if int(args[0]) not in self._databases:
+                self.new_db(args[0])
+        elif command == 'DROP_DB':
+            self.drop_db(args[0])
+        elif db is None:
+            pass
+        elif command == 'SET':
+            self.set(args[0], args[1], None, db_id)
+        elif command == 'SET_FLOAT':
+            db.put(args[0], float(args[1]))
+        elif command == 'EXPIREAT':
+            if args[0] in db._kv:
+                db.set_ttl(args[0], float(args[1]))
+                db.is_expired(args[0])
+        elif command == 'DEL_TIME':
+            self.del_time(args[0], db_id)
+        elif command == 'DELETE':
+            self.delete(args[0], db_id)
+        elif command == 'BULK_SET':
+            self.bulk_set(*args, db_id=db_id)
+        elif command == 'HSET':
+            self.hset(*args, db_id=db_id)
+        elif command == 'HDEL':
+            self.hdel(*args, db_id=db_id)
+        elif command in ('LPUSH', 'RPUSH'):
+            self._push(args[0], args[1:], command == 'LPUSH', db_id)
+        elif command in ('LPOP', 'RPOP'):
+            self._pop(args[0], command == 'LPOP', db_id)
+        elif command == 'ZADD':
+            self.zadd(*args, db_id=db_id)
+        elif command == 'ZREM':
+            self.zrem(*args, db_id=db_id)
+        elif command == 'FLUSH':
+            db.clear()
+        return db_id
+
+    # Transactions
+    def multi(self, session_state):
+        """Start queueing the session's commands for EXEC"""
+        if 'multi' in session_state:
+            return Error("MULTI calls can not be nested")
+        session_state['multi'] = []
+        return "OK"
+
+    def _queue_command(self, command, entry, data, session_state):
+        """Hold a command for EXEC. One that could never run fails the whole transaction now."""
+        if entry is None:
+            error = f"Unrecognized command: {command}"
+        elif 'nomulti' in entry.flags:
+            error = f"{command} is not allowed in a transaction"
+        elif not entry.fewest <= len(data) - 1 - self._password_arguments(entry, len(data) - 1) <= entry.most:
+            error = f"Invalid arguments for {command}"
+        else:
+            session_state['multi'].append(data)
+            return "QUEUED"
+        session_state['multi_failed'] = True
+        return Error(error)
+
+    def exec(self, session_state):
+        """
+        Run the queued commands back to back and return their replies. No
+        other client runs in between, since nothing here yields. Returns
+        None without running anything if a watched key has changed.
+        """
+        if 'multi' not in session_state:
+            return Error("EXEC without MULTI")
+        queue = session_state.pop('multi')
+        failed = session_state.pop('multi_failed', False)
+        changed = self._watched_changed(session_state)
+        self._unwatch(session_state)
+        if failed:
+            return Error("Transaction discarded because of earlier errors")
+        if changed:
+            return None
+
+        replies = []
+        self._begin_multi()
+        try:
+            for request in queue:
+                try:
+                    resp = self.get_response(request, session_state)
+                except CommandError as exc:
+                    resp = Error(exc.args[0])
+                if resp.__class__ is Blocked:
+                    # A transaction can't wait, so BLPOP/BRPOP act like a pop that found nothing
+                    resp = None
+                replies.append(resp)
+        finally:
+            self._end_multi()
+        return replies
+
+    def discard(self, session_state):
+        if 'multi' not in session_state:
+            return Error("DISCARD without MULTI")
+        del session_state['multi']
+        session_state.pop('multi_failed', None)
+        self._unwatch(session_state)
+        return "OK"
+
+    def watch(self, *keys, session_state):
+        """Make the session's next EXEC fail if any of keys changes first"""
+        if 'multi' in session_state:
+            return Error("WATCH inside MULTI is not allowed")
+        db_id = session_state.get('current_db', 0)
+        db = self._databases.get(db_id)
+        if db is None:
+            return Error(f"Database {db_id} does not exist")
+        watching = session_state.setdefault('watching', [])
+        for key in keys:
+            watching.append((db_id, db, key, db.watch(key)))
+        return "OK"
+
+    def unwatch(self, session_state):
+        self._unwatch(session_state)
+        return "OK"
+
+    def _unwatch(self, session_state):
+        for _, db, key, _ in session_state.pop('watching', ()):
+            db.unwatch(key)
+
+    def _watched_changed(self, session_state):
+        for db_id, db, key, version in session_state.get('watching', ()):
+            # A dropped or reloaded database counts as a change, and so does
+            # a key that expired while watched
+            if self._databases.get(db_id) is not db:
+                return True
+            self._is_expired(db, key)
+            if db.version(key) != version:
+                return True
+        return False
+
+    # Publish/subscribe. A connection that subscribes switches to push mode:
+    # its replies and the messages published to it are queued on a
+    # Subscriber and sent by a writer greenlet of its own; see pubsub.
+    def subscribe(self, *channels, session_state):
+        return self._subscribe('subscribe', channels, session_state)
+
+    def psubscribe(self, *patterns, session_state):
+        return self._subscribe('psubscribe', patterns, session_state)
+
+    def unsubscribe(self, *channels, session_state):
+        """UNSUBSCRIBE [channel ...] leaves the channels, or every channel with none given"""
+        return self._unsubscribe('unsubscribe', channels, session_state)
+
+    def punsubscribe(self, *patterns, session_state):
+        return self._unsubscribe('punsubscribe', patterns, session_state)
+
+    def _subscribe(self, kind, names, session_state):
+        subscriber = session_state.get('subscriber')
+        if subscriber is None:
+            subscriber = Subscriber(session_state.get('address'), self._pubsub_output_limit)
+            session_state['subscriber'] = subscriber
+        add = self._pubsub.subscribe if kind == 'subscribe' else self._pubsub.psubscribe
+        replies = []
+        for name in names:
+            add(subscriber, name)
+            replies.append([kind, name, subscriber.subscriptions])
+        return Push(replies)
+
+    def _unsubscribe(self, kind, names, session_state):
+        subscriber = session_state.get('subscriber')
+        if subscriber is None:
+            return Push([[kind, name, 0] for name in names] or [[kind, None, 0]])
+        if kind == 'unsubscribe':
+            current, remove = subscriber.channels, self._pubsub.unsubscribe
+        else:
+            current, remove = subscriber.patterns, self._pubsub.punsubscribe
+        replies = []
+        for name in names or sorted(current):
+            remove(subscriber, name)
+            replies.append([kind, name, subscriber.subscriptions])
+        return Push(replies or [[kind, None, subscriber.subscriptions]])
+
+    def publish(self, channel, message):
+        """Queue a message for every subscriber of the channel and return how many there were"""
+        receivers, dropped = self._pubsub.publish(channel, message)
+        for subscriber in dropped:
+            self._drop_subscriber(subscriber)
+        return receivers
+
+    def _push_responses(self, conn, subscriber, payload):
+        """Queue replies behind the messages already waiting for a subscriber"""
+        if subscriber.writer is None:
+            subscriber.conn = conn
+            subscriber.writer = gevent.spawn(self._write_subscriber, conn, subscriber)
+        if not subscriber.push(payload):
+            self._drop_subscriber(subscriber)
+
+    def _write_subscriber(self, conn, subscriber):
+        """Send whatever is queued for a subscriber until it is closed"""
+        stats = self._stats
+        try:
+            while True:
+                data = subscriber.take()
+                if data is None:
+                    return
+                conn.sendall(data)
+                subscriber.sent(len(data))
+                stats.bytes_sent += len(data)
+        except OSError:
+            # The client is gone; its connection greenlet cleans up
+            subscriber.close()
+
+    def _drop_subscriber(self, subscriber):
+        """Disconnect a subscriber that fell too far behind"""
+        self._pubsub.remove(subscriber)
+        address = subscriber.address
+        name = f"{address[0]}:{address[1]}" if isinstance(address, tuple) else str(address)
+        console.print(f"Subscriber {name} dropped: over {subscriber.limit} bytes of output waiting")
+        if subscriber.conn is not None:
+            try:
+                # Ends both its pending reads and a send stuck on a full socket
+                subscriber.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _leave_push_mode(self, session_state):
+        subscriber = session_state.pop('subscriber', None)
+        if subscriber is not None:
+            self._pubsub.remove(subscriber)
+            subscriber.close()
+
+    # Client side caching. A connection in tracking mode has the keys it
+    # reads remembered by their database; the first change to one of them
+    # is published on INVALIDATE_CHANNEL to the connection it redirects to,
+    # which has to be subscribed there. Keys are forgotten once invalidated,
+    # and the ids of connections that have gone are dropped as keys change.
+    def client(self, subcommand, *args, session_state):
+        """CLIENT ID | CLIENT TRACKING ON REDIRECT id | CLIENT TRACKING OFF"""
+        subcommand = subcommand.upper()
+        if subcommand == 'ID' and not args:
+            return session_state['id']
+        if subcommand == 'TRACKING' and args:
+            mode = args[0].upper()
+            if mode == 'OFF' and len(args) == 1:
+                session_state.pop('tracking', None)
+                return "OK"
+            if mode == 'ON' and len(args) == 3 and args[1].upper() == 'REDIRECT':
+                target = parse_int(args[2])
+                if target not in self._sessions:
+                    return Error(f"No client with id {args[2]}")
+                if target == session_state['id']:
+                    return Error("Invalidations must go to another connection, subscribed to " + INVALIDATE_CHANNEL)
+                session_state['tracking'] = target
+                return "OK"
+        return Error(f"Invalid arguments for CLIENT {subcommand}")
+
+    def _track_keys(self, entry, data, session_state):
+        db = self._databases.get(session_state.get('current_db', 0))
+        if db is not None:
+            client_id = session_state['id']
+            for key in command_keys(entry.spec, data):
+                db.track(key, client_id)
+
+    def _invalidate(self, key, readers):
+        """Publish a changed key, or None for all of a database's, to where its readers redirect"""
+        sessions = self._sessions
+        targets = set()
+        for client_id in readers:
+            session = sessions.get(client_id)
+            if session is not None and 'tracking' in session:
+                targets.add(session['tracking'])
+        payload = None
+        for target in targets:
+            session = sessions.get(target)
+            subscriber = session.get('subscriber') if session is not None else None
+            if subscriber is None or INVALIDATE_CHANNEL not in subscriber.channels:
+                continue
+            if payload is None:
+                payload = self._protocol.encode(['message', INVALIDATE_CHANNEL, None if key is None else [key]])
+            self._stats.invalidations += 1
+            if not subscriber.push(payload):
+                self._drop_subscriber(subscriber)
+
+    # Replication
+    def replicaof(self, host, port):
+        """REPLICAOF host port follows a master as a read-only replica; REPLICAOF NO ONE stops"""
+        if host.upper() == 'NO' and port.upper() == 'ONE':
+            if self._master is not None:
+                self._repl_greenlet.kill()
+                self._master = None
+                console.print("Replication stopped, accepting writes")
+            return "OK"
+        port_number = parse_int(port)
+        if port_number is None or not 0 < port_number < 65536:
+            return Error("Port must be an integer between 1 and 65535")
+        if self._repl_greenlet is not None:
+            self._repl_greenlet.kill()
+        self._master = (host, port_number)
+        self._master_error = None
+        self._repl_greenlet = gevent.spawn(self._replicate, host, port_number)
+        return "OK"
+
+    def psync(self, replid, offset):
+        """Sent by a replica with the stream position it has reached, '?' and -1 for none"""
+        offset = parse_int(offset)
+        if offset is None:
+            return Error("Offset must be an integer")
+        return ReplicaSync(replid, offset)
+
+    def _replication_info(self):
+        backlog = self._backlog
+        info = {
+            'role': 'replica' if self._master is not None else 'master',
+            'connected_replicas': len(self._replicas),
+            'replid': backlog.replid if backlog is not None else '',
+            'repl_offset': backlog.offset if backlog is not None else 0,
+            'backlog_bytes': backlog.offset - backlog.start if backlog is not None else 0,
+        }
+        if self._master is not None:
+            info.update({
+                'master_host': self._master[0],
+                'master_port': self._master[1],
+                'master_link_status': self._master_link,
+                'master_replid': self._master_replid or '',
+                'master_repl_offset': self._master_offset,
+            })
+        # Bytes sent to each replica and bytes still to send
+        info['replicas'] = {name: {'offset': offset, 'lag': backlog.offset - offset}
+                            for name, offset in self._replicas.items()}
+        return info
+
+    def _feed_replica(self, conn, sync, address):
+        """
+        Stream writes to a replica until its connection drops. A replica
+        whose offset is still in the backlog carries on from there; any
+        other first gets every database as of the offset it starts from.
+        """
+        if self._backlog is None:
+            self._backlog = ReplicationBacklog(self._repl_backlog_size)
+        backlog = self._backlog
+        name = f"{address[0]}:{address[1]}" if isinstance(address, tuple) else str(address)
+        try:
+            if backlog.covers(sync.replid, sync.offset):
+                offset = sync.offset
+                conn.sendall(self._protocol.encode(['CONTINUE', backlog.replid, offset]))
+            else:
+                offset = backlog.offset
+                backlog.reselect()
+                self._send_snapshot(conn, self._protocol.encode(['FULLRESYNC', backlog.replid, offset]))
+            console.print(f"Replica {name} attached at offset {offset}")
+            self._replicas[name] = offset
+            while backlog is self._backlog and offset >= backlog.start:
+                if backlog.offset > offset:
+                    data = backlog.read(offset)
+                    conn.sendall(data)
+                    offset += len(data)
+                    self._replicas[name] = offset
+                elif not backlog.wait(offset, REPL_PING_INTERVAL):
+                    # Keeps an idle replica from timing out and finds dead ones
+                    backlog.append(None, 'PING')
+            # It fell behind the backlog, or this server started a new
+            # history; either way the replica has to sync from scratch
+            console.print(f"Replica {name} dropped: it has to sync again")
+        except OSError as e:
+            console.print(f"Replica {name} disconnected: {e}")
+        finally:
+            self._replicas.pop(name, None)
+
+    def _send_snapshot(self, conn, header):
+        """
+        Send header, then log records that rebuild every database as they
+        are at this moment, ending with SYNCED. Where fork() exists a child
+        process encodes them from a copy-on-write image while this process
+        keeps serving. Elsewhere they are encoded before anything is sent,
+        which blocks clients for as long as that takes.
+        """
+        if not FORK_SAVES:
+            chunks = list(self._snapshot_chunks())
+            conn.sendall(header)
+            for chunk in chunks:
+                conn.sendall(chunk)
+            return
+
+        pid, read_fd = fork_child(self._snapshot_in_child)
+        try:
+            conn.sendall(header)
+            while True:
+                data = nb_read(read_fd, RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                conn.sendall(data)
+        finally:
+            # Closing the pipe first stops a child that is still writing
+            os.close(read_fd)
+            exit_status = wait_child(pid)
+        if exit_status != 0:
+            raise OSError("Snapshot for the replica failed")
+
+    def _snapshot_in_child(self, write_fd):
+        """Body of the forked snapshot process, writing the records down write_fd"""
+        with os.fdopen(write_fd, 'wb') as f:
+            for chunk in self._snapshot_chunks():
+                f.write(chunk)
+
+    def _snapshot_chunks(self):
+        for records in self._all_database_records():
+            yield self._protocol.encode(*records)
+        yield self._protocol.encode(['SYNCED'])
+
+    def _replicate(self, host, port):
+        """Follow the master for as long as this server is a replica, reconnecting whenever the link drops"""
+        while True:
+            try:
+                self._sync_from_master(host, port)
+            except (OSError, CommandError) as e:
+                # Report each new problem once rather than on every retry
+                if str(e) != self._master_error:
+                    console.print(f"Replication from {host}:{port} failed: {e}")
+                self._master_error = str(e)
+            gevent.sleep(REPL_RETRY_INTERVAL)
+
+    def _sync_from_master(self, host, port):
+        """
+        One replication session: ask for the stream from where this replica
+        left off, load a full sync if the master can't continue from there,
+        then apply writes as they arrive until the connection drops
+        """
+        sock = gevent.socket.create_connection((host, port), timeout=REPL_TIMEOUT)
+        try:
+            setup = []
+            if self._master_password is not None:
+                setup.append(['AUTH', self._master_password])
+            setup.append(['PSYNC', self._master_replid or '?', str(self._master_offset)])
+            sock.sendall(self._protocol.encode(*setup))
+            stream = self._master_stream(sock)
+            for request in setup:
+                reply, consumed = next(stream)
+                if isinstance(reply, Error):
+                    raise CommandError(f"Master refused {request[0]}: {reply.message}")
+
+            if reply[0] == 'FULLRESYNC':
+                consumed = self._load_full_sync(stream)
+            self._master_replid, self._master_offset = reply[1], reply[2]
+            self._master_link = 'up'
+            self._master_error = None
+            console.print(f"Replicating {host}:{port} from offset {self._master_offset}"
+                          f" ({'full sync' if reply[0] == 'FULLRESYNC' else 'continued'})")
+
+            base = self._master_offset - consumed
+            queued = None
+            for record, consumed in stream:
+                command = record[0]
+                if command == 'MULTI':
+                    queued = []
+                elif queued is not None and command != 'EXEC':
+                    queued.append(record)
+                else:
+                    # A transaction is applied whole, so readers never see
+                    # part of it, and the offset only moves past its end
+                    self._apply_from_master(queued if queued is not None else (record,))
+                    queued = None
+                    self._master_offset = base + consumed
+        finally:
+            self._master_link = 'down'
+            sock.close()
+
+    def _apply_from_master(self, records):
+        """Apply records from the master, passing them on to this server's own log and replicas"""
+        propagate = self._append_log is not None or self._backlog is not None
+        if len(records) > 1:
+            self._begin_multi()
+        for record in records:
+            command, db_id = record[0], self._master_db
+            self._master_db = self._apply_record(record, db_id)
+            if propagate and command != 'SELECT' and command != 'PING':
+                self._propagate(None if command in ('NEW_DB', 'DROP_DB') else db_id, *record)
+        self._end_multi()
+
+    def _load_full_sync(self, stream):
+        """
+        Build new databases from the records of a full sync and swap them in
+        once the master says it is complete. Returns the bytes of the stream
+        consumed through the end marker.
+        """
+        loading = {0: self._create_database(0)}
+        db_id = 0
+        for record, consumed in stream:
+            if record[0] == 'SYNCED':
+                break
+            # The live databases are set aside only while a record applies,
+            # which never yields, so clients keep reading the old data
+            live, self._databases = self._databases, loading
+            try:
+                db_id = self._apply_record(record, db_id)
+            finally:
+                self._databases = live
+        for db in self._databases.values():
+            db.untrack_all()
+        self._databases = loading
+        self._master_db = 0
+        if self._backlog is not None:
+            # Replicas of this server have to start over from the new data
+            self._backlog = ReplicationBacklog(self._repl_backlog_size)
+        if self._append_log is not None and not self._append_log.rewriting:
+            self._start_log_rewrite()
+        return consumed
+
+    def _master_stream(self, sock):
+        """Yield each message from the master with the bytes of the stream consumed through it"""
+        parser = ProtocolParser(self._raw_values)
+        fed = 0
+        while True:
+            message = parser.gets()
+            if message is not INCOMPLETE:
+                if self._raw_values and message.__class__ is list:
+                    message = self._text_arguments(message)
+                yield message, fed - parser.buffered()
+                continue
+            data = sock.recv(RECV_BUFFER_SIZE)
+            if not data:
+                raise ConnectionError("Master closed the connection")
+            fed += len(data)
+            parser.feed(data)
+
     def bulk_get(self, *keys, db_id=0):
         if db_id not in self._databases:
             return Error(f"Database {db_id} does not exist")
@@ -502,10 +2710,9 @@ class Server(object):
         db = self._databases[db_id]
         result = []
         for key in keys:
-            if self._is_expired(db, key):
-                result.append(None)
-            else:
-                result.append(db._kv.get(key))
+            value = None if self._is_expired(db, key) else db.get(key)
+            # Like MGET, keys of another type read as missing
+            result.append(format_value(value) if is_string(value) else None)
         return result
 
     def bulk_set(self, *items, db_id=0):
@@ -515,8 +2722,42 @@ class Server(object):
         db = self._databases[db_id]
         data = list(zip(items[::2], items[1::2]))
         for key, value in data:
-            db._kv[key] = value
+            db.put(key, value)
         return len(data)
+
+    def scan(self, cursor, *options, db_id=0):
+        """SCAN cursor [MATCH pattern] [COUNT count]"""
+        if db_id not in self._databases:
+            return Error(f"Database {db_id} does not exist")
+        
+        try:
+            cursor = int(cursor)
+            if cursor < 0:
+                raise ValueError
+        except ValueError:
+            return Error("Invalid cursor")
+        
+        match = None
+        count = SCAN_DEFAULT_COUNT
+        if len(options) % 2:
+            return Error("Invalid arguments for SCAN")
+        for option, value in zip(options[::2], options[1::2]):
+            option = option.upper()
+            if option == 'MATCH':
+                match = re.compile(fnmatch.translate(value)).match
+            elif option == 'COUNT':
+                try:
+                    count = int(value)
+                except ValueError:
+                    return Error("COUNT must be an integer")
+                if count < 1:
+                    return Error("COUNT must be positive")
+                count = min(count, SCAN_MAX_COUNT)
+            else:
+                return Error(f"Unknown SCAN option {option}")
+        
+        next_cursor, keys = self._databases[db_id].scan(cursor, count, match)
+        return [next_cursor, keys]
     
     def get_response(self, data, session_state):
         if not isinstance(data, list):
@@ -527,107 +2768,225 @@ class Server(object):
 
         if not data:
             raise CommandError('Missing command')
+        if self._raw_values:
+            data = self._text_arguments(data)
 
         command = data[0].upper()
-        
-        # Check authentication for protected commands (only if password is set)
-        protected_commands = ['FLUSH', 'DUMP', 'LOAD']
-        if self._password is not None and command in protected_commands and not session_state.get('authenticated', False):
-            return Error("Authentication required")
-        
-        # Authentication doesn't require being authenticated
-        if command == 'AUTH':
-            if len(data) < 2:
-                return Error("Missing password")
-            result = self.auth(data[1])
-            if result == "OK":
-                session_state['authenticated'] = True
-            return result
-        
-        # Set password command
-        if command == 'SET_PASSWORD':
-            if len(data) < 2:
-                return Error("Missing password")
-            return self.set_password(data[1])
-        
-        # Database selection
-        if command == 'SELECT':
-            if len(data) < 2:
-                return Error("Missing database ID")
-            result = self.select_db(data[1])
-            if result == "OK":
-                session_state['current_db'] = int(data[1])
-            return result
-        
-        if command not in self._commands:
+        entry = self._commands.get(command)
+        flags = entry.flags if entry is not None else ()
+        if 'multi' in session_state and 'transaction' not in flags:
+            return self._queue_command(command, entry, data, session_state)
+        if 'subscriber' in session_state and 'pubsub' not in flags:
+            if session_state['subscriber'].subscriptions:
+                return Error(f"{command} is not allowed while subscribed: only (P)SUBSCRIBE and (P)UNSUBSCRIBE are")
+            if command == 'PSYNC':
+                # The replication stream would bypass the subscriber's queue
+                return Error("PSYNC is not allowed on a connection that has subscribed")
+        if entry is None:
+            self._stats.unknown_commands += 1
             raise CommandError('Unrecognized command: %s' % command)
+        if self._master is not None and 'write' in flags:
+            return Error("Read-only replica: send writes to the master")
+        if (self._maxmemory is not None and 'denyoom' in flags
+                and not self._free_memory()):
+            return Error("Out of memory: used memory is over maxmemory and nothing can be evicted")
+        started = perf_counter()
+        try:
+            resp = self._dispatch(entry, data, session_state)
+        except CommandError:
+            self._stats.record(command, perf_counter() - started, True)
+            raise
+        elapsed = perf_counter() - started
+        self._stats.record(command, elapsed, resp.__class__ is Error)
+        if elapsed >= self._slowlog.threshold:
+            self._slowlog.add(elapsed, self._slowlog_arguments(entry, data), session_state.get('address'),
+                              session_state.get('current_db', 0))
+        if 'tracking' in session_state and 'readonly' in flags and resp.__class__ is not Error:
+            self._track_keys(entry, data, session_state)
+
+        if (entry.log is not None and (self._append_log is not None or self._backlog is not None)
+                and not isinstance(resp, Error)):
+            entry.log(command, data, resp, session_state.get('current_db', 0))
+        return resp
+
+    def _text_arguments(self, data):
+        """
+        Requests reach a raw_values server as bytes. Decode the command and
+        its keys and options, so only the values it stores stay as bytes.
+        """
+        try:
+            command = data[0].decode('utf-8') if data[0].__class__ is bytes else data[0]
+            spec = COMMAND_TABLE.get(command.upper())
+            raw = spec.values if spec is not None else None
+            if raw is None:
+                return [arg.decode('utf-8') if arg.__class__ is bytes else arg for arg in data]
+            # Blank the values out, decode the rest in one pass, put them back
+            values = data[raw]
+            args = list(data)
+            args[raw] = [None] * len(values)
+            args = [arg.decode('utf-8') if arg.__class__ is bytes else arg for arg in args]
+            args[raw] = values
+            return args
+        except UnicodeDecodeError:
+            raise CommandError("Commands, keys and options must be UTF-8 text")
+
+    def _slowlog_arguments(self, entry, data):
+        """A request as the slow log keeps it, with any password hidden"""
+        if len(data) > 1 and ('secret' in entry.flags or self._password_arguments(entry, len(data) - 1)):
+            return [data[0], SLOWLOG_HIDDEN] + data[2:]
+        return data
 
-        # Get current database for this session
-        current_db = session_state.get('current_db', 0)
-        
-        # Route commands to appropriate database
-        if command in ['GET', 'SET', 'DELETE', 'EXISTS', 'DEL_TIME', 'BULK_GET', 'BULK_SET']:
-            if command == 'SET':
-                if len(data) < 3:  # SET key value [ttl]
-                    return Error("SET requires at least key and value")
-                key, value = data[1], data[2]
-                ttl = data[3] if len(data) > 3 else None
-                return self.set(key, value, ttl, current_db)
-            elif command in ['GET', 'DELETE', 'EXISTS', 'DEL_TIME'] and len(data) >= 2:
-                return self._commands[command](data[1], current_db)
-            elif command == 'BULK_GET' and len(data) >= 2:
-                return self.bulk_get(*data[1:], db_id=current_db)
-            elif command == 'BULK_SET' and len(data) >= 3:
-                return self.bulk_set(*data[1:], db_id=current_db)
+    def _password_arguments(self, entry, count):
+        """How many of a command's count arguments are the server password, which comes first"""
+        if 'password' not in entry.flags:
+            return 0
+        if self._password is not None:
+            return 1
+        # A password the server doesn't ask for is dropped when the command allows it
+        return 1 if 'droppassword' in entry.flags and count > entry.most else 0
+
+    def _dispatch(self, entry, data, session_state):
+        """Check a request against its command table entry and run it"""
+        flags = entry.flags
+        count = len(data) - 1
+        if self._password is not None:
+            if 'protected' in flags and not session_state.get('authenticated', False):
+                return Error("Authentication required")
+            if 'password' in flags:
+                # Commands that destroy or expose data also take the
+                # password, but only once the server has one
+                if not count:
+                    return Error(f"Password required for {entry.spec.name}")
+                count -= 1
+        elif 'password' in flags:
+            if self._password_arguments(entry, count):
+                data = [data[0], None] + data[2:]
+                count -= 1
             else:
-                return Error(f"Invalid arguments for {command}")
-        elif command in ['FLUSH', 'DUMP', 'LOAD']:
-            if command == 'FLUSH':
-                password = data[1] if len(data) > 1 and self._password is not None else None
-                return self.flush(password, current_db)
-            elif command == 'DUMP':
-                if self._password is not None:
-                    if len(data) < 2:
-                        return Error("Password required for DUMP")
-                    password = data[1]
-                    filename = data[2] if len(data) > 2 else None
-                else:
-                    password = None
-                    filename = data[1] if len(data) > 1 else None
-                return self.dump(password, filename, current_db)
-            elif command == 'LOAD':
-                if self._password is not None:
-                    if len(data) < 3:
-                        return Error("Password and filename required for LOAD")
-                    password, filename = data[1], data[2]
-                else:
-                    if len(data) < 2:
-                        return Error("Filename required for LOAD")
-                    password = None
-                    filename = data[1]
-                return self.load(password, filename, current_db)
-        else:
-            return self._commands[command](*data[1:])
+                data = [data[0], None] + data[1:]
+        if not entry.fewest <= count <= entry.most:
+            if entry.most == 0:
+                return Error(f"{entry.spec.name} takes no arguments")
+            return Error(f"Invalid arguments for {entry.spec.name}")
+
+        handler = entry.handler
+        if 'db' in flags:
+            db_id = session_state.get('current_db', 0)
+            # Spreading *args next to a keyword costs several times a plain
+            # call, so the common one and two argument shapes are spelled out
+            if len(data) == 2:
+                return handler(data[1], db_id=db_id)
+            if len(data) == 3:
+                return handler(data[1], data[2], db_id=db_id)
+            return handler(*data[1:], db_id=db_id)
+        if 'session' in flags:
+            return handler(*data[1:], session_state=session_state)
+        return handler(*data[1:])
     
     def connection_handler(self, conn, address):
-        socket_file = conn.makefile('rwb')
-        session_state = {'authenticated': False, 'current_db': 0}
-
+        stats = self._stats
+        stats.connections_received += 1
+        stats.connected_clients += 1
+        client_id = self._next_client_id
+        self._next_client_id += 1
+        session_state = {'authenticated': False, 'current_db': 0, 'address': address, 'id': client_id}
+        self._sessions[client_id] = session_state
         try:
-            while True: 
+            self._serve_connection(conn, address, session_state)
+        except OSError:
+            # Reset by the client, or shut down under a pending read when a
+            # subscriber is dropped
+            pass
+        finally:
+            stats.connected_clients -= 1
+            del self._sessions[client_id]
+            self._unwatch(session_state)
+            self._leave_push_mode(session_state)
+
+    def _unix_connection_handler(self, conn, address):
+        # Unix clients have no address of their own; name them by the socket
+        self.connection_handler(conn, self._unix_socket)
+
+    def start(self):
+        """Start accepting connections without blocking"""
+        self._server.start()
+        if self._unix_server is not None:
+            self._unix_server.start()
+
+    def close(self):
+        """Stop listening, and remove the Unix socket file"""
+        self._server.stop()
+        if self._unix_server is not None:
+            self._unix_server.stop()
+            remove_unix_socket(self._unix_socket)
+
+    def _serve_connection(self, conn, address, session_state):
+        parser = ProtocolParser(self._raw_values)
+        stats = self._stats
+
+        while True: 
+            data = conn.recv(RECV_BUFFER_SIZE)
+            if not data:
+                break 
+            stats.bytes_received += len(data)
+            parser.feed(data)
+
+            # Run every complete request that arrived and send all of their
+            # replies with one write
+            responses = []
+            while True:
                 try: 
-                    data = self._protocol.handle_request(socket_file)
-                except Disconnect:
-                    break 
+                    request = parser.gets()
+                except CommandError as exc:
+                    # The stream can't be resynchronised after a framing error
+                    responses.append(Error(exc.args[0]))
+                    self._send_responses(conn, responses, session_state)
+                    return
+                if request is INCOMPLETE:
+                    break
 
                 try: 
-                    resp = self.get_response(data, session_state)
+                    resp = self.get_response(request, session_state)
+                    if resp.__class__ is Blocked:
+                        # Replies already run go out first, then this
+                        # greenlet parks until a push or the timeout
+                        if responses:
+                            self._send_responses(conn, responses, session_state)
+                            responses = []
+                        resp = self._wait_blocked(request, resp, session_state, conn)
+                    elif resp.__class__ is ReplicaSync:
+                        # From here on the connection carries the write stream
+                        if responses:
+                            self._send_responses(conn, responses)
+                        self._feed_replica(conn, resp, address)
+                        return
                 except CommandError as exc:
                     resp = Error(exc.args[0])
+                if resp.__class__ is Push:
+                    responses.extend(resp.replies)
+                else:
+                    responses.append(resp)
 
-                self._protocol.write_response(socket_file, resp)
-        finally:
-            socket_file.close()
+                # In push mode every reply is queued as soon as it is ready,
+                # so it keeps its place among the messages published here
+                if len(responses) >= MAX_PIPELINE_BATCH or 'subscriber' in session_state:
+                    self._send_responses(conn, responses, session_state)
+                    responses = []
+
+            if responses:
+                self._send_responses(conn, responses, session_state)
+
+    def _send_responses(self, conn, responses, session_state=None):
+        # Writes must reach the append log before clients see them succeed
+        if self._append_log is not None:
+            self._append_log.flush()
+        payload = self._protocol.encode(*responses)
+        subscriber = session_state.get('subscriber') if session_state else None
+        if subscriber is not None:
+            self._push_responses(conn, subscriber, payload)
+            return
+        self._stats.bytes_sent += len(payload)
+        conn.sendall(payload)
 
     def run(self):
         import datetime
@@ -638,16 +2997,25 @@ class Server(object):
         table = Table(title="[bold red]RedDB[/bold red] is running..")
         table.add_row("Start Time:", f"[bold blue]{current_time}[/bold blue]")
         table.add_row("Port:", f"[bold yellow]127.0.0.1:[/bold yellow][bold green]{DEFAULT_PORT}[/bold green]")
+        if self._unix_socket is not None:
+            table.add_row("Unix socket:", f"[bold green]{self._unix_socket}[/bold green]")
         table.add_row(
             "Password protection:",
             "[bold green]Enabled[/bold green]" if self._password else "[bold red]Disabled[/bold red]"
         )
         table.add_row("Databases:", f"[bold cyan]{len(self._databases)}[/bold cyan]")
+        if self._master is not None:
+            table.add_row("Replica of:", f"[bold magenta]{self._master[0]}:{self._master[1]}[/bold magenta]")
         
         console.print(table)
         #print(f"Features: TTL, EXISTS, DUMP, LOAD, TIME_DUMP, PASSWORD, MULTI-DB")
         for i in range(10):console.print("")
-        self._server.serve_forever()
+        self.start()
+        try:
+            self._server.serve_forever()
+        finally:
+            if self._unix_server is not None:
+                remove_unix_socket(self._unix_socket)
 
 if __name__ == '__main__':
     from gevent import monkey
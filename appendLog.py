@@ -0,0 +1,174 @@
+import os
+
+import gevent
+
+from protocolHandler import *
+
+FSYNC_POLICIES = ('always', 'everysec', 'no')
+REWRITE_MIN_SIZE = 64 * 1024 * 1024  # Log size before automatic rewrites start
+REWRITE_GROWTH = 2  # Rewrite once the log is this many times its post-rewrite size
+READ_CHUNK_SIZE = 65536
+
+
+class AppendLog(object):
+    """
+    Append-only log of write commands, stored in the same wire format the
+    clients speak. Records are buffered in memory while a batch of requests
+    runs and written out by flush() before the replies are sent. The fsync
+    policy decides when the data is forced to disk:
+
+        always    fsync on every flush, before clients see their replies
+        everysec  fsync once a second from a worker thread
+        no        leave it to the operating system
+    """
+    def __init__(self, filename, fsync='everysec'):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync policy must be one of {', '.join(FSYNC_POLICIES)}")
+        self.filename = filename
+        self.fsync = fsync
+        self.size = 0
+        self.rewrite_base_size = 0
+        self._protocol = ProtocolHandler()
+        self._file = None
+        self._buffer = []
+        self._db = None  # Database the file is positioned on by its last SELECT
+        self._dirty = False
+        # Records logged while a rewrite runs, replayed on top of its snapshot
+        self._rewrite_buffer = None
+        self._rewrite_db = None
+        self._fsync_greenlet = None
+
+    @property
+    def rewriting(self):
+        return self._rewrite_buffer is not None
+
+    def replay(self, raw=False):
+        """
+        Yield every complete record in the log, in order. A record cut
+        short by a crash is dropped and the file truncated after the last
+        complete one, so new records are not appended onto garbage. The
+        records of a transaction, between MULTI and EXEC, are only yielded
+        once its EXEC is read, so one cut short is dropped whole. With
+        raw=True every argument is yielded as bytes.
+        """
+        if not os.path.exists(self.filename):
+            return
+        parser = ProtocolParser(raw)
+        fed = valid_size = 0
+        transaction = None
+        with open(self.filename, 'rb') as f:
+            while True:
+                chunk = f.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                parser.feed(chunk)
+                fed += len(chunk)
+                while True:
+                    record = parser.gets()
+                    if record is INCOMPLETE:
+                        break
+                    if record[0] in ('MULTI', b'MULTI'):
+                        transaction = []
+                        continue
+                    if transaction is not None and record[0] not in ('EXEC', b'EXEC'):
+                        transaction.append(record)
+                        continue
+                    valid_size = fed - parser.buffered()
+                    if transaction is not None:
+                        yield from transaction
+                        transaction = None
+                    else:
+                        yield record
+
+        if fed != valid_size:
+            with open(self.filename, 'r+b') as f:
+                f.truncate(valid_size)
+
+    def open(self):
+        self._file = open(self.filename, 'ab')
+        self.size = self.rewrite_base_size = self._file.tell()
+        self._db = None
+        if self.fsync == 'everysec':
+            self._fsync_greenlet = gevent.spawn(self._fsync_worker)
+
+    def close(self):
+        if self._fsync_greenlet is not None:
+            self._fsync_greenlet.kill()
+            self._fsync_greenlet = None
+        self.flush()
+        self._file.close()
+
+    def append(self, db_id, *command):
+        """Buffer a write command; db_id None marks a server-wide command"""
+        record = self._protocol.encode(list(command))
+        if db_id is not None and db_id != self._db:
+            self._buffer.append(self._protocol.encode(['SELECT', str(db_id)]))
+            self._db = db_id
+        self._buffer.append(record)
+
+        if self._rewrite_buffer is not None:
+            if db_id is not None and db_id != self._rewrite_db:
+                self._rewrite_buffer.append(self._protocol.encode(['SELECT', str(db_id)]))
+                self._rewrite_db = db_id
+            self._rewrite_buffer.append(record)
+
+    def flush(self):
+        """Write buffered records to the file, and fsync under 'always'"""
+        if not self._buffer:
+            return
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._file.write(data)
+        self._file.flush()
+        self.size += len(data)
+        if self.fsync == 'always':
+            os.fsync(self._file.fileno())
+        else:
+            self._dirty = True
+
+    def needs_rewrite(self):
+        return (not self.rewriting and self.size >= REWRITE_MIN_SIZE and
+                self.size >= REWRITE_GROWTH * self.rewrite_base_size)
+
+    def start_rewrite(self):
+        self._rewrite_buffer = []
+        self._rewrite_db = None
+
+    def finish_rewrite(self, temp_filename):
+        """
+        Append the records logged during the rewrite to its snapshot and
+        swap the result in place of the current log. Runs without yielding,
+        so no write can slip in between.
+        """
+        self.flush()
+        with open(temp_filename, 'ab') as f:
+            f.write(b''.join(self._rewrite_buffer))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, self.filename)
+
+        self._file.close()
+        self._file = open(self.filename, 'ab')
+        self.size = self.rewrite_base_size = self._file.tell()
+        self._db = None
+        self._dirty = False
+        self._rewrite_buffer = None
+
+    def abort_rewrite(self, temp_filename):
+        self._rewrite_buffer = None
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+    def _fsync_worker(self):
+        """Background worker for the 'everysec' policy"""
+        hub = gevent.get_hub()
+        while True:
+            gevent.sleep(1)
+            self.flush()
+            if self._dirty:
+                self._dirty = False
+                try:
+                    # fsync in a thread so the event loop keeps serving clients
+                    hub.threadpool.apply(os.fsync, (self._file.fileno(),))
+                except (OSError, ValueError):
+                    pass  # The file was swapped by a rewrite meanwhile
@@ -0,0 +1,252 @@
+import asyncio
+
+from NimbleDB import Commands, DEFAULT_PORT, RECV_BUFFER_SIZE, unpack_transaction
+from protocolHandler import *
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 10.0  # Seconds allowed for a command, including the wait for a connection
+
+
+class AsyncConnection(object):
+    """
+    A single stream connection to the server, along with the password and
+    database the server currently holds for it.
+    """
+    def __init__(self, reader, writer, raw=False):
+        self._reader = reader
+        self._writer = writer
+        self._protocol = ProtocolHandler()
+        self._parser = ProtocolParser(raw)
+        self.password = None
+        self.current_db = 0
+
+    async def send(self, commands):
+        """Write every command at once, then read one reply per command"""
+        self._writer.write(self._protocol.encode(*commands))
+        await self._writer.drain()
+        return [await self._read_reply() for _ in commands]
+
+    async def _read_reply(self):
+        parser = self._parser
+        while True:
+            reply = parser.gets()
+            if reply is not INCOMPLETE:
+                return reply
+            data = await self._reader.read(RECV_BUFFER_SIZE)
+            if not data:
+                raise ConnectionError("Connection closed by server")
+            parser.feed(data)
+
+    def close(self):
+        self._writer.close()
+
+
+class ConnectionPool(object):
+    """
+    Bounded pool of connections to one server. No more than max_connections
+    are open at once; a coroutine that finds them all busy waits until one
+    is released. Idle connections are reused most recent first.
+    """
+    def __init__(self, host, port, max_connections=DEFAULT_POOL_SIZE, raw=False, unix_socket_path=None):
+        self.host = host
+        self.port = port
+        self.unix_socket_path = unix_socket_path  # Connect here instead of host and port
+        self.max_connections = max_connections
+        self.raw = raw  # Leave bulk string replies as bytes
+        self._idle = []
+        self._slots = asyncio.Semaphore(max_connections)
+        self._closed = False
+
+    async def acquire(self):
+        if self._closed:
+            raise ConnectionError("Connection pool is closed")
+        await self._slots.acquire()
+        if self._idle:
+            return self._idle.pop()
+        try:
+            if self.unix_socket_path is not None:
+                reader, writer = await asyncio.open_unix_connection(self.unix_socket_path)
+            else:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+        except BaseException:
+            self._slots.release()
+            raise
+        return AsyncConnection(reader, writer, self.raw)
+
+    def release(self, conn, discard=False):
+        """Return a connection; discard it if its stream state is unknown"""
+        if discard or self._closed:
+            conn.close()
+        else:
+            self._idle.append(conn)
+        self._slots.release()
+
+    def close(self):
+        self._closed = True
+        while self._idle:
+            self._idle.pop().close()
+
+
+class AsyncClient(Commands):
+    """
+    asyncio counterpart of Client with the same command methods, which
+    return coroutines here:
+
+        client = AsyncClient()
+        await client.set('a', '1')
+        await client.get('a')
+        await client.close()
+
+    Any number of tasks can share one AsyncClient; their commands run over
+    a bounded pool of connections. AUTH and SELECT apply to the client as a
+    whole: every pooled connection remembers the password and database it
+    is on, and catches up before running its next command. As with Client,
+    decode_responses=False returns values as bytes and unix_socket_path
+    connects over a Unix socket instead of TCP.
+    """
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, max_connections=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, decode_responses=True, unix_socket_path=None):
+        self._pool = ConnectionPool(host, port, max_connections, raw=not decode_responses,
+                                    unix_socket_path=unix_socket_path)
+        self._timeout = timeout
+        self._password = None
+        self._current_db = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def execute(self, *args):
+        resp, = await self._call([args])
+        if isinstance(resp, Error):
+            raise CommandError(resp.message)
+        return resp
+
+    def pipeline(self, transaction=False):
+        """
+        Return an AsyncPipeline that batches commands into one round trip;
+        with transaction=True they run as one MULTI/EXEC transaction
+        """
+        return AsyncPipeline(self, transaction)
+
+    async def scan_iter(self, match=None, count=None):
+        """Yield every key in the current database, one SCAN step at a time"""
+        cursor = None
+        while cursor != 0:
+            cursor, keys = await self.scan(cursor or 0, match, count)
+            for key in keys:
+                yield key
+
+    async def blpop(self, *keys, timeout=0):
+        return await self._blocking_pop('BLPOP', keys, timeout)
+
+    async def brpop(self, *keys, timeout=0):
+        return await self._blocking_pop('BRPOP', keys, timeout)
+
+    async def _blocking_pop(self, command, keys, timeout):
+        # The server holds the reply for up to timeout seconds, so that much
+        # is allowed on top of the client's own timeout
+        resp, = await self._call([(command,) + keys + (str(timeout),)], wait=timeout or None)
+        if isinstance(resp, Error):
+            raise CommandError(resp.message)
+        return resp
+
+    async def close(self):
+        self._pool.close()
+
+    async def _call(self, commands, wait=0):
+        """
+        Run a batch of commands on one pooled connection, within the timeout
+        plus wait seconds the server may legitimately take; None waits forever
+        """
+        if self._timeout is None or wait is None:
+            return await self._run(commands)
+        return await asyncio.wait_for(self._run(commands), self._timeout + wait)
+
+    async def _run(self, commands):
+        conn = await self._pool.acquire()
+        done = False
+        try:
+            await self._sync_session(conn)
+            results = await conn.send(commands)
+            done = True
+        finally:
+            # A connection left mid-reply by a timeout or error can't be reused
+            self._pool.release(conn, discard=not done)
+
+        replies = zip(commands, results)
+        if commands[0][0] == 'MULTI' and results[-1].__class__ is list:
+            # Commands in a transaction reply inside the EXEC reply
+            replies = zip(commands[1:-1], results[-1])
+        for args, resp in replies:
+            if resp == "OK" and args[0] == 'AUTH':
+                self._password = conn.password = args[1]
+            elif resp == "OK" and args[0] == 'SELECT':
+                self._current_db = conn.current_db = int(args[1])
+        return results
+
+    async def _sync_session(self, conn):
+        """Bring a connection up to the client's AUTH and SELECT state"""
+        setup = []
+        if self._password is not None and conn.password != self._password:
+            setup.append(('AUTH', self._password))
+        if conn.current_db != self._current_db:
+            setup.append(('SELECT', str(self._current_db)))
+        if not setup:
+            return
+        # A separate round trip, so a failed SELECT can't let the commands
+        # run against the wrong database
+        for resp in await conn.send(setup):
+            if isinstance(resp, Error):
+                raise CommandError(resp.message)
+        conn.password = self._password
+        conn.current_db = self._current_db
+
+
+class AsyncPipeline(Commands):
+    """
+    Queue commands on top of an AsyncClient and send them in a single
+    batch over one pooled connection:
+
+        pipe = client.pipeline()
+        pipe.set('a', '1')
+        pipe.get('a')
+        await pipe.send()  # [1, '1']
+
+    With transaction=True the batch is wrapped in MULTI and EXEC, so no
+    other client's commands run in between. WATCH needs every command on
+    one connection, so it is only available on Client.
+    """
+    def __init__(self, client, transaction=False):
+        self._client = client
+        self._queue = []
+        self._transaction = transaction
+
+    def __len__(self):
+        return len(self._queue)
+
+    def execute(self, *args):
+        self._queue.append(args)
+        return self
+
+    async def send(self, raise_on_error=True):
+        """
+        Write every queued command at once, then read one reply per command
+        Args:
+            raise_on_error: Raise CommandError for the first error reply,
+                otherwise errors are returned in place as Error tuples
+        """
+        if not self._queue:
+            return []
+        queue, self._queue = self._queue, []
+        if self._transaction:
+            results = unpack_transaction(await self._client._call([('MULTI',)] + queue + [('EXEC',)]))
+        else:
+            results = await self._client._call(queue)
+        if raise_on_error:
+            for resp in results:
+                if isinstance(resp, Error):
+                    raise CommandError(resp.message)
+        return results
@@ -0,0 +1,541 @@
+"""
+Micro-benchmarks for NimbleDB internals
+
+    python benchmark.py parser [--items 5000] [--rounds 20]
+    python benchmark.py values [--sizes 1kb,16kb,256kb,1mb] [--rounds 20]
+    python benchmark.py expiry [--keys 10000,100000,1000000] [--due 0.01]
+    python benchmark.py shards [--workers 1,2,4] [--clients 8] [--seconds 5]
+    python benchmark.py load [--clients 8] [--pipeline 1] [--mix get=60,set=30,...] [--json]
+    python benchmark.py transport [--clients 1,8] [--pipeline 1] [--seconds 5]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+from array import array
+from base64 import b64encode
+from io import BufferedReader, BytesIO
+
+from rich.console import Console
+from rich.table import Table
+
+from NimbleDB import Client, EXPIRE_BATCH_SIZE, RECV_BUFFER_SIZE, Server, parse_memory, remove_unix_socket
+from database import Database
+from protocolHandler import *
+
+console = Console()
+
+
+def _best_of(rounds, func):
+    """Run func rounds times and return the fastest wall time in seconds"""
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def _parse_with_handler(wire, count):
+    handler = ProtocolHandler()
+    socket_file = BufferedReader(BytesIO(wire))
+    for _ in range(count):
+        handler.handle_request(socket_file)
+
+
+def _parse_with_parser(wire, count):
+    parser = ProtocolParser()
+    parsed = 0
+    for offset in range(0, len(wire), RECV_BUFFER_SIZE):
+        parser.feed(wire[offset:offset + RECV_BUFFER_SIZE])
+        while parser.gets() is not INCOMPLETE:
+            parsed += 1
+    assert parsed == count
+
+
+def bench_parser(items=5000, rounds=20):
+    """Compare ProtocolHandler.handle_request with ProtocolParser"""
+    encoder = ProtocolHandler()
+    bulk_set = ['BULK_SET']
+    for i in range(items):
+        bulk_set.extend([f'key:{i}', f'value:{i}'])
+    workloads = [
+        (f"BULK_SET x{items}", encoder.encode(bulk_set), 1),
+        (f"GET x{items} pipelined",
+         encoder.encode(*[['GET', f'key:{i}'] for i in range(items)]), items),
+    ]
+
+    table = Table(title="Protocol parsing (best of %d)" % rounds)
+    table.add_column("Workload")
+    table.add_column("Bytes", justify="right")
+    table.add_column("handle_request", justify="right")
+    table.add_column("ProtocolParser", justify="right")
+    table.add_column("Speedup", justify="right")
+
+    for name, wire, count in workloads:
+        old = _best_of(rounds, lambda: _parse_with_handler(wire, count))
+        new = _best_of(rounds, lambda: _parse_with_parser(wire, count))
+        table.add_row(name, str(len(wire)), f"{old * 1000:.2f} ms",
+                      f"{new * 1000:.2f} ms", f"{old / new:.2f}x")
+    console.print(table)
+
+
+def _value_round_trip(server, wire, decode):
+    """
+    What a SET and a GET of one value cost end to end: the server parses both
+    requests, stores and fetches the value and encodes the reply, which the
+    client then reads back
+    """
+    parser = ProtocolParser(server._raw_values)
+    parser.feed(wire)
+    session_state = {'current_db': 0}
+    server.get_response(parser.gets(), session_state)
+    reply = server._protocol.encode(server.get_response(parser.gets(), session_state))
+    return ProtocolHandler(decode).handle_request(BufferedReader(BytesIO(reply)))
+
+
+def _peak_allocated(func):
+    """Bytes allocated at the high point of one call to func"""
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        func()
+        return tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+
+def bench_values(sizes=(1024, 16384, 262144, 1048576), rounds=20):
+    """Compare values decoded to str with values kept as bytes by raw_values"""
+    encoder = ProtocolHandler()
+    table = Table(title="SET + GET of one value (best of %d)" % rounds)
+    table.add_column("Value size", justify="right")
+    table.add_column("str", justify="right")
+    table.add_column("bytes", justify="right")
+    table.add_column("Speedup", justify="right")
+    table.add_column("Peak alloc str", justify="right")
+    table.add_column("Peak alloc bytes", justify="right")
+
+    for size in sizes:
+        # Text that is valid UTF-8, so both modes can store it
+        value = b64encode(os.urandom(size))[:size]
+        wire = encoder.encode(['SET', 'key', value], ['GET', 'key'])
+        results = []
+        for raw in (False, True):
+            server = Server(raw_values=raw)
+            run = lambda: _value_round_trip(server, wire, not raw)
+            assert run() == (value if raw else value.decode('utf-8'))
+            results.append((_best_of(rounds, run), _peak_allocated(run)))
+        (text_time, text_peak), (raw_time, raw_peak) = results
+        table.add_row(f"{size:,}", f"{text_time * 1e6:,.1f} µs", f"{raw_time * 1e6:,.1f} µs",
+                      f"{text_time / raw_time:.2f}x", f"{text_peak / 1024:,.0f} KB",
+                      f"{raw_peak / 1024:,.0f} KB")
+    console.print(table)
+
+
+def _full_scan_sweep(db, now):
+    """The sweep the server ran before the expiry index existed"""
+    expired_keys = [key for key, expire_time in db._ttl.items() if now >= expire_time]
+    for key in expired_keys:
+        db._kv.pop(key, None)
+        db._ttl.pop(key, None)
+
+
+def _volatile_database(keys, due, now):
+    db = Database(0)
+    due_count = int(keys * due)
+    for i in range(keys):
+        db._kv[f'key:{i}'] = 'value'
+        # The first due_count keys are already past their TTL
+        db.set_ttl(f'key:{i}', now - 1 if i < due_count else now + 3600 + i)
+    return db
+
+
+def bench_expiry(key_counts=(10000, 100000, 1000000), due=0.01):
+    """Loop pause of one expiry pass as the number of TTL'd keys grows"""
+    table = Table(title="Expiry pass pause (%.1f%% of keys due)" % (due * 100))
+    table.add_column("TTL keys", justify="right")
+    table.add_column("Full scan", justify="right")
+    table.add_column("Expiry index pass", justify="right")
+    table.add_column("Index passes to drain", justify="right")
+
+    for keys in key_counts:
+        now = time.time()
+        db = _volatile_database(keys, due, now)
+        start = time.perf_counter()
+        _full_scan_sweep(db, now)
+        scan = time.perf_counter() - start
+
+        db = _volatile_database(keys, due, now)
+        passes = 0
+        worst = 0
+        while True:
+            start = time.perf_counter()
+            db.expire_due(now, EXPIRE_BATCH_SIZE)
+            worst = max(worst, time.perf_counter() - start)
+            passes += 1
+            if not db.has_due(now):
+                break
+
+        table.add_row(str(keys), f"{scan * 1000:.2f} ms",
+                      f"{worst * 1000:.3f} ms", str(passes))
+    console.print(table)
+
+
+def _wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def _shard_load(args):
+    """One load generating process: pipelined batches of random GETs and SETs"""
+    port, seconds, pipeline, keys, seed = args
+    client = Client(port=port)
+    rng = random.Random(seed)
+    ops = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pipe = client.pipeline()
+        for _ in range(pipeline):
+            key = f'key:{rng.randrange(keys)}'
+            if rng.random() < 0.5:
+                pipe.set(key, 'value')
+            else:
+                pipe.get(key)
+        pipe.send()
+        ops += pipeline
+    return ops
+
+
+def bench_shards(worker_counts=(1, 2, 4), clients=8, seconds=5, pipeline=64, keys=100000, port=7199):
+    """Throughput of the sharded server as workers are added"""
+    table = Table(title=f"Sharded server throughput ({clients} client processes, "
+                        f"pipelines of {pipeline}, {os.cpu_count()} cores)")
+    table.add_column("Workers", justify="right")
+    table.add_column("Ops/sec", justify="right")
+    table.add_column("Scaling", justify="right")
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shardedServer.py')
+    baseline = None
+    for workers in worker_counts:
+        server = subprocess.Popen([sys.executable, script, '--workers', str(workers), '--port', str(port)],
+                                  stdout=subprocess.DEVNULL)
+        try:
+            _wait_for_port(port)
+            with multiprocessing.Pool(clients) as pool:
+                ops = pool.map(_shard_load, [(port, seconds, pipeline, keys, seed)
+                                             for seed in range(clients)])
+        finally:
+            server.terminate()
+            server.wait()
+        rate = sum(ops) / seconds
+        baseline = baseline or rate
+        table.add_row(str(workers), f"{rate:,.0f}", f"{rate / baseline:.2f}x")
+    console.print(table)
+
+
+LOAD_COMMANDS = ('get', 'set', 'exists', 'bulk_get', 'bulk_set', 'delete')
+LOAD_PRELOAD_BATCH = 1000  # Keys per BULK_SET while filling the key space
+# Starts a plain Server on the port given as the first argument, and on
+# the Unix socket given as the second if there is one
+LOCAL_SERVER = (
+    "import sys\n"
+    "from gevent import monkey; monkey.patch_all()\n"
+    "from NimbleDB import Server\n"
+    "Server(port=int(sys.argv[1]), unix_socket=sys.argv[2] if len(sys.argv) > 2 else None).run()\n"
+)
+
+
+def _parse_mix(text):
+    """'get=60,set=30,delete=10' -> {'get': 60.0, 'set': 30.0, 'delete': 10.0}"""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip().lower()
+        if name not in LOAD_COMMANDS:
+            raise ValueError(f"Unknown command {name!r} in mix; choose from {', '.join(LOAD_COMMANDS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def _random_key(rng, keys):
+    return f'key:{rng.randrange(keys)}'
+
+
+def _queue_command(pipe, name, rng, options):
+    keys = options['keys']
+    if name == 'get':
+        pipe.get(_random_key(rng, keys))
+    elif name == 'set':
+        ttl = options['ttl'] if rng.random() < options['ttl_ratio'] else None
+        pipe.set(_random_key(rng, keys), options['value'], ttl)
+    elif name == 'exists':
+        pipe.exists(_random_key(rng, keys))
+    elif name == 'delete':
+        pipe.delete(_random_key(rng, keys))
+    elif name == 'bulk_get':
+        pipe.bulk_get(*[_random_key(rng, keys) for _ in range(options['bulk_size'])])
+    elif name == 'bulk_set':
+        items = []
+        for _ in range(options['bulk_size']):
+            items.extend([_random_key(rng, keys), options['value']])
+        pipe.bulk_set(*items)
+
+
+def _load_worker(args):
+    """
+    One client connection sending pipelined batches drawn from the mix.
+    Every command in a batch is timed as the batch's round trip, which with
+    a pipeline of 1 is the latency of the command itself.
+    """
+    connect, seconds, seed, options = args
+    client = Client(**connect)
+    rng = random.Random(seed)
+    names = list(options['mix'])
+    weights = list(options['mix'].values())
+    latencies = {name: array('d') for name in names}
+    errors = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        batch = rng.choices(names, weights, k=options['pipeline'])
+        pipe = client.pipeline()
+        for name in batch:
+            _queue_command(pipe, name, rng, options)
+        started = time.perf_counter()
+        results = pipe.send(raise_on_error=False)
+        elapsed = time.perf_counter() - started
+        for name in batch:
+            latencies[name].append(elapsed)
+        errors += sum(1 for resp in results if isinstance(resp, Error))
+    return latencies, errors
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def _latency_summary(samples, seconds):
+    ordered = sorted(samples)
+    return {
+        'ops': len(ordered),
+        'ops_per_sec': round(len(ordered) / seconds, 1),
+        'p50_ms': round(_percentile(ordered, 0.50) * 1000, 4),
+        'p99_ms': round(_percentile(ordered, 0.99) * 1000, 4),
+        'p999_ms': round(_percentile(ordered, 0.999) * 1000, 4),
+    }
+
+
+def bench_load(clients=8, seconds=10, pipeline=1, keys=100000, value_size=100, ttl_ratio=0.0, ttl=60,
+               mix='get=60,set=30,exists=4,bulk_get=2,bulk_set=2,delete=2', bulk_size=10,
+               port=7198, as_json=False):
+    """
+    Throughput and latency of a local Server under a configurable command
+    mix, driven by one process per client connection so the load generator
+    is not the bottleneck
+    """
+    options = {
+        'mix': _parse_mix(mix), 'pipeline': pipeline, 'keys': keys, 'value': 'x' * value_size,
+        'ttl_ratio': ttl_ratio, 'ttl': ttl, 'bulk_size': bulk_size,
+    }
+    here = os.path.dirname(os.path.abspath(__file__))
+    server = subprocess.Popen([sys.executable, '-c', LOCAL_SERVER, str(port)], cwd=here,
+                              stdout=subprocess.DEVNULL)
+    try:
+        _wait_for_port(port)
+        # Fill the key space first, so GETs measure hits rather than misses
+        loader = Client(port=port)
+        for start in range(0, keys, LOAD_PRELOAD_BATCH):
+            items = []
+            for i in range(start, min(start + LOAD_PRELOAD_BATCH, keys)):
+                items.extend([f'key:{i}', options['value']])
+            loader.bulk_set(*items)
+
+        with multiprocessing.Pool(clients) as pool:
+            runs = pool.map(_load_worker, [({'port': port}, seconds, seed, options)
+                                           for seed in range(clients)])
+    finally:
+        server.terminate()
+        server.wait()
+
+    samples = {name: array('d') for name in options['mix']}
+    for latencies, _ in runs:
+        for name, values in latencies.items():
+            samples[name].extend(values)
+    results = {name: _latency_summary(values, seconds) for name, values in samples.items()}
+    total = _latency_summary([value for values in samples.values() for value in values], seconds)
+    total['errors'] = sum(errors for _, errors in runs)
+
+    if as_json:
+        print(json.dumps({
+            'benchmark': 'load',
+            'config': {
+                'clients': clients, 'seconds': seconds, 'pipeline': pipeline, 'keys': keys,
+                'value_size': value_size, 'ttl_ratio': ttl_ratio, 'ttl': ttl,
+                'mix': options['mix'], 'bulk_size': bulk_size,
+            },
+            'environment': {
+                'python': platform.python_version(), 'implementation': platform.python_implementation(),
+                'platform': platform.platform(), 'cpus': os.cpu_count(),
+            },
+            'timestamp': int(time.time()),
+            'commands': results,
+            'total': total,
+        }, indent=2))
+        return
+
+    table = Table(title=f"Load test ({clients} clients, pipelines of {pipeline}, {keys:,} keys, "
+                        f"{value_size} byte values, {seconds:g}s)")
+    table.add_column("Command")
+    table.add_column("Ops/sec", justify="right")
+    table.add_column("p50 ms", justify="right")
+    table.add_column("p99 ms", justify="right")
+    table.add_column("p99.9 ms", justify="right")
+    for name, summary in list(results.items()) + [('total', total)]:
+        table.add_row(name.upper() if name != 'total' else "[bold]Total[/bold]",
+                      f"{summary['ops_per_sec']:,.0f}", f"{summary['p50_ms']:.3f}",
+                      f"{summary['p99_ms']:.3f}", f"{summary['p999_ms']:.3f}")
+    console.print(table)
+    if total['errors']:
+        console.print(f"[bold red]{total['errors']} error replies[/bold red]")
+
+
+def bench_transport(client_counts=(1, 8), seconds=5, pipeline=1, keys=10000, value_size=100,
+                    mix='get=80,set=20', port=7197, unix_socket='/tmp/nimbledb-bench.sock'):
+    """
+    The same server and command mix over loopback TCP and over a Unix
+    socket, one process per client connection
+    """
+    options = {
+        'mix': _parse_mix(mix), 'pipeline': pipeline, 'keys': keys, 'value': 'x' * value_size,
+        'ttl_ratio': 0.0, 'ttl': 60, 'bulk_size': 10,
+    }
+    transports = (('TCP', {'port': port}), ('Unix socket', {'unix_socket_path': unix_socket}))
+    table = Table(title=f"TCP loopback versus Unix socket (pipelines of {pipeline}, {value_size} byte values, "
+                        f"{seconds:g}s, {os.cpu_count()} cores)")
+    table.add_column("Clients", justify="right")
+    table.add_column("Transport")
+    table.add_column("Ops/sec", justify="right")
+    table.add_column("p50 ms", justify="right")
+    table.add_column("p99 ms", justify="right")
+    table.add_column("p99.9 ms", justify="right")
+    table.add_column("vs TCP", justify="right")
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    server = subprocess.Popen([sys.executable, '-c', LOCAL_SERVER, str(port), unix_socket], cwd=here,
+                              stdout=subprocess.DEVNULL)
+    try:
+        # The Unix socket is bound before the TCP port starts listening
+        _wait_for_port(port)
+        loader = Client(port=port)
+        for start in range(0, keys, LOAD_PRELOAD_BATCH):
+            items = []
+            for i in range(start, min(start + LOAD_PRELOAD_BATCH, keys)):
+                items.extend([f'key:{i}', options['value']])
+            loader.bulk_set(*items)
+
+        for clients in client_counts:
+            baseline = None
+            for name, connect in transports:
+                with multiprocessing.Pool(clients) as pool:
+                    runs = pool.map(_load_worker, [(connect, seconds, seed, options)
+                                                   for seed in range(clients)])
+                summary = _latency_summary([value for latencies, _ in runs
+                                            for values in latencies.values() for value in values], seconds)
+                baseline = baseline or summary['ops_per_sec']
+                table.add_row(str(clients), name, f"{summary['ops_per_sec']:,.0f}", f"{summary['p50_ms']:.3f}",
+                              f"{summary['p99_ms']:.3f}", f"{summary['p999_ms']:.3f}",
+                              f"{summary['ops_per_sec'] / baseline:.2f}x")
+    finally:
+        server.terminate()
+        server.wait()
+        remove_unix_socket(unix_socket)
+    console.print(table)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NimbleDB benchmarks")
+    commands = parser.add_subparsers(dest='benchmark', required=True)
+
+    cmd = commands.add_parser('parser', help="protocol parser throughput")
+    cmd.add_argument('--items', type=int, default=5000)
+    cmd.add_argument('--rounds', type=int, default=20)
+
+    cmd = commands.add_parser('values', help="str versus raw bytes values, 1 KB to 1 MB")
+    cmd.add_argument('--sizes', default='1kb,16kb,256kb,1mb', help="comma separated value sizes")
+    cmd.add_argument('--rounds', type=int, default=20)
+
+    cmd = commands.add_parser('expiry', help="TTL expiry pause per pass")
+    cmd.add_argument('--keys', default='10000,100000,1000000',
+                     help="comma separated TTL'd key counts")
+    cmd.add_argument('--due', type=float, default=0.01,
+                     help="fraction of keys already expired")
+
+    cmd = commands.add_parser('shards', help="sharded server throughput by worker count")
+    cmd.add_argument('--workers', default='1,2,4', help="comma separated worker counts")
+    cmd.add_argument('--clients', type=int, default=8, help="load generating processes")
+    cmd.add_argument('--seconds', type=float, default=5)
+    cmd.add_argument('--pipeline', type=int, default=64, help="commands per pipelined batch")
+    cmd.add_argument('--port', type=int, default=7199)
+
+    cmd = commands.add_parser('load', help="throughput and latency percentiles of a local server")
+    cmd.add_argument('--clients', type=int, default=8, help="concurrent connections, one process each")
+    cmd.add_argument('--seconds', type=float, default=10)
+    cmd.add_argument('--pipeline', type=int, default=1, help="commands per pipelined batch")
+    cmd.add_argument('--keys', type=int, default=100000, help="size of the key space")
+    cmd.add_argument('--value-size', type=int, default=100, help="bytes per value")
+    cmd.add_argument('--ttl-ratio', type=float, default=0.0, help="fraction of SETs given a TTL")
+    cmd.add_argument('--ttl', type=int, default=60, help="seconds of TTL for those SETs")
+    cmd.add_argument('--mix', default='get=60,set=30,exists=4,bulk_get=2,bulk_set=2,delete=2',
+                     help="command weights, from " + ', '.join(LOAD_COMMANDS))
+    cmd.add_argument('--bulk-size', type=int, default=10, help="keys per BULK_GET and BULK_SET")
+    cmd.add_argument('--port', type=int, default=7198)
+    cmd.add_argument('--json', action='store_true', help="print results as JSON")
+
+    cmd = commands.add_parser('transport', help="loopback TCP versus Unix socket latency and throughput")
+    cmd.add_argument('--clients', default='1,8', help="comma separated client counts")
+    cmd.add_argument('--seconds', type=float, default=5)
+    cmd.add_argument('--pipeline', type=int, default=1, help="commands per pipelined batch")
+    cmd.add_argument('--keys', type=int, default=10000, help="size of the key space")
+    cmd.add_argument('--value-size', type=int, default=100, help="bytes per value")
+    cmd.add_argument('--mix', default='get=80,set=20', help="command weights, from " + ', '.join(LOAD_COMMANDS))
+    cmd.add_argument('--port', type=int, default=7197)
+    cmd.add_argument('--unix-socket', default='/tmp/nimbledb-bench.sock')
+
+    args = parser.parse_args()
+    if args.benchmark == 'parser':
+        bench_parser(args.items, args.rounds)
+    elif args.benchmark == 'values':
+        bench_values([parse_memory(size) for size in args.sizes.split(',')], args.rounds)
+    elif args.benchmark == 'expiry':
+        bench_expiry([int(count) for count in args.keys.split(',')], args.due)
+    elif args.benchmark == 'shards':
+        bench_shards([int(count) for count in args.workers.split(',')], args.clients,
+                     args.seconds, args.pipeline, port=args.port)
+    elif args.benchmark == 'load':
+        bench_load(args.clients, args.seconds, args.pipeline, args.keys, args.value_size,
+                   args.ttl_ratio, args.ttl, args.mix, args.bulk_size, args.port, args.json)
+    elif args.benchmark == 'transport':
+        bench_transport([int(count) for count in args.clients.split(',')], args.seconds, args.pipeline,
+                        args.keys, args.value_size, args.mix, args.port, args.unix_socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import threading
+from collections import OrderedDict
+
+CLIENT_CACHE_SIZE = 10000  # Values a client keeps cached unless told otherwise
+
+# What ClientCache.get() returns for a key it doesn't hold; None is a value
+# in its own right, for a key the server doesn't have
+NOT_CACHED = object()
+
+
+class ClientCache(object):
+    """
+    Values a Client in tracking mode has read, the least recently used
+    dropped once max_keys are held. Invalidations are applied by another
+    thread, so every method takes the lock. A read is kept only if no
+    invalidation of its key arrived while it was on its way: begin() marks
+    the key before the request is sent and store() checks the mark is
+    still there, since the server may change the key and say so on the
+    other connection before the reply is read.
+    """
+    def __init__(self, max_keys=CLIENT_CACHE_SIZE):
+        self.max_keys = max_keys
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.closed = False
+        self._entries = OrderedDict()
+        self._pending = {}  # key -> token of the read on its way
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """The cached value of key or NOT_CACHED, counted as a hit or a miss"""
+        with self._lock:
+            value = self._entries.get(key, NOT_CACHED)
+            if value is NOT_CACHED:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return value
+
+    def begin(self, key):
+        """Mark a read of key as sent; returns the token to store its value with"""
+        token = object()
+        with self._lock:
+            self._pending[key] = token
+        return token
+
+    def store(self, key, value, token):
+        """Keep the value read for key, unless key was invalidated since begin()"""
+        with self._lock:
+            if self._pending.get(key) is not token:
+                return
+            del self._pending[key]
+            if self.closed:
+                return
+            entries = self._entries
+            entries[key] = value
+            entries.move_to_end(key)
+            if len(entries) > self.max_keys:
+                entries.popitem(last=False)
+
+    def abandon(self, key, token):
+        """Forget a read that failed"""
+        with self._lock:
+            if self._pending.get(key) is token:
+                del self._pending[key]
+
+    def invalidate(self, keys):
+        """Apply an invalidation from the server: drop keys, or everything for None"""
+        with self._lock:
+            self.invalidations += 1
+            self._drop(keys)
+
+    def drop(self, keys):
+        """Drop keys this client changed itself, or everything for None"""
+        with self._lock:
+            self._drop(keys)
+
+    def _drop(self, keys):
+        if keys is None:
+            self._entries.clear()
+            self._pending.clear()
+            return
+        for key in keys:
+            self._entries.pop(key, None)
+            self._pending.pop(key, None)
+
+    def close(self):
+        """Empty the cache for good, once invalidations can no longer arrive"""
+        with self._lock:
+            self.closed = True
+            self._drop(None)
+
+    def info(self):
+        with self._lock:
+            return {
+                'enabled': not self.closed,
+                'keys': len(self._entries),
+                'max_keys': self.max_keys,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+            }
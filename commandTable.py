@@ -0,0 +1,138 @@
+from collections import namedtuple
+
+# One entry of the command table. handler names the Server method that runs
+# the command and log the one that passes a successful write on to the
+# append log and the replicas. fewest and most bound the number of arguments
+# after the command name, most None meaning no limit. keys is the (first,
+# last, step) position of the key arguments, a negative last counting from
+# the end and (0, 0, 0) meaning no keys. values are the arguments a
+# raw_values server keeps as the bytes received.
+CommandSpec = namedtuple('CommandSpec', ('name', 'handler', 'fewest', 'most', 'flags', 'keys', 'log', 'values'))
+
+# Flags of a command:
+#   write        changes data; refused by replicas, logged and replicated
+#   denyoom      can use more memory; refused over maxmemory if nothing can be evicted
+#   readonly     reads keys without changing them
+#   protected    needs AUTH first when the server has a password
+#   password     takes the server password as its first argument when one is set
+#   secret       takes a password as its first argument, always
+#   droppassword accepts and ignores a password when the server has none
+#   db           takes the session's current database as db_id
+#   session      takes the connection's session_state
+#   transaction  runs straight away inside MULTI instead of being queued
+#   nomulti      can not be queued inside MULTI
+#   pubsub       allowed while the connection has subscriptions
+#   blocking     may wait for another client to push data
+NO_KEYS = (0, 0, 0)
+ONE_KEY = (1, 1, 1)
+
+
+def _command(name, handler, fewest, most, flags='', keys=NO_KEYS, log=None, values=None):
+    return CommandSpec(name, handler, fewest, most, frozenset(flags.split()), keys, log, values)
+
+
+COMMAND_TABLE = {spec.name: spec for spec in (
+    # Sessions and databases
+    _command('AUTH', 'auth', 1, 1, 'secret session'),
+    _command('SET_PASSWORD', 'set_password', 1, 1, 'secret'),
+    _command('SELECT', 'select_db', 1, 1, 'session'),
+    _command('NEW_DB', 'new_db', 0, 1, 'write denyoom', log='_log_new_db'),
+    _command('LIST_DBS', 'list_dbs', 0, 0),
+    _command('DROP_DB', 'drop_db', 1, 1, 'write', log='_log_drop_db'),
+    # Strings and counters
+    _command('GET', 'get', 1, 1, 'readonly db', ONE_KEY),
+    _command('SET', 'set', 2, 3, 'write denyoom db', ONE_KEY, '_log_set', slice(2, 3)),
+    _command('DELETE', 'delete', 1, 1, 'write db', ONE_KEY, '_log_request'),
+    _command('EXISTS', 'exists', 1, 1, 'readonly db', ONE_KEY),
+    _command('DEL_TIME', 'del_time', 1, 1, 'write db', ONE_KEY, '_log_request'),
+    _command('INCR', 'incr', 1, 1, 'write denyoom db', ONE_KEY, '_log_counter'),
+    _command('INCRBY', 'incrby', 2, 2, 'write denyoom db', ONE_KEY, '_log_counter'),
+    _command('DECR', 'decr', 1, 1, 'write denyoom db', ONE_KEY, '_log_counter'),
+    _command('DECRBY', 'decrby', 2, 2, 'write denyoom db', ONE_KEY, '_log_counter'),
+    _command('INCRBYFLOAT', 'incrbyfloat', 2, 2, 'write denyoom db', ONE_KEY, '_log_float_counter'),
+    _command('BULK_GET', 'bulk_get', 1, None, 'readonly db', (1, -1, 1)),
+    _command('BULK_SET', 'bulk_set', 2, None, 'write denyoom db', (1, -1, 2), '_log_request',
+             slice(2, None, 2)),
+    _command('SCAN', 'scan', 1, None, 'readonly db'),
+    _command('EXPIRE', 'expire', 2, 2, 'write db', ONE_KEY, '_log_expire'),
+    # Hashes
+    _command('HSET', 'hset', 3, None, 'write denyoom db', ONE_KEY, '_log_request'),
+    _command('HGET', 'hget', 2, 2, 'readonly db', ONE_KEY),
+    _command('HMGET', 'hmget', 2, None, 'readonly db', ONE_KEY),
+    _command('HGETALL', 'hgetall', 1, 1, 'readonly db', ONE_KEY),
+    _command('HDEL', 'hdel', 2, None, 'write db', ONE_KEY, '_log_request'),
+    _command('HINCRBY', 'hincrby', 3, 3, 'write denyoom db', ONE_KEY, '_log_hincrby'),
+    _command('HLEN', 'hlen', 1, 1, 'readonly db', ONE_KEY),
+    _command('HEXISTS', 'hexists', 2, 2, 'readonly db', ONE_KEY),
+    # Lists
+    _command('LPUSH', 'lpush', 2, None, 'write denyoom db', ONE_KEY, '_log_request'),
+    _command('RPUSH', 'rpush', 2, None, 'write denyoom db', ONE_KEY, '_log_request'),
+    _command('LPOP', 'lpop', 1, 1, 'write db', ONE_KEY, '_log_pop'),
+    _command('RPOP', 'rpop', 1, 1, 'write db', ONE_KEY, '_log_pop'),
+    _command('LRANGE', 'lrange', 3, 3, 'readonly db', ONE_KEY),
+    _command('LLEN', 'llen', 1, 1, 'readonly db', ONE_KEY),
+    _command('BLPOP', 'blpop', 2, None, 'write blocking db', (1, -2, 1), '_log_blocking_pop'),
+    _command('BRPOP', 'brpop', 2, None, 'write blocking db', (1, -2, 1), '_log_blocking_pop'),
+    # Sorted sets
+    _command('ZADD', 'zadd', 3, None, 'write denyoom db', ONE_KEY, '_log_request'),
+    _command('ZINCRBY', 'zincrby', 3, 3, 'write denyoom db', ONE_KEY, '_log_zincrby'),
+    _command('ZRANGE', 'zrange', 3, 4, 'readonly db', ONE_KEY),
+    _command('ZREVRANGE', 'zrevrange', 3, 4, 'readonly db', ONE_KEY),
+    _command('ZRANGEBYSCORE', 'zrangebyscore', 3, 7, 'readonly db', ONE_KEY),
+    _command('ZRANK', 'zrank', 2, 2, 'readonly db', ONE_KEY),
+    _command('ZREVRANK', 'zrevrank', 2, 2, 'readonly db', ONE_KEY),
+    _command('ZREM', 'zrem', 2, None, 'write db', ONE_KEY, '_log_request'),
+    _command('ZSCORE', 'zscore', 2, 2, 'readonly db', ONE_KEY),
+    _command('ZCARD', 'zcard', 1, 1, 'readonly db', ONE_KEY),
+    # Persistence
+    _command('FLUSH', 'flush', 0, 0, 'write protected password droppassword db', log='_log_flush'),
+    _command('DUMP', 'dump', 0, 1, 'protected password db'),
+    _command('LOAD', 'load', 1, 1, 'write denyoom protected password db', log='_log_load'),
+    _command('BGSAVE', 'bgsave', 0, 1, 'protected password db'),
+    _command('BGSAVE_STATUS', 'bgsave_status', 0, 0),
+    _command('TIME_DUMP', 'time_dump', 1, 1),
+    _command('REWRITE_LOG', 'rewrite_log', 0, 0, 'protected'),
+    # Monitoring
+    _command('MEMORY_STATS', 'memory_stats', 0, 0),
+    _command('INFO', 'info', 0, 0, 'protected'),
+    _command('STATS', 'stats', 1, 1),
+    _command('SLOWLOG', 'slowlog', 1, None, 'protected'),
+    _command('COMMAND', 'command', 0, None),
+    # Replication
+    _command('REPLICAOF', 'replicaof', 2, 2, 'protected'),
+    _command('PSYNC', 'psync', 2, 2, 'protected nomulti'),
+    # Transactions
+    _command('MULTI', 'multi', 0, 0, 'session transaction'),
+    _command('EXEC', 'exec', 0, 0, 'session transaction'),
+    _command('DISCARD', 'discard', 0, 0, 'session transaction'),
+    _command('WATCH', 'watch', 1, None, 'session transaction', (1, -1, 1)),
+    _command('UNWATCH', 'unwatch', 0, 0, 'session transaction'),
+    # Publish/subscribe
+    _command('SUBSCRIBE', 'subscribe', 1, None, 'session pubsub nomulti'),
+    _command('PSUBSCRIBE', 'psubscribe', 1, None, 'session pubsub nomulti'),
+    _command('UNSUBSCRIBE', 'unsubscribe', 0, None, 'session pubsub nomulti'),
+    _command('PUNSUBSCRIBE', 'punsubscribe', 0, None, 'session pubsub nomulti'),
+    _command('PUBLISH', 'publish', 2, 2, values=slice(2, 3)),
+    # Client side caching
+    _command('CLIENT', 'client', 1, None, 'session'),
+)}
+
+
+def command_arity(spec):
+    """Arity the way COMMAND reports it: the exact number of words, command included, or minus the fewest"""
+    return spec.fewest + 1 if spec.fewest == spec.most else -(spec.fewest + 1)
+
+
+def command_info(spec):
+    """COMMAND reply for one command: name, arity, flags and first key, last key and key step"""
+    return [spec.name, command_arity(spec), sorted(spec.flags)] + list(spec.keys)
+
+
+def command_keys(spec, request):
+    """The key arguments of a request, the command name being request[0]"""
+    first, last, step = spec.keys
+    if not first:
+        return []
+    if last < 0:
+        last += len(request)
+    return request[first:last + 1:step]
@@ -1,5 +1,550 @@
+import decimal
+import heapq
+import itertools
+import math
+import random
+import sys
+import time
+from array import array
+from collections import deque
+
+from hashType import *
+from listType import *
+from zsetType import *
+
+SCAN_COMPACT_SLACK = 1024  # Tombstones tolerated in the scan list before compacting
+SCAN_MAP_STRIDE = 256  # Granularity of the cursor map kept across a compaction
+ENTRY_OVERHEAD = 64  # Estimated bytes of dict, scan list and bookkeeping slots per key
+LFU_INIT_VAL = 5  # Starting frequency counter, so new keys aren't evicted straight away
+LFU_LOG_FACTOR = 10  # Higher values make the counter saturate more slowly
+LFU_DECAY_TIME = 60  # Seconds without access for the counter to drop by one
+TRACKING_MAX_KEYS = 1000000  # Keys remembered for client side caching; the oldest is invalidated past this
+
+INT64_MIN = -2 ** 63  # Counters stay in the range Redis clients expect
+INT64_MAX = 2 ** 63 - 1
+
+# Ticks on every tracked access; shared by all databases so LRU ages compare across them
+_access_clock = itertools.count(1)
+
+
+def sizeof(value):
+    """Estimated bytes held by a stored value"""
+    if is_hash(value):
+        return hash_sizeof(value)
+    if is_list(value):
+        return list_sizeof(value)
+    if is_zset(value):
+        return zset_sizeof(value)
+    return sys.getsizeof(value)
+
+
+def copy_value(value):
+    """
+    A copy of a stored value that later writes to the key won't reach.
+    Strings and counters are immutable, but hashes, lists and sorted sets
+    are changed in place.
+    """
+    if is_hash(value):
+        return value.copy()
+    if is_list(value):
+        return deque(value)
+    if is_zset(value):
+        return value.copy()
+    return value
+
+
+def format_float(value):
+    """Shortest text for a float that reads back the same, without exponents: 10.0 -> '10', 1e-07 -> '0.0000001'"""
+    text = format(decimal.Decimal(repr(value)), 'f')
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+    return text
+
+
+def format_score(score):
+    """Reply form of a sorted set score: format_float, with 'inf' and '-inf' for the infinities"""
+    if math.isinf(score):
+        return 'inf' if score > 0 else '-inf'
+    return format_float(score)
+
+
+def format_value(value):
+    """
+    Reply form of a stored string value. Counters are stored as native ints
+    and floats so INCR and friends never re-parse them, but clients always
+    read strings back. Hashes come back as dicts of strings, lists as lists
+    and sorted sets as dicts of member to score. Raw bytes go back as stored.
+    """
+    if value.__class__ is int:
+        return str(value)
+    if value.__class__ is float:
+        return format_float(value)
+    if is_hash(value):
+        return {field: format_value(v) for field, v in hash_items(value)}
+    if is_list(value):
+        return list(value)
+    if is_zset(value):
+        return {member: format_score(score) for member, score in value}
+    return value
+
+
+def is_string(value):
+    """True for plain string values, including counters stored as numbers and raw bytes"""
+    return (value.__class__ is str or value.__class__ is bytes
+            or value.__class__ is int or value.__class__ is float)
+
+
+def _text(value):
+    """Raw bytes as text for the commands that need it, or None if they aren't UTF-8"""
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+
+def parse_int(value):
+    """A stored value as a counter, or None if it doesn't hold an integer"""
+    if value.__class__ is int:
+        return value
+    if value.__class__ is float:
+        return int(value) if value.is_integer() else None
+    if value.__class__ is bytes:
+        value = _text(value)
+    if value.__class__ is not str or not value or value != value.strip() or '_' in value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def parse_float(value):
+    """A stored value or an increment as a finite float, or None"""
+    if value.__class__ in (int, float):
+        return float(value)
+    if value.__class__ is bytes:
+        value = _text(value)
+    if value.__class__ is not str or not value or value != value.strip() or '_' in value:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    return number if math.isfinite(number) else None
+
+
 class Database:
     def __init__(self, db_id):
         self.db_id = db_id
         self._kv = {}
-        self._ttl = {}
\ No newline at end of file
+        self._ttl = {}
+        # Min-heap of (expire_time, key). Entries are never removed in place:
+        # an entry is stale once _ttl no longer holds that exact expire_time
+        # for its key, and stale entries are skipped when they reach the top.
+        self._expiry_heap = []
+        # Keys in insertion order for SCAN. Deleted keys stay behind as
+        # tombstones so positions never shift under a cursor; the list is
+        # compacted once tombstones outnumber live keys, which starts a new
+        # epoch. Every insert of a new key must go through put().
+        self._keys = []
+        self._keys_epoch = 0
+        self._epoch_map = None  # Live key counts per stride of the previous epoch's list
+        # Estimated bytes held by the keys and values, kept up to date on
+        # every insert and removal
+        self.used_memory = 0
+        # Access history for eviction: key -> clock tick (LRU) or
+        # decay period << 8 | counter (LFU; an int rather than a tuple keeps
+        # the garbage collector out of the hot path). Only kept while a
+        # policy needs it.
+        self._access = {}
+        self._touch = None
+        # Version counters for keys under WATCH: key -> [version, watchers].
+        # Every change to a watched key bumps its version; keys nobody
+        # watches have no entry, so other writes only pay a truth test.
+        self._watched = {}
+        # Keys read by connections in tracking mode: key -> ids of those
+        # connections, oldest key first. The first change to a key passes
+        # it to on_invalidate(key, ids) and forgets it until it is read
+        # again; a key of None stands for every key of the database.
+        self._tracked = {}
+        self.on_invalidate = None
+
+    def track_access(self, mode):
+        """Start recording key accesses for 'lru' or 'lfu' eviction, or stop with None"""
+        self._access = {}
+        self._touch = {'lru': self._touch_lru, 'lfu': self._touch_lfu, None: None}[mode]
+
+    def get(self, key):
+        value = self._kv.get(key)
+        if value is not None and self._touch is not None:
+            self._touch(key)
+        return value
+
+    def put(self, key, value):
+        kv = self._kv
+        old = kv.get(key, _MISSING)
+        kv[key] = value
+        if self._watched or self._tracked:
+            self._changed(key)
+        if old is not _MISSING:
+            self.used_memory += sizeof(value) - sizeof(old)
+        else:
+            self.used_memory += sys.getsizeof(key) + sizeof(value) + ENTRY_OVERHEAD
+            self._keys.append(key)
+            if len(self._keys) > 2 * len(kv) + SCAN_COMPACT_SLACK:
+                self._compact_keys()
+        if self._touch is not None:
+            self._touch(key)
+
+    def set_field(self, key, field, value):
+        """Set a field of the hash at key, creating the hash if needed; True if the field is new"""
+        h = self._kv.get(key)
+        if h is None:
+            h = []
+            self.put(key, h)
+        new, added, delta = hash_set(h, field, value)
+        # The hash is changed in place, so only the size difference is counted
+        self.used_memory += delta
+        if self._watched or self._tracked:
+            self._changed(key)
+        if new is not h:
+            self._kv[key] = new
+        return added
+
+    def delete_field(self, key, field):
+        """Remove a field of the hash at key, and the key once it is empty; True if it existed"""
+        h = self._kv.get(key)
+        if h is None:
+            return False
+        delta = hash_delete(h, field)
+        if delta is None:
+            return False
+        self.used_memory += delta
+        if self._watched or self._tracked:
+            self._changed(key)
+        if not hash_len(h):
+            self.delete(key)
+        return True
+
+    def push(self, key, values, left=False):
+        """Add values to one end of the list at key, creating it if needed; returns the new length"""
+        items = self._kv.get(key)
+        if items is None:
+            items = deque()
+            self.put(key, items)
+        if left:
+            items.extendleft(values)
+        else:
+            items.extend(values)
+        self.used_memory += sum(map(item_sizeof, values))
+        if self._watched or self._tracked:
+            self._changed(key)
+        return len(items)
+
+    def pop(self, key, left=False):
+        """Take a value off one end of the list at key, deleting the key once it is empty; None if there is none"""
+        items = self._kv.get(key)
+        if not items:
+            return None
+        value = items.popleft() if left else items.pop()
+        self.used_memory -= item_sizeof(value)
+        if self._watched or self._tracked:
+            self._changed(key)
+        if not items:
+            self.delete(key)
+        return value
+
+    def set_score(self, key, member, score):
+        """Set a member's score in the sorted set at key, creating it if needed; True if the member is new"""
+        zset = self._kv.get(key)
+        if zset is None:
+            zset = SortedSet()
+            self.put(key, zset)
+        added = zset.add(member, score)
+        if added:
+            self.used_memory += member_sizeof(member)
+        if self._watched or self._tracked:
+            self._changed(key)
+        return added
+
+    def delete_member(self, key, member):
+        """Remove a member of the sorted set at key, and the key once it is empty; True if it existed"""
+        zset = self._kv.get(key)
+        if zset is None or not zset.remove(member):
+            return False
+        self.used_memory -= member_sizeof(member)
+        if self._watched or self._tracked:
+            self._changed(key)
+        if not zset:
+            self.delete(key)
+        return True
+
+    def set_ttl(self, key, expire_time):
+        self._ttl[key] = expire_time
+        if self._watched or self._tracked:
+            self._changed(key)
+        heapq.heappush(self._expiry_heap, (expire_time, key))
+        if len(self._expiry_heap) > 2 * len(self._ttl) + 1024:
+            self._rebuild_expiry_heap()
+
+    def remove_ttl(self, key):
+        """Make a key persistent; returns True if it had a TTL"""
+        if self._ttl.pop(key, None) is None:
+            return False
+        if self._watched or self._tracked:
+            self._changed(key)
+        return True
+
+    def delete(self, key):
+        """Remove a key and its TTL; returns True if the key existed"""
+        self._ttl.pop(key, None)
+        return self._remove(key)
+
+    def _remove(self, key):
+        value = self._kv.pop(key, _MISSING)
+        if value is _MISSING:
+            return False
+        self.used_memory -= sys.getsizeof(key) + sizeof(value) + ENTRY_OVERHEAD
+        self._access.pop(key, None)
+        if self._watched or self._tracked:
+            self._changed(key)
+        return True
+
+    def clear(self):
+        self._kv.clear()
+        self._ttl.clear()
+        self._expiry_heap = []
+        self.used_memory = 0
+        self._access.clear()
+        self._keys = []
+        self._keys_epoch += 1
+        self._epoch_map = None
+        for entry in self._watched.values():
+            entry[0] += 1
+        self.untrack_all()
+
+    def watch(self, key):
+        """Start counting changes to key for a WATCH; returns its current version"""
+        entry = self._watched.get(key)
+        if entry is None:
+            entry = self._watched[key] = [0, 0]
+        entry[1] += 1
+        return entry[0]
+
+    def unwatch(self, key):
+        entry = self._watched.get(key)
+        if entry is not None:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._watched[key]
+
+    def version(self, key):
+        """Version of a watched key, None if nobody watches it"""
+        entry = self._watched.get(key)
+        return None if entry is None else entry[0]
+
+    def _changed(self, key):
+        entry = self._watched.get(key)
+        if entry is not None:
+            entry[0] += 1
+        readers = self._tracked.pop(key, None)
+        if readers is not None:
+            self.on_invalidate(key, readers)
+
+    def track(self, key, client_id):
+        """Remember that a tracking connection read key, so it hears when key changes"""
+        readers = self._tracked.get(key)
+        if readers is None:
+            if len(self._tracked) >= TRACKING_MAX_KEYS:
+                # Forgetting a key is only safe once its readers have dropped it
+                oldest = next(iter(self._tracked))
+                self.on_invalidate(oldest, self._tracked.pop(oldest))
+            readers = self._tracked[key] = set()
+        readers.add(client_id)
+
+    def untrack_all(self):
+        """Invalidate every tracked key at once, as when the database is flushed or replaced"""
+        if self._tracked:
+            tracked, self._tracked = self._tracked, {}
+            self.on_invalidate(None, set().union(*tracked.values()))
+
+    def is_expired(self, key, now=None):
+        """Check a key's TTL, removing the key if it is past due"""
+        expire_time = self._ttl.get(key)
+        if expire_time is None:
+            return False
+        if (time.time() if now is None else now) < expire_time:
+            return False
+        self.delete(key)
+        return True
+
+    def has_due(self, now):
+        heap = self._expiry_heap
+        return bool(heap) and heap[0][0] <= now
+
+    def expire_due(self, now, limit):
+        """
+        Remove keys whose TTL is due, looking at no more than limit heap
+        entries so a single pass stays short. Returns the number of keys
+        removed; has_due() tells whether anything due is left.
+        """
+        heap = self._expiry_heap
+        ttl = self._ttl
+        expired = 0
+        while limit and heap and heap[0][0] <= now:
+            expire_time, key = heapq.heappop(heap)
+            limit -= 1
+            if ttl.get(key) == expire_time:
+                del ttl[key]
+                self._remove(key)
+                expired += 1
+        return expired
+
+    def _touch_lru(self, key):
+        self._access[key] = next(_access_clock)
+
+    def _touch_lfu(self, key):
+        """
+        Logarithmic frequency counter in the style of Redis: the more often a
+        key has been used, the less likely another use bumps its counter,
+        and the counter decays while the key sits idle.
+        """
+        period = int(time.monotonic() // LFU_DECAY_TIME)
+        entry = self._access.get(key)
+        if entry is None:
+            counter = LFU_INIT_VAL
+        else:
+            counter = max((entry & 0xFF) - (period - (entry >> 8)), 0)
+        if counter < 255:
+            base = counter - LFU_INIT_VAL
+            if base <= 0 or random.random() * (base * LFU_LOG_FACTOR + 1) < 1:
+                counter += 1
+        self._access[key] = period << 8 | counter
+
+    def _lfu_counter(self, key):
+        """Current frequency counter of a key, with decay applied"""
+        entry = self._access.get(key)
+        if entry is None:
+            return LFU_INIT_VAL
+        period = int(time.monotonic() // LFU_DECAY_TIME)
+        return max((entry & 0xFF) - (period - (entry >> 8)), 0)
+
+    def eviction_candidate(self, policy, samples):
+        """
+        Sample a few keys and return (score, key) for the one the policy
+        would rather drop, or None if nothing is eligible. Higher scores are
+        better to evict, so candidates from several databases compare.
+        """
+        if policy.startswith('volatile-'):
+            keys = self._sample_volatile(samples)
+        else:
+            keys = self._sample_keys(samples)
+        best = None
+        for key in keys:
+            if policy.endswith('-lru'):
+                score = -self._access.get(key, 0)
+            elif policy.endswith('-lfu'):
+                score = -self._lfu_counter(key)
+            else:  # volatile-ttl: soonest to expire first
+                score = -self._ttl[key]
+            if best is None or score > best[0]:
+                best = (score, key)
+        return best
+
+    def _sample_keys(self, count):
+        """Random live keys, picked from the scan list and skipping tombstones"""
+        keys = self._keys
+        kv = self._kv
+        found = []
+        if kv:
+            for _ in range(count * 4):
+                key = keys[random.randrange(len(keys))]
+                if key in kv:
+                    found.append(key)
+                    if len(found) == count:
+                        break
+            if not found:
+                found.append(next(iter(kv)))  # Unlucky with tombstones; still make progress
+        return found
+
+    def _sample_volatile(self, count):
+        """Random keys with a TTL, picked from the expiry heap and skipping stale entries"""
+        ttl = self._ttl
+        found = []
+        if ttl:
+            if len(self._expiry_heap) > 2 * len(ttl):
+                self._rebuild_expiry_heap()
+            heap = self._expiry_heap
+            for _ in range(count * 4):
+                expire_time, key = heap[random.randrange(len(heap))]
+                if ttl.get(key) == expire_time:
+                    found.append(key)
+                    if len(found) == count:
+                        break
+            if not found:
+                found.append(next(iter(ttl)))
+        return found
+
+    def scan(self, cursor, count, match=None):
+        """
+        One step of a cursor walk over the keys, looking at no more than
+        count slots of the scan list. Returns (next_cursor, keys); a
+        next_cursor of 0 means the walk is complete. Keys that exist for
+        the whole walk are returned at least once, keys added or removed
+        meanwhile may or may not be, and a key can come back twice.
+        """
+        keys = self._keys
+        kv = self._kv
+        now = time.time()
+        start = self._cursor_position(cursor)
+        stop = min(start + count, len(keys))
+        found = []
+        for key in keys[start:stop]:
+            if key in kv and not self.is_expired(key, now) and (match is None or match(key)):
+                found.append(key)
+        if stop >= len(self._keys):
+            return 0, found
+        return stop << 16 | (self._keys_epoch & 0xFFFF), found
+
+    def _cursor_position(self, cursor):
+        """Map a cursor to a position in the current scan list"""
+        if cursor == 0:
+            return 0
+        position, epoch = cursor >> 16, cursor & 0xFFFF
+        if epoch == self._keys_epoch & 0xFFFF:
+            return position
+        if self._epoch_map is not None and epoch == (self._keys_epoch - 1) & 0xFFFF:
+            # Rounds down, so nothing is skipped at the cost of a few repeats
+            return self._epoch_map[min(position // SCAN_MAP_STRIDE, len(self._epoch_map) - 1)]
+        return 0  # Too old to map; start over rather than miss keys
+
+    def _compact_keys(self):
+        """Drop tombstones from the scan list, remembering where old cursors land"""
+        kv = self._kv
+        keys = self._keys
+        # The new list is the dict order, where a key sits at its latest
+        # insert, i.e. its last occurrence in the old list
+        last = bytearray(len(keys))
+        seen = set()
+        for i in range(len(keys) - 1, -1, -1):
+            key = keys[i]
+            if key in kv and key not in seen:
+                seen.add(key)
+                last[i] = 1
+        del seen
+        epoch_map = array('Q')
+        live = 0
+        for start in range(0, len(keys), SCAN_MAP_STRIDE):
+            epoch_map.append(live)
+            live += last.count(1, start, start + SCAN_MAP_STRIDE)
+        self._epoch_map = epoch_map
+        self._keys = list(kv)
+        self._keys_epoch += 1
+
+    def _rebuild_expiry_heap(self):
+        """Drop stale heap entries once they outnumber live TTLs"""
+        self._expiry_heap = [(expire_time, key) for key, expire_time in self._ttl.items()]
+        heapq.heapify(self._expiry_heap)
+
+
+_MISSING = object()
@@ -0,0 +1,104 @@
+import sys
+
+HASH_MAX_COMPACT_FIELDS = 128  # Fields a hash holds before moving to a dict
+HASH_MAX_COMPACT_VALUE = 64  # Longest field or value the compact encoding keeps
+HASH_OVERHEAD = 64  # Estimated bytes of the container itself
+HASH_FIELD_OVERHEAD = 16  # Estimated bytes per field besides the strings
+
+# A hash value has one of two encodings. Small hashes are a flat list
+# [field1, value1, field2, value2, ...], which costs two pointers per field
+# and is quick to scan at this size. Once a hash outgrows the limits above
+# it becomes a dict and stays one. Values are strings, or ints written by
+# HINCRBY.
+
+
+def is_hash(value):
+    return value.__class__ is list or value.__class__ is dict
+
+
+def new_hash(items=()):
+    """Build a hash from (field, value) pairs in the encoding that fits"""
+    h = []
+    for field, value in items:
+        h = hash_set(h, field, value)[0]
+    return h
+
+
+def hash_len(h):
+    return len(h) if h.__class__ is dict else len(h) // 2
+
+
+def hash_items(h):
+    if h.__class__ is dict:
+        return h.items()
+    return zip(h[::2], h[1::2])
+
+
+def hash_get(h, field):
+    if h.__class__ is dict:
+        return h.get(field)
+    i = _compact_index(h, field)
+    return None if i < 0 else h[i + 1]
+
+
+def hash_set(h, field, value):
+    """
+    Set a field. Returns (hash, added, delta): the hash, which is a new
+    object when the encoding changed, whether the field is new, and the
+    change in estimated size.
+    """
+    if h.__class__ is dict:
+        old = h.get(field)
+        h[field] = value
+    else:
+        i = _compact_index(h, field)
+        if i < 0:
+            old = None
+            h.append(field)
+            h.append(value)
+        else:
+            old = h[i + 1]
+            h[i + 1] = value
+        if (len(h) > 2 * HASH_MAX_COMPACT_FIELDS or len(field) > HASH_MAX_COMPACT_VALUE
+                or (value.__class__ is str and len(value) > HASH_MAX_COMPACT_VALUE)):
+            h = dict(zip(h[::2], h[1::2]))
+    delta = _field_size(field, value)
+    if old is not None:
+        delta -= _field_size(field, old)
+    return h, old is None, delta
+
+
+def hash_delete(h, field):
+    """Remove a field; returns the change in estimated size, or None if it wasn't there"""
+    if h.__class__ is dict:
+        if field not in h:
+            return None
+        old = h.pop(field)
+    else:
+        i = _compact_index(h, field)
+        if i < 0:
+            return None
+        old = h[i + 1]
+        del h[i:i + 2]
+    return -_field_size(field, old)
+
+
+def hash_sizeof(h):
+    return HASH_OVERHEAD + sum(_field_size(field, value) for field, value in hash_items(h))
+
+
+def _field_size(field, value):
+    return sys.getsizeof(field) + sys.getsizeof(value) + HASH_FIELD_OVERHEAD
+
+
+def _compact_index(h, field):
+    """Position of field in a compact hash, or -1. list.index scans in C; odd hits are values"""
+    start = 0
+    while True:
+        try:
+            i = h.index(field, start)
+        except ValueError:
+            return -1
+        if not i & 1:
+            return i
+        start = i + 1
@@ -0,0 +1,39 @@
+import sys
+from collections import deque
+from itertools import islice
+
+LIST_OVERHEAD = 64  # Estimated bytes of the deque itself
+LIST_ITEM_OVERHEAD = 8  # Estimated bytes per item besides the string
+
+# A list value is a deque of strings, so pushes and pops at either end are
+# O(1). Its class also keeps it apart from the flat lists small hashes use.
+
+
+def is_list(value):
+    return value.__class__ is deque
+
+
+def list_range(items, start, stop):
+    """Items from start to stop inclusive; negative indices count from the end, as in LRANGE"""
+    length = len(items)
+    if start < 0:
+        start = max(length + start, 0)
+    if stop < 0:
+        stop += length
+    stop = min(stop, length - 1)
+    if start > stop:
+        return []
+    if start > length // 2:
+        # Walk in from the right end, which is closer
+        tail = list(islice(reversed(items), length - 1 - stop, length - start))
+        tail.reverse()
+        return tail
+    return list(islice(items, start, stop + 1))
+
+
+def list_sizeof(items):
+    return LIST_OVERHEAD + sum(map(item_sizeof, items))
+
+
+def item_sizeof(value):
+    return sys.getsizeof(value) + LIST_ITEM_OVERHEAD
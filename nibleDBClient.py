@@ -1,7 +1,19 @@
 from TAGS import *
-from 
+from NimbleDB import Client, Error, CommandError, Disconnect, DEFAULT_PORT
+from database import format_float
+from hashType import hash_items, is_hash
+from snapshot import SnapshotReader, SnapshotError, is_snapshot
+from zsetType import SortedSet, is_zset
+from collections import deque
+import argparse
+import csv
+import json
+import math
 import os 
 import shlex
+import sys
+import threading
+import time
 from rich.console import Console 
 from rich.traceback import install
 
@@ -11,6 +23,13 @@ install()
 tag = tags()
 console = Console()
 
+PIPE_BATCH = 1000  # Commands encoded and written at a time by --pipe
+PIPE_WINDOW = 10000  # Replies --pipe lets go unread before it waits for them
+PIPE_BULK_PAIRS = 500  # Key/value pairs sent per BULK_SET
+PIPE_CHUNK = 1000  # Fields, items or members sent per HSET, RPUSH or ZADD
+PIPE_ERRORS_SHOWN = 10  # Failed records listed after an import
+PIPE_FORMATS = ('commands', 'csv', 'jsonl', 'dump')
+
 def print_return(message): 
     console.print(f"[bold cyan]{message}")
     return f"{message}"
@@ -29,7 +48,7 @@ def select():
     command = client.select_db(tag.tag_index[1])
     print_return(command)
     
-def list():
+def list_dbs():
     command = client.list_dbs()
     print_return(command)
 
@@ -67,7 +86,7 @@ def set_password():
         command = client.set_password()
         print_return(command) 
 
-def set(): 
+def set_key(): 
     try:
         key = tag.tag_index[1]
         value = tag.tag_index[2]
@@ -130,10 +149,10 @@ commands = {
     'password': set_password,
     'connect': select,
     'new_db': new_db, 
-    "dbs": list,
+    "dbs": list_dbs,
     "drop": drop_db,
     "get": get,
-    "set": set, 
+    "set": set_key, 
     "delete": delete,
     "exist": exists,
     "flush": flush,
@@ -163,9 +182,344 @@ def main_loop():
         except Exception as e:
             error(e)
 
+# Mass import. Every source yields (record, command) pairs, record being the
+# line or key number a failure is reported against and command a list of
+# arguments, or an Error for a record that couldn't be read.
+class PipeImport(object):
+    """
+    Streams commands to the server over one connection. They are encoded
+    and written batch at a time while a reader thread takes the replies off
+    the socket, so writing never waits for a round trip. At most window
+    replies can be outstanding; past that, writing waits for the reader.
+    """
+    def __init__(self, client, batch=PIPE_BATCH, window=PIPE_WINDOW):
+        self._client = client
+        self._batch = batch
+        self._slots = threading.Semaphore(window)
+        self._records = deque()  # Record of each command whose reply is outstanding
+        self._changed = threading.Condition()
+        self._writing = True
+        self.records = 0
+        self.sent = 0
+        self.replies = 0
+        self.errors = 0
+        self.first_errors = []
+        self.failure = None
+
+    def run(self, commands):
+        reader = threading.Thread(target=self._read_replies, daemon=True)
+        reader.start()
+        batch, records = [], []
+        try:
+            for record, command in commands:
+                if self.failure is not None:
+                    break
+                if command.__class__ is Error:
+                    self._failed(record, command.message)
+                    continue
+                if not self._slots.acquire(blocking=False):
+                    # Send what is queued, so the replies being waited for can come
+                    self._send(batch, records)
+                    batch, records = [], []
+                    self._slots.acquire()
+                batch.append(command)
+                records.append(record)
+                if len(batch) >= self._batch:
+                    self._send(batch, records)
+                    batch, records = [], []
+            self._send(batch, records)
+        except OSError as e:
+            self.failure = self.failure or e
+        finally:
+            with self._changed:
+                self._writing = False
+                self._changed.notify()
+            reader.join()
+
+    def count(self, entries):
+        """Pass a reader's entries through, counting the records read"""
+        for entry in entries:
+            self.records += 1
+            yield entry
+
+    def _send(self, batch, records):
+        if not batch:
+            return
+        with self._changed:
+            self._records.extend(records)
+            self._changed.notify()
+        client = self._client
+        client._protocol.write_responses(client._fh, batch)
+        self.sent += len(batch)
+
+    def _read_replies(self):
+        client = self._client
+        while True:
+            with self._changed:
+                while not self._records and self._writing:
+                    self._changed.wait()
+                if not self._records:
+                    return
+            try:
+                resp = client._protocol.handle_request(client._fh)
+            except (Disconnect, CommandError, OSError) as e:
+                self.failure = e if not isinstance(e, Disconnect) else ConnectionError("server closed the connection")
+                # Let a writer waiting for a free slot see the failure
+                self._slots.release(len(self._records) + 1)
+                return
+            record = self._records.popleft()
+            self.replies += 1
+            if resp.__class__ is Error:
+                self._failed(record, resp.message)
+            self._slots.release()
+
+    def _failed(self, record, message):
+        with self._changed:
+            self.errors += 1
+            if len(self.first_errors) < PIPE_ERRORS_SHOWN:
+                self.first_errors.append((record, message))
+
+
+def pipe_format(filename):
+    """Input format of a file, from its extension or, for dumps, its header"""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    if extension == '.json' or (filename != '-' and is_snapshot(filename)):
+        return 'dump'
+    return 'commands'
+
+
+def read_commands(lines):
+    """One command per line, as typed at the prompt; blank lines and lines starting with # or / are skipped"""
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line[0] in '#/':
+            continue
+        if '"' not in line and "'" not in line:
+            # Most lines need no shlex, which is many times slower than split()
+            yield number, line.split()
+            continue
+        try:
+            yield number, shlex.split(line)
+        except ValueError as e:
+            yield number, Error(f"Can't parse command: {e}")
+
+
+def read_csv(lines):
+    """key,value[,ttl] rows"""
+    for number, row in enumerate(csv.reader(lines), 1):
+        if not row:
+            continue
+        if len(row) == 2:
+            yield number, row[0], row[1], None
+        elif len(row) == 3 and row[2].strip().isdigit():
+            yield number, row[0], row[1], int(row[2]) or None
+        else:
+            yield number, Error("Expected key,value[,ttl]"), None, None
+
+
+def read_jsonl(lines):
+    """
+    One JSON value per line: an array is a command, an object a key with
+    "key", "value" and optionally "ttl" in seconds. An object or array
+    value becomes a hash or a list, as in a JSON dump.
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            yield number, Error(f"Invalid JSON: {e}"), None, None
+            continue
+        if item.__class__ is list and item:
+            yield number, [str(arg) for arg in item], None, None
+        elif item.__class__ is dict and 'key' in item and 'value' in item:
+            try:
+                ttl = int(math.ceil(float(item['ttl']))) if item.get('ttl') else None
+            except (TypeError, ValueError):
+                yield number, Error("ttl must be a number of seconds"), None, None
+                continue
+            yield number, str(item['key']), item['value'], ttl
+        else:
+            yield number, Error('Expected a command array or an object with "key" and "value"'), None, None
+
+
+def read_dump(filename):
+    """Keys of a binary snapshot or a JSON dump written by DUMP, BGSAVE or TIME_DUMP"""
+    if is_snapshot(filename):
+        with open(filename, 'rb') as f:
+            number = 0
+            for item in SnapshotReader(f):
+                if item[0] != 'key':
+                    continue
+                _, key, value, expire_at = item
+                number += 1
+                ttl = None
+                if expire_at is not None:
+                    ttl = int(math.ceil(expire_at - time.time()))
+                    if ttl <= 0:
+                        continue
+                if is_hash(value):
+                    value = dict(hash_items(value))
+                yield number, key, value, ttl
+        return
+    with open(filename) as f:
+        dump_data = json.load(f)
+    if dump_data.__class__ is not dict or 'data' not in dump_data:
+        raise ValueError(f"{filename} is not a NimbleDB dump")
+    ttls = dump_data.get('ttl', {})
+    items = [*dump_data['data'].items()]
+    for key, scores in dump_data.get('zsets', {}).items():
+        zset = SortedSet()
+        for member, score in scores.items():
+            zset.add(member, float(score))
+        items.append((key, zset))
+    for number, (key, value) in enumerate(items, 1):
+        ttl = ttls.get(key)
+        yield number, key, value, int(math.ceil(ttl)) if ttl else None
+
+
+def key_commands(entries):
+    """
+    Commands that write (record, key, value, ttl) entries. Plain values
+    are gathered into BULK_SETs of PIPE_BULK_PAIRS keys, followed by an
+    EXPIRE for each that has a ttl; hashes, lists and sorted sets replace
+    the key and are written PIPE_CHUNK fields, items or members at a time,
+    an empty one leaving the key deleted. An entry whose key is a command
+    or an Error passes straight through.
+    """
+    pairs = ['BULK_SET']
+    expiries = []
+    first = None
+    for record, key, value, ttl in entries:
+        if key.__class__ is not str:
+            yield from _flush_pairs(first, pairs, expiries)
+            pairs, expiries, first = ['BULK_SET'], [], None
+            yield record, key
+            continue
+        if value.__class__ is dict:
+            parts = [part for item in value.items() for part in item]
+            command = 'HSET'
+        elif value.__class__ in (list, deque):
+            parts = list(value) if value.__class__ is deque else value
+            command = 'RPUSH'
+        elif is_zset(value):
+            parts = [part for member, score in value for part in (repr(score), member)]
+            command = 'ZADD'
+        else:
+            if value.__class__ is float:
+                value = format_float(value)
+            elif value.__class__ not in (str, bytes):
+                value = str(value)
+            first = record if first is None else first
+            pairs += (key, value)
+            if ttl is not None:
+                expiries.append(['EXPIRE', key, str(ttl)])
+            if len(pairs) > 2 * PIPE_BULK_PAIRS:
+                yield from _flush_pairs(first, pairs, expiries)
+                pairs, expiries, first = ['BULK_SET'], [], None
+            continue
+
+        # Pending pairs go first, so a key written twice ends up as its last write
+        yield from _flush_pairs(first, pairs, expiries)
+        pairs, expiries, first = ['BULK_SET'], [], None
+        # The value replaces whatever the key held, so importing twice gives the same data
+        yield record, ['DELETE', key]
+        step = 2 if command != 'RPUSH' else 1
+        chunk = PIPE_CHUNK * step
+        for start in range(0, len(parts), chunk):
+            yield record, [command, key, *[str(part) if part.__class__ not in (str, bytes) else part
+                                           for part in parts[start:start + chunk]]]
+        if ttl is not None:
+            yield record, ['EXPIRE', key, str(ttl)]
+    yield from _flush_pairs(first, pairs, expiries)
+
+
+def _flush_pairs(record, pairs, expiries):
+    if len(pairs) > 1:
+        yield record, pairs
+        for expiry in expiries:
+            yield record, expiry
+
+
+def pipe_commands(filename, input_format, importer):
+    """(record, command) pairs read from a file, or from stdin for '-', counted by importer"""
+    if input_format == 'dump':
+        yield from key_commands(importer.count(read_dump(filename)))
+        return
+    lines = sys.stdin if filename == '-' else open(filename, newline='' if input_format == 'csv' else None)
+    try:
+        if input_format == 'commands':
+            yield from importer.count(read_commands(lines))
+        elif input_format == 'csv':
+            yield from key_commands(importer.count(read_csv(lines)))
+        else:
+            yield from key_commands(importer.count(read_jsonl(lines)))
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+
+def mass_import(client, filename, input_format=None, batch=PIPE_BATCH, window=PIPE_WINDOW):
+    """Send every command or key in filename and print how it went; returns the PipeImport"""
+    input_format = input_format or pipe_format(filename)
+    importer = PipeImport(client, batch, window)
+    started = time.perf_counter()
+    importer.run(pipe_commands(filename, input_format, importer))
+    elapsed = time.perf_counter() - started
+
+    rate = importer.records / elapsed if elapsed else 0
+    console.print(f"[bold green]Imported[/bold green] {importer.records:,} records from {filename} ({input_format}) "
+                  f"as {importer.sent:,} commands in {elapsed:.2f}s, {rate:,.0f} records/s")
+    for record, message in sorted(importer.first_errors):
+        error(f"record {record}: {message}")
+    if importer.errors:
+        console.print(f"[bold red]{importer.errors:,} errors[/bold red]"
+                      + (f", first {len(importer.first_errors)} shown" if importer.errors > len(importer.first_errors) else ""))
+    if importer.failure is not None:
+        error(f"Import stopped after {importer.replies:,} replies: {importer.failure}")
+    return importer
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="NimbleDB shell; with --pipe, a bulk importer")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix-socket', metavar='PATH', help="connect over this Unix socket instead of TCP")
+    parser.add_argument('--password', help="AUTH with this password first")
+    parser.add_argument('--db', type=int, default=0, help="database to work in")
+    parser.add_argument('--pipe', metavar='FILE',
+                        help="import a file of commands, CSV or JSONL key/values, or a dump; - reads commands from stdin")
+    parser.add_argument('--format', choices=PIPE_FORMATS,
+                        help="input format of --pipe; guessed from the file name and header by default")
+    parser.add_argument('--batch', type=int, default=PIPE_BATCH, help="commands written at a time")
+    parser.add_argument('--window', type=int, default=PIPE_WINDOW, help="replies left outstanding at most")
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
+    args = parse_args()
+    try:
+        client = Client(args.host, args.port, unix_socket_path=args.unix_socket)
+        if args.password is not None:
+            client.auth(args.password)
+        if args.db:
+            client.select_db(args.db)
+    except Exception as e:
+        console.print(f"[bold red]Failed to connect to database:[/bold red] {e}")
+        sys.exit(1)
+    if args.pipe is not None:
+        try:
+            importer = mass_import(client, args.pipe, args.format, args.batch, args.window)
+        except (OSError, ValueError, SnapshotError) as e:
+            error(e)
+            sys.exit(1)
+        sys.exit(1 if importer.errors or importer.failure is not None else 0)
     try:
-        client = Client()
         console.print("[bold green]Database Connected[/bold green]")
         main_loop()
     except Exception as e:
@@ -1,7 +1,25 @@
+from collections import namedtuple
+from io import BytesIO
+
 from database import *
 
+
+class CommandError(Exception): pass 
+class Disconnect(Exception): pass 
+
+Error = namedtuple('Error', ('message', ))
+
+INCOMPLETE = object()  # Returned by ProtocolParser.gets() while a frame is partial
+BULK_SPLIT_MIN = 8  # Bulk strings left in an array before the split fast path is used
+BULK_SPLIT_WINDOW = 1 << 18  # Bytes scanned per fast-path pass
+BULK_COPY_MAX = 512  # Shorter payloads are sliced, longer ones decoded in place
+_BULK_HEADERS = [b'$%d' % length for length in range(1024)]
+
+
 class ProtocolHandler(object):
-    def __init__(self):
+    def __init__(self, decode=True):
+        # With decode=False bulk strings are returned as the bytes received
+        self.decode = decode
         self.handlers = {
             "+": self.handle_simple_string, 
             "-": self.handle_error, 
@@ -36,8 +54,10 @@ class ProtocolHandler(object):
         length = int(socket_file.readline().decode('utf-8').rstrip('\r\n'))
         if length == -1:
             return None 
-        length += 2
-        return socket_file.read(length)[:-2].decode('utf-8')
+        # The CRLF is read apart so a large payload isn't copied to cut it off
+        data = socket_file.read(length)
+        socket_file.read(2)
+        return data.decode('utf-8') if self.decode else data
 
     def handle_array(self, socket_file):
         num_elements = int(socket_file.readline().decode('utf-8').rstrip('\r\n'))
@@ -50,12 +70,19 @@ class ProtocolHandler(object):
         return dict(zip(elements[::2], elements[1::2]))
     
     def write_response(self, socket_file, data):
-        buf = BytesIO()
-        self._write(buf, data)
-        buf.seek(0)
-        socket_file.write(buf.getvalue())
+        self.write_responses(socket_file, (data,))
+
+    def write_responses(self, socket_file, responses):
+        """Encode several replies and send them with a single flush"""
+        socket_file.write(self.encode(*responses))
         socket_file.flush()
 
+    def encode(self, *responses):
+        buf = BytesIO()
+        for data in responses:
+            self._write(buf, data)
+        return buf.getvalue()
+
     def _write(self, buf, data):
         if isinstance(data, str):
             data = data.encode('utf-8')
@@ -80,4 +107,190 @@ class ProtocolHandler(object):
         elif data is None:
             buf.write(b'$-1\r\n')
         else:
-            raise CommandError('unrecognized type: %s' % type(data))
\ No newline at end of file
+            raise CommandError('unrecognized type: %s' % type(data))
+
+
+class ProtocolParser(object):
+    """
+    Incremental parser over a receive buffer, wire-compatible with
+    ProtocolHandler. Bytes from the socket are fed in as they arrive and
+    gets() returns complete messages one at a time. CRLF offsets are found
+    with bytearray.find and payloads are decoded straight out of a
+    memoryview, so nothing is read byte by byte or copied before decoding.
+    Long runs of bulk strings inside an array, the shape of BULK_SET and
+    BULK_GET, are split on CRLF in a single pass instead.
+
+    When a message is not complete yet gets() returns INCOMPLETE. Arrays
+    and dicts that are partially parsed are kept on a stack, so the next
+    call resumes where the previous one stopped instead of starting over.
+
+    With raw=True bulk strings are returned as bytes, copied out of the
+    buffer once and never decoded, so binary payloads come through intact.
+    """
+    def __init__(self, raw=False):
+        self._raw = raw
+        self._buf = bytearray()
+        self._pos = 0
+        # Open arrays/dicts, innermost last: [items, expected, is_dict, slow]
+        self._stack = []
+
+    def feed(self, data):
+        if self._pos:
+            del self._buf[:self._pos]
+            self._pos = 0
+        self._buf += data
+
+    def has_pending(self):
+        """True while buffered bytes or a partial frame are waiting"""
+        return self._pos < len(self._buf) or bool(self._stack)
+
+    def buffered(self):
+        """Number of fed bytes not consumed by a complete value yet"""
+        return len(self._buf) - self._pos
+
+    def gets(self):
+        buf = self._buf
+        find = buf.find
+        size = len(buf)
+        pos = self._pos
+        stack = self._stack
+        # Shorter payloads are sliced then decoded, or just copied when raw
+        small = bytes if self._raw else bytearray.decode
+        # Innermost open container, cached in locals for the hot loop
+        top = stack[-1] if stack else None
+        if top is not None:
+            items, expected = top[0], top[1]
+
+        try:
+            while True:
+                # The last element of a container always takes the regular
+                # path below, so closing containers is handled in one place
+                if (top is not None and not top[3] and pos < size and buf[pos] == 36
+                        and expected - len(items) > BULK_SPLIT_MIN):
+                    start = pos
+                    pos, top[3] = self._take_bulk_strings(pos, items,
+                                                          expected - len(items) - 1)
+                    if pos != start:
+                        continue
+
+                end = find(b'\r\n', pos)
+                if end == -1:
+                    self._pos = pos
+                    return INCOMPLETE
+
+                marker = buf[pos]
+                if marker == 36:  # $
+                    length = int(buf[pos + 1:end])
+                    if length < 0:
+                        value = None
+                        pos = end + 2
+                    else:
+                        start = end + 2
+                        stop = start + length
+                        if stop + 2 > size:
+                            self._pos = pos
+                            return INCOMPLETE
+                        value = (small(buf[start:stop])
+                                 if length < BULK_COPY_MAX else
+                                 self._decode(buf, start, stop))
+                        pos = stop + 2
+                elif marker == 42 and top is None:  # *
+                    # A top-level array is a request; read short ones in one
+                    # tight loop and only fall back to the stack when they
+                    # hold something else or are not complete yet. Long ones
+                    # go straight to the stack and the split fast path.
+                    count = int(buf[pos + 1:end])
+                    pos = end + 2
+                    value = []
+                    if count <= BULK_SPLIT_MIN:
+                        for _ in range(count):
+                            if pos >= size or buf[pos] != 36:
+                                break
+                            end = find(b'\r\n', pos)
+                            if end == -1:
+                                break
+                            length = int(buf[pos + 1:end])
+                            start = end + 2
+                            stop = start + length
+                            if length < 0 or stop + 2 > size:
+                                break
+                            value.append(small(buf[start:stop])
+                                         if length < BULK_COPY_MAX else
+                                         self._decode(buf, start, stop))
+                            pos = stop + 2
+                        else:
+                            self._pos = pos
+                            return value
+                    items, expected = value, count
+                    top = [items, expected, False, False]
+                    stack.append(top)
+                    continue
+                elif marker == 42 or marker == 37:  # * or %
+                    count = int(buf[pos + 1:end])
+                    pos = end + 2
+                    if marker == 37:
+                        count *= 2
+                    if count > 0:
+                        items, expected = [], count
+                        top = [items, expected, marker == 37, False]
+                        stack.append(top)
+                        continue
+                    value = {} if marker == 37 else []
+                elif marker == 43:  # +
+                    value = buf[pos + 1:end].decode('utf-8')
+                    pos = end + 2
+                elif marker == 45:  # -
+                    value = Error(buf[pos + 1:end].decode('utf-8'))
+                    pos = end + 2
+                elif marker == 58:  # :
+                    value = int(buf[pos + 1:end])
+                    pos = end + 2
+                else:
+                    raise CommandError('bad request')
+
+                # Attach the value to the innermost open container, closing
+                # every container it completes on the way out
+                while top is not None:
+                    items.append(value)
+                    if len(items) < expected:
+                        break
+                    stack.pop()
+                    value = dict(zip(items[::2], items[1::2])) if top[2] else items
+                    top = stack[-1] if stack else None
+                    if top is not None:
+                        items, expected = top[0], top[1]
+                else:
+                    self._pos = pos
+                    return value
+        except (ValueError, UnicodeDecodeError):
+            raise CommandError('invalid protocol')
+
+    def _decode(self, buf, start, stop):
+        # Decode large payloads in place rather than slicing a copy first
+        with memoryview(buf) as view:
+            if self._raw:
+                return bytes(view[start:stop])
+            return str(view[start:stop], 'utf-8')
+
+    def _take_bulk_strings(self, pos, items, count):
+        """
+        Consume up to count complete bulk strings starting at pos with one
+        split over the buffered bytes. A pair is only accepted when its
+        header matches the payload length, so a payload that itself
+        contains CRLF ends the run and is left to the regular path.
+        Returns the new offset and whether the run hit such a pair.
+        """
+        parts = self._buf[pos:pos + BULK_SPLIT_WINDOW].split(b'\r\n', 2 * count)
+        headers = _BULK_HEADERS
+        append = items.append
+        convert = bytes if self._raw else bytearray.decode
+        # Only pairs followed by a CRLF are complete; the last part is the
+        # unsplit remainder
+        for i in range(0, len(parts) - 2, 2):
+            header, payload = parts[i], parts[i + 1]
+            length = len(payload)
+            if header != (headers[length] if length < len(headers) else b'$%d' % length):
+                return pos, True
+            append(convert(payload))
+            pos += len(header) + length + 4
+        return pos, False
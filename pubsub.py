@@ -0,0 +1,136 @@
+import fnmatch
+import re
+
+from gevent.event import Event
+
+from protocolHandler import *
+
+PUBSUB_OUTPUT_LIMIT = 8 * 1024 * 1024  # Bytes queued for a subscriber before it is dropped
+
+
+class Subscriber(object):
+    """
+    Output side of a connection in push mode. Replies and published
+    messages are queued as encoded bytes and a writer greenlet sends them
+    in order, so publishing never waits on a subscriber's socket. Bytes
+    queued or being sent are bounded by limit; a subscriber that falls
+    further behind is closed instead of being allowed to grow.
+    """
+    def __init__(self, address, limit=PUBSUB_OUTPUT_LIMIT):
+        self.address = address
+        self.limit = limit
+        self.channels = set()
+        self.patterns = set()
+        self.pending = 0  # Bytes queued or being sent
+        self.closed = False
+        self.conn = None
+        self.writer = None
+        self._chunks = []
+        self._ready = Event()
+
+    @property
+    def subscriptions(self):
+        return len(self.channels) + len(self.patterns)
+
+    def push(self, data):
+        """Queue encoded bytes; returns False if the subscriber is closed or now over its limit"""
+        if self.closed:
+            return False
+        self.pending += len(data)
+        if self.pending > self.limit:
+            self.close()
+            return False
+        self._chunks.append(data)
+        self._ready.set()
+        return True
+
+    def take(self):
+        """Wait for queued bytes and return them joined; None once closed"""
+        while not self._chunks:
+            if self.closed:
+                return None
+            self._ready.clear()
+            self._ready.wait()
+        chunks, self._chunks = self._chunks, []
+        return b''.join(chunks)
+
+    def sent(self, size):
+        self.pending -= size
+
+    def close(self):
+        self.closed = True
+        self._chunks = []
+        self._ready.set()
+
+
+class PubSub(object):
+    """
+    Channel and pattern subscriptions of every connection. A published
+    message is encoded once for its channel and once for each matching
+    pattern, and the same bytes are queued to every subscriber.
+    """
+    def __init__(self):
+        self.channels = {}  # channel -> set of Subscribers
+        self.patterns = {}  # pattern -> [match function, set of Subscribers]
+        self._protocol = ProtocolHandler()
+
+    def subscribe(self, subscriber, channel):
+        self.channels.setdefault(channel, set()).add(subscriber)
+        subscriber.channels.add(channel)
+
+    def unsubscribe(self, subscriber, channel):
+        subscribers = self.channels.get(channel)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.channels[channel]
+        subscriber.channels.discard(channel)
+
+    def psubscribe(self, subscriber, pattern):
+        if pattern not in self.patterns:
+            self.patterns[pattern] = [re.compile(fnmatch.translate(pattern)).match, set()]
+        self.patterns[pattern][1].add(subscriber)
+        subscriber.patterns.add(pattern)
+
+    def punsubscribe(self, subscriber, pattern):
+        entry = self.patterns.get(pattern)
+        if entry is not None:
+            entry[1].discard(subscriber)
+            if not entry[1]:
+                del self.patterns[pattern]
+        subscriber.patterns.discard(pattern)
+
+    def remove(self, subscriber):
+        """Drop every subscription of a subscriber"""
+        for channel in list(subscriber.channels):
+            self.unsubscribe(subscriber, channel)
+        for pattern in list(subscriber.patterns):
+            self.punsubscribe(subscriber, pattern)
+
+    def publish(self, channel, message):
+        """
+        Queue a message to the subscribers of channel and of every pattern
+        matching it. Returns the number of deliveries and the subscribers
+        that went over their limit, which are no longer subscribed.
+        """
+        receivers = 0
+        dropped = []
+        subscribers = self.channels.get(channel)
+        if subscribers:
+            payload = self._protocol.encode(['message', channel, message])
+            for subscriber in subscribers:
+                if subscriber.push(payload):
+                    receivers += 1
+                else:
+                    dropped.append(subscriber)
+        for pattern, (match, subscribers) in self.patterns.items():
+            if match(channel):
+                payload = self._protocol.encode(['pmessage', pattern, channel, message])
+                for subscriber in subscribers:
+                    if subscriber.push(payload):
+                        receivers += 1
+                    elif subscriber not in dropped:
+                        dropped.append(subscriber)
+        for subscriber in dropped:
+            self.remove(subscriber)
+        return receivers, dropped
@@ -0,0 +1,74 @@
+import os
+
+from gevent.event import Event
+
+from protocolHandler import *
+
+REPL_BACKLOG_SIZE = 1024 * 1024  # Bytes of the write stream kept for partial resyncs
+REPL_PING_INTERVAL = 10  # Seconds of quiet before the master pings its replicas
+REPL_TIMEOUT = 60  # Seconds a replica waits on a silent master before reconnecting
+REPL_RETRY_INTERVAL = 1  # Seconds between attempts to reach the master
+
+
+class ReplicationBacklog(object):
+    """
+    The tail of a master's stream of write commands, in the wire format of
+    the append log. Every byte ever appended has an offset and the last
+    size bytes are kept, so a replica that loses its connection can ask
+    for the stream from its offset on and skip a full sync as long as
+    that offset is still here. The replication ID names the history the
+    offsets count; a new backlog starts a new history.
+    """
+    def __init__(self, size=REPL_BACKLOG_SIZE):
+        self.replid = os.urandom(20).hex()
+        self.size = size
+        self.start = 0  # Offset of the first byte kept
+        self.offset = 0  # Offset just past the last byte appended
+        self._buf = bytearray()
+        self._protocol = ProtocolHandler()
+        self._db = None  # Database the stream is on by its last SELECT
+        self._wakeup = Event()
+        self._waiting = 0
+
+    def append(self, db_id, *command):
+        """Add a write command; db_id None marks a server-wide command"""
+        if db_id is not None and db_id != self._db:
+            self._write(self._protocol.encode(['SELECT', str(db_id)]))
+            self._db = db_id
+        self._write(self._protocol.encode(list(command)))
+
+    def reselect(self):
+        """Make the next command carry a SELECT, for a replica joining the stream here"""
+        self._db = None
+
+    def covers(self, replid, offset):
+        """True if the stream from offset on is still kept"""
+        return replid == self.replid and self.start <= offset <= self.offset
+
+    def read(self, offset):
+        """Everything appended from offset on"""
+        return bytes(self._buf[offset - self.start:])
+
+    def wait(self, offset, timeout=None):
+        """Wait until the stream grows past offset; returns False on timeout"""
+        if self.offset > offset:
+            return True
+        self._waiting += 1
+        try:
+            return self._wakeup.wait(timeout)
+        finally:
+            self._waiting -= 1
+
+    def _write(self, data):
+        buf = self._buf
+        buf += data
+        self.offset += len(data)
+        excess = len(buf) - self.size
+        if excess > 0:
+            # Deleting from the front of a bytearray doesn't move the rest
+            del buf[:excess]
+            self.start += excess
+        if self._waiting:
+            # Every waiter wakes on the old event; later ones get a fresh one
+            wakeup, self._wakeup = self._wakeup, Event()
+            wakeup.set()
@@ -0,0 +1,154 @@
+import time
+from collections import deque
+from itertools import islice
+
+LATENCY_BUCKETS = 64  # Powers of two of microseconds; enough that no duration needs clamping
+SLOWLOG_THRESHOLD = 10000  # Microseconds a command runs before it is logged as slow
+SLOWLOG_MAX_LEN = 128  # Slow log entries kept
+SLOWLOG_DEFAULT_COUNT = 10  # Entries SLOWLOG GET returns unless told otherwise
+SLOWLOG_MAX_ARGS = 32  # Arguments kept per entry, the command included
+SLOWLOG_MAX_ARG_LEN = 128  # Characters kept per argument
+SLOWLOG_HIDDEN = '(password)'  # Shown in place of a password argument
+
+
+class CommandStats(object):
+    """
+    Calls, errors and time spent in one command. Latencies go into
+    power-of-two buckets: bucket i counts calls that took under 2**i
+    microseconds but not under 2**(i-1), so recording one costs an int
+    bit_length() and no allocation.
+    """
+    __slots__ = ('calls', 'errors', 'usec', 'buckets')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.usec = 0
+        self.buckets = [0] * LATENCY_BUCKETS
+
+    def info(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'usec': self.usec,
+            'usec_per_call': f"{self.usec / self.calls:.2f}" if self.calls else '0',
+            # Calls faster than each bound, skipping empty buckets
+            'latency': {f"<{1 << i}us": count for i, count in enumerate(self.buckets) if count},
+        }
+
+
+class ServerStats(object):
+    """
+    Counters behind INFO. Everything but the gauges, such as the number of
+    connected clients, starts again from zero on reset().
+    """
+    def __init__(self, known_commands):
+        self._known = known_commands
+        self.connected_clients = 0
+        self.reset()
+
+    def reset(self):
+        self.since = time.time()
+        self.commands = {}
+        self.unknown_commands = 0
+        self.connections_received = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.expired_keys = 0
+        self.evicted_keys = 0
+        self.invalidations = 0
+        self.dumps = 0
+        self.dump_failures = 0
+        self.last_dump_time = 0
+        self.last_dump_duration = 0.0
+        self.last_dump_keys = 0
+
+    def record(self, command, seconds, failed):
+        """Count one run of a command that took seconds"""
+        entry = self.commands.get(command)
+        if entry is None:
+            # Only real commands get an entry, so junk names can't grow the table
+            if command not in self._known:
+                self.unknown_commands += 1
+                return
+            entry = self.commands[command] = CommandStats()
+        usec = int(seconds * 1000000)
+        entry.calls += 1
+        entry.usec += usec
+        entry.buckets[usec.bit_length()] += 1
+        if failed:
+            entry.errors += 1
+
+    def record_dump(self, ok, seconds, keys=0):
+        if not ok:
+            self.dump_failures += 1
+            return
+        self.dumps += 1
+        self.last_dump_time = int(time.time())
+        self.last_dump_duration = seconds
+        self.last_dump_keys = keys
+
+    def info(self):
+        return {
+            'stats_since': int(self.since),
+            'connected_clients': self.connected_clients,
+            'total_connections_received': self.connections_received,
+            'total_commands_processed': sum(entry.calls for entry in self.commands.values()),
+            'total_errors': sum(entry.errors for entry in self.commands.values()),
+            'unknown_commands': self.unknown_commands,
+            'bytes_received': self.bytes_received,
+            'bytes_sent': self.bytes_sent,
+            'expired_keys': self.expired_keys,
+            'evicted_keys': self.evicted_keys,
+            'invalidations': self.invalidations,
+            'dumps': self.dumps,
+            'dump_failures': self.dump_failures,
+            'last_dump_time': self.last_dump_time,
+            'last_dump_duration': f"{self.last_dump_duration:.3f}",
+            'last_dump_keys': self.last_dump_keys,
+            'commands': {command: entry.info() for command, entry in sorted(self.commands.items())},
+        }
+
+
+class SlowLog(object):
+    """
+    The last max_len commands that ran for at least threshold microseconds,
+    newest first. A negative threshold turns the log off. Arguments are cut
+    down as they are captured, so a huge BULK_SET does not stay in memory;
+    passwords are blanked out by the server before they get here.
+    """
+    def __init__(self, threshold=SLOWLOG_THRESHOLD, max_len=SLOWLOG_MAX_LEN):
+        # Kept in seconds so the hot path compares it straight to a timing
+        self.threshold = float('inf') if threshold < 0 else threshold / 1000000
+        self._entries = deque(maxlen=max_len)
+        self._next_id = 0
+
+    def add(self, seconds, args, address, db_id):
+        if len(args) > SLOWLOG_MAX_ARGS:
+            args = args[:SLOWLOG_MAX_ARGS - 1] + [f"... ({len(args) - SLOWLOG_MAX_ARGS + 1} more arguments)"]
+        shown = []
+        for arg in args:
+            arg = arg.decode('utf-8', 'backslashreplace') if arg.__class__ is bytes else str(arg)
+            if len(arg) > SLOWLOG_MAX_ARG_LEN:
+                arg = f"{arg[:SLOWLOG_MAX_ARG_LEN]}... ({len(arg) - SLOWLOG_MAX_ARG_LEN} more characters)"
+            shown.append(arg)
+        if isinstance(address, tuple):
+            address = f"{address[0]}:{address[1]}"
+        self._entries.appendleft({
+            'id': self._next_id,
+            'time': int(time.time()),
+            'duration_us': int(seconds * 1000000),
+            'command': shown,
+            'client': address or '',
+            'db': db_id,
+        })
+        self._next_id += 1
+
+    def get(self, count=SLOWLOG_DEFAULT_COUNT):
+        return list(islice(self._entries, count))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def reset(self):
+        self._entries.clear()
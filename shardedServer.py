@@ -0,0 +1,632 @@
+"""
+Multi-process NimbleDB: one worker process per core, each owning a hash
+partition of the keys in every database.
+
+    python shardedServer.py [--workers 4] [--port 7100] [--password secret]
+"""
+import argparse
+import datetime
+import os
+import signal
+import socket
+import time
+import zlib
+from collections import deque
+
+import gevent
+import gevent.socket
+from gevent.event import AsyncResult
+from gevent.lock import Semaphore
+from gevent.pool import Pool
+from gevent.server import StreamServer
+
+from NimbleDB import *
+
+REUSE_PORT = hasattr(socket, 'SO_REUSEPORT')  # Workers accept on their own listening socket
+LISTEN_BACKLOG = 1024
+RESTART_DELAY = 1  # Seconds before a worker that died is started again
+
+# How the router spreads commands over the shards
+KEY_COMMANDS = frozenset(['GET', 'SET', 'DELETE', 'EXISTS', 'DEL_TIME',  # Sent to the owner of the key
+                          'INCR', 'INCRBY', 'DECR', 'DECRBY', 'INCRBYFLOAT',
+                          'HSET', 'HGET', 'HMGET', 'HGETALL', 'HDEL', 'HINCRBY', 'HLEN',
+                          'HEXISTS', 'EXPIRE',
+                          'LPUSH', 'RPUSH', 'LPOP', 'RPOP', 'LRANGE', 'LLEN',
+                          'ZADD', 'ZINCRBY', 'ZRANGE', 'ZREVRANGE', 'ZRANGEBYSCORE', 'ZRANK',
+                          'ZREVRANK', 'ZREM', 'ZSCORE', 'ZCARD'])
+BLOCKING_COMMANDS = frozenset(['BLPOP', 'BRPOP'])  # Sent to the key owner on a connection of their own
+BROADCAST_COMMANDS = frozenset(['SET_PASSWORD', 'DROP_DB', 'FLUSH', 'TIME_DUMP', 'REWRITE_LOG', 'STATS'])
+FILE_COMMANDS = frozenset(['DUMP', 'BGSAVE', 'LOAD'])  # Broadcast with a file per shard
+STATS_COMMANDS = frozenset(['MEMORY_STATS', 'INFO'])  # Counters summed over the shards
+STATS_LATEST_FIELDS = frozenset(['uptime_seconds', 'stats_since', 'last_dump_time'])  # Merged with max()
+# Replication, transactions, pub/sub and key tracking only work within a single server
+UNSHARDED_COMMANDS = frozenset(['REPLICAOF', 'PSYNC', 'MULTI', 'EXEC', 'DISCARD', 'WATCH', 'UNWATCH',
+                                'SUBSCRIBE', 'PSUBSCRIBE', 'UNSUBSCRIBE', 'PUNSUBSCRIBE', 'PUBLISH', 'CLIENT'])
+
+
+def shard_for(key, shards):
+    """Shard owning a key. crc32 rather than hash() so the answer is the same in every process and across restarts"""
+    return zlib.crc32(key.encode('utf-8')) % shards
+
+
+def shard_filename(filename, index):
+    """File a shard uses for filename: data.ndb -> data.shard2.ndb"""
+    root, ext = os.path.splitext(filename)
+    return f"{root}.shard{index}{ext}"
+
+
+def _ready(value):
+    return lambda: value
+
+
+def _merge_stats(totals, stats):
+    """Fold one shard's MEMORY_STATS or INFO reply into totals"""
+    for name, value in stats.items():
+        if isinstance(value, dict):
+            _merge_stats(totals.setdefault(name, {}), value)
+        elif isinstance(value, int) and name in STATS_LATEST_FIELDS:
+            totals[name] = max(totals.get(name, 0), value)
+        elif isinstance(value, int):
+            totals[name] = totals.get(name, 0) + value
+        else:
+            totals[name] = value
+
+
+class PeerLink(object):
+    """
+    Connection from a worker to another shard's internal listener, shared by
+    all of the worker's clients. Requests are pipelined: call() queues a
+    request and returns an AsyncResult, flush() writes out everything
+    queued, and a reader greenlet hands out the replies in order.
+    """
+    def __init__(self, address, password=None):
+        self._sock = gevent.socket.create_connection(address)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._protocol = ProtocolHandler()
+        self._out = []
+        self._waiting = deque()  # One AsyncResult per request written, None for bookkeeping
+        self._write_lock = Semaphore()
+        self._db = 0  # Database the peer session is on after everything queued
+        self.closed = False
+        if password is not None:
+            self._queue(['AUTH', password], None)
+        self._reader = gevent.spawn(self._read_replies)
+
+    def call(self, db_id, command):
+        if db_id != self._db:
+            self._queue(['SELECT', str(db_id)], None)
+            self._db = db_id
+        result = AsyncResult()
+        self._queue(command, result)
+        return result
+
+    def flush(self):
+        # The buffer is taken under the lock so bytes go out in queue order
+        with self._write_lock:
+            if not self._out or self.closed:
+                return
+            data = b''.join(self._out)
+            self._out = []
+            try:
+                self._sock.sendall(data)
+            except OSError as exc:
+                self._fail(exc)
+
+    def _queue(self, command, result):
+        self._out.append(self._protocol.encode(command))
+        self._waiting.append(result)
+
+    def _read_replies(self):
+        parser = ProtocolParser()
+        try:
+            while True:
+                data = self._sock.recv(RECV_BUFFER_SIZE)
+                if not data:
+                    raise ConnectionError("connection closed")
+                parser.feed(data)
+                while True:
+                    reply = parser.gets()
+                    if reply is INCOMPLETE:
+                        break
+                    result = self._waiting.popleft()
+                    if result is not None:
+                        result.set(reply)
+        except (OSError, CommandError) as exc:
+            self._fail(exc)
+
+    def _fail(self, exc):
+        self.closed = True
+        self._sock.close()
+        while self._waiting:
+            result = self._waiting.popleft()
+            if result is not None:
+                result.set(Error(f"Shard unavailable: {exc}"))
+
+
+class ShardRouter(object):
+    """
+    Front end of one worker. It speaks the client protocol, runs commands
+    for keys its own shard owns on the local Server, and forwards the rest
+    to their owners over PeerLinks. Routing a request gives back a callable
+    that produces its reply, so a pipelined batch reaches every shard it
+    touches before the first reply is waited on.
+    """
+    def __init__(self, index, server, peers):
+        self.index = index
+        self.server = server
+        self.peers = peers
+        self.shards = len(peers)
+        self._links = {}
+
+    def connection_handler(self, conn, address):
+        stats = self.server._stats
+        stats.connections_received += 1
+        stats.connected_clients += 1
+        try:
+            self._serve_connection(conn, address)
+        finally:
+            stats.connected_clients -= 1
+
+    def _serve_connection(self, conn, address):
+        parser = ProtocolParser()
+        session_state = {'authenticated': False, 'current_db': 0, 'address': address}
+        stats = self.server._stats
+
+        while True:
+            data = conn.recv(RECV_BUFFER_SIZE)
+            if not data:
+                break
+            stats.bytes_received += len(data)
+            parser.feed(data)
+
+            replies = []
+            while True:
+                try:
+                    request = parser.gets()
+                except CommandError as exc:
+                    replies.append(_ready(Error(exc.args[0])))
+                    self._send_replies(conn, replies)
+                    return
+                if request is INCOMPLETE:
+                    break
+
+                try:
+                    replies.append(self.route(request, session_state))
+                except CommandError as exc:
+                    replies.append(_ready(Error(exc.args[0])))
+
+                if len(replies) >= MAX_PIPELINE_BATCH:
+                    self._send_replies(conn, replies)
+                    replies = []
+
+            if replies:
+                self._send_replies(conn, replies)
+
+    def _send_replies(self, conn, replies):
+        self._flush_links()
+        self.server._send_responses(conn, [reply() for reply in replies])
+
+    def _flush_links(self):
+        for link in list(self._links.values()):
+            link.flush()
+
+    def route(self, data, session_state):
+        if not isinstance(data, list):
+            try:
+                data = data.split()
+            except AttributeError:
+                raise CommandError('Request must be list or simple string.')
+        if not data:
+            raise CommandError('Missing command')
+
+        command = data[0].upper()
+        db_id = session_state['current_db']
+        spec = COMMAND_TABLE.get(command)
+        if (self.server._password is not None and spec is not None and 'protected' in spec.flags
+                and not session_state['authenticated']):
+            return _ready(Error("Authentication required"))
+
+        if command in KEY_COMMANDS and len(data) >= 2:
+            if command == 'GET' and data[1] in ('*', '**'):
+                return self._gather_all(data[1], db_id)
+            return self._call(shard_for(data[1], self.shards), data, db_id)
+        elif command == 'BULK_GET' and len(data) >= 2:
+            if len(data) == 2 and data[1] in ('*', '**'):
+                return self._gather_all(data[1], db_id)
+            return self._bulk_get(data[1:], db_id)
+        elif command == 'BULK_SET' and len(data) >= 3:
+            return self._bulk_set(data[1:], db_id)
+        elif command in BLOCKING_COMMANDS and len(data) >= 3:
+            return self._blocking_pop(data, db_id)
+        elif command == 'SCAN' and len(data) >= 2:
+            return self._scan(data, db_id)
+        elif command == 'NEW_DB':
+            return self._new_db(data)
+        elif command == 'LIST_DBS':
+            return self._list_dbs()
+        elif command in BROADCAST_COMMANDS:
+            return self._broadcast(data, db_id)
+        elif command in FILE_COMMANDS:
+            return self._file_command(data, db_id)
+        elif command == 'BGSAVE_STATUS':
+            calls = self._call_all(data, db_id)
+            return lambda: [reply() for reply in calls]
+        elif command in STATS_COMMANDS:
+            return self._merged_stats(data)
+        elif command == 'SLOWLOG' and len(data) >= 2:
+            return self._slowlog(data)
+        elif command in UNSHARDED_COMMANDS:
+            return _ready(Error(f"{command} is not supported by the sharded server"))
+        # AUTH, SELECT, and anything malformed or unknown, which the local
+        # shard answers with the same error a single server would
+        return _ready(self._local(data, session_state))
+
+    def _local(self, data, session_state):
+        try:
+            return self.server.get_response(data, session_state)
+        except CommandError as exc:
+            return Error(exc.args[0])
+
+    def _call(self, shard, data, db_id):
+        """Send a command to one shard; returns a callable producing its reply"""
+        if shard == self.index:
+            return _ready(self._local(data, {'authenticated': True, 'current_db': db_id}))
+        link = self._links.get(shard)
+        if link is None or link.closed:
+            try:
+                link = self._links[shard] = PeerLink(self.peers[shard], self.server._password)
+            except OSError as exc:
+                return _ready(Error(f"Shard unavailable: {exc}"))
+        return link.call(db_id, data).get
+
+    def _blocking_pop(self, data, db_id):
+        """
+        BLPOP and BRPOP can wait indefinitely, so they never go over a shared
+        PeerLink, where they would hold up every request queued behind them.
+        All of their keys must live on one shard.
+        """
+        shards = {shard_for(key, self.shards) for key in data[1:-1]}
+        if len(shards) > 1:
+            return _ready(Error(f"{data[0].upper()} keys must all live on the same shard"))
+        shard = shards.pop()
+        if shard != self.index:
+            return lambda: self._call_blocking(shard, data, db_id)
+        session_state = {'authenticated': True, 'current_db': db_id}
+        resp = self._local(data, session_state)
+        if resp.__class__ is Blocked:
+            return lambda: self.server._wait_blocked(data, resp, session_state)
+        return _ready(resp)
+
+    def _call_blocking(self, shard, data, db_id):
+        """Run one command on a shard over a connection opened just for it"""
+        protocol = ProtocolHandler()
+        setup = []
+        if self.server._password is not None:
+            setup.append(['AUTH', self.server._password])
+        if db_id:
+            setup.append(['SELECT', str(db_id)])
+        try:
+            sock = gevent.socket.create_connection(self.peers[shard])
+        except OSError as exc:
+            return Error(f"Shard unavailable: {exc}")
+        try:
+            sock.sendall(protocol.encode(*(setup + [data])))
+            parser = ProtocolParser()
+            replies = []
+            while len(replies) <= len(setup):
+                reply = parser.gets()
+                if reply is not INCOMPLETE:
+                    if isinstance(reply, Error):
+                        return reply
+                    replies.append(reply)
+                    continue
+                chunk = sock.recv(RECV_BUFFER_SIZE)
+                if not chunk:
+                    return Error("Shard unavailable: connection closed")
+                parser.feed(chunk)
+            return replies[-1]
+        except OSError as exc:
+            return Error(f"Shard unavailable: {exc}")
+        finally:
+            sock.close()
+
+    def _call_all(self, data, db_id):
+        return [self._call(shard, data, db_id) for shard in range(self.shards)]
+
+    def _broadcast(self, data, db_id):
+        calls = self._call_all(data, db_id)
+        return lambda: self._combine([reply() for reply in calls])
+
+    def _combine(self, replies):
+        """One reply for a broadcast: the first error, the sum of counts, or the local shard's reply"""
+        for reply in replies:
+            if isinstance(reply, Error):
+                return reply
+        if all(isinstance(reply, int) for reply in replies):
+            return sum(replies)
+        return replies[self.index]
+
+    def _gather_all(self, pattern, db_id):
+        calls = self._call_all(['GET', pattern], db_id)
+
+        def reply():
+            replies = [call() for call in calls]
+            for part in replies:
+                if isinstance(part, Error):
+                    return part
+            if pattern == '**':
+                merged = {}
+                for part in replies:
+                    merged.update(part)
+                return merged
+            return [value for part in replies for value in part]
+        return reply
+
+    def _bulk_get(self, keys, db_id):
+        positions = {}
+        for position, key in enumerate(keys):
+            positions.setdefault(shard_for(key, self.shards), []).append(position)
+        calls = [(self._call(shard, ['BULK_GET'] + [keys[p] for p in owned], db_id), owned)
+                 for shard, owned in positions.items()]
+
+        def reply():
+            result = [None] * len(keys)
+            for call, owned in calls:
+                values = call()
+                if isinstance(values, Error):
+                    return values
+                for position, value in zip(owned, values):
+                    result[position] = value
+            return result
+        return reply
+
+    def _bulk_set(self, items, db_id):
+        owned = {}
+        for key, value in zip(items[::2], items[1::2]):
+            owned.setdefault(shard_for(key, self.shards), []).extend([key, value])
+        calls = [self._call(shard, ['BULK_SET'] + pairs, db_id) for shard, pairs in owned.items()]
+        return lambda: self._combine([call() for call in calls])
+
+    def _scan(self, data, db_id):
+        """
+        Walk the shards one after another. The global cursor packs the shard
+        into its low part: cursor = shard_cursor * shards + shard.
+        """
+        try:
+            cursor = int(data[1])
+        except ValueError:
+            return _ready(Error("Invalid cursor"))
+        if cursor < 0:
+            return _ready(Error("Invalid cursor"))
+        shard = cursor % self.shards
+        call = self._call(shard, ['SCAN', str(cursor // self.shards)] + data[2:], db_id)
+
+        def reply():
+            resp = call()
+            if isinstance(resp, Error):
+                return resp
+            next_cursor, keys = resp
+            if next_cursor:
+                return [next_cursor * self.shards + shard, keys]
+            return [shard + 1 if shard + 1 < self.shards else 0, keys]
+        return reply
+
+    def _new_db(self, data):
+        if len(data) > 1:
+            return self._broadcast(data, 0)
+        # Shard 0 picks the ID, so concurrent NEW_DBs can't hand out the same
+        # ID on different shards; the rest then create that exact ID
+        first = self._call(0, data, 0)
+
+        def reply():
+            resp = first()
+            if isinstance(resp, Error):
+                return resp
+            db_id = resp.split()[1]
+            calls = [self._call(shard, ['NEW_DB', db_id], 0) for shard in range(1, self.shards)]
+            self._flush_links()
+            return self._combine([resp] + [call() for call in calls])
+        return reply
+
+    def _list_dbs(self):
+        calls = self._call_all(['LIST_DBS'], 0)
+
+        def reply():
+            counts = {}
+            for resp in [call() for call in calls]:
+                if isinstance(resp, Error):
+                    return resp
+                for line in resp:  # "DB 1: 42 keys"
+                    name, keys = line.split(': ')
+                    counts[name] = counts.get(name, 0) + int(keys.split()[0])
+            return [f"{name}: {keys} keys" for name, keys in counts.items()]
+        return reply
+
+    def _merged_stats(self, data):
+        calls = self._call_all(data, 0)
+
+        def reply():
+            totals = {}
+            for resp in [call() for call in calls]:
+                if isinstance(resp, Error):
+                    return resp
+                _merge_stats(totals, resp)
+            for entry in totals.get('commands', {}).values():
+                entry['usec_per_call'] = f"{entry['usec'] / entry['calls']:.2f}" if entry['calls'] else '0'
+            return totals
+        return reply
+
+    def _slowlog(self, data):
+        """Every worker keeps its own slow log; GET merges them newest first"""
+        calls = self._call_all(data, 0)
+        if data[1].upper() != 'GET':
+            return lambda: self._combine([call() for call in calls])
+
+        def reply():
+            entries = []
+            for resp in [call() for call in calls]:
+                if isinstance(resp, Error):
+                    return resp
+                entries.extend(resp)
+            entries.sort(key=lambda entry: entry['time'], reverse=True)
+            return entries[:int(data[2]) if len(data) > 2 else SLOWLOG_DEFAULT_COUNT]
+        return reply
+
+    def _file_command(self, data, db_id):
+        """DUMP, BGSAVE and LOAD on every shard, each with its own file"""
+        slot = 2 if self.server._password is not None else 1
+        calls = []
+        for shard in range(self.shards):
+            command = list(data)
+            if len(command) > slot:
+                command[slot] = shard_filename(command[slot], shard)
+            calls.append(self._call(shard, command, db_id))
+
+        def reply():
+            replies = [call() for call in calls]
+            for resp in replies:
+                if isinstance(resp, Error):
+                    return resp
+            return replies
+        return reply
+
+
+class ShardedServer(object):
+    """
+    Runs one worker process per shard. Every worker holds a regular Server
+    for its partition of the keys, listening on a private localhost port,
+    and a ShardRouter on the public port. With SO_REUSEPORT each worker
+    binds the public port itself and the kernel spreads connections over
+    them; elsewhere the workers share one listening socket. Whichever
+    worker accepts a connection serves it, forwarding commands for other
+    shards' keys to their owners.
+
+    Each shard has its own append log and dump files (see shard_filename),
+    so the worker count must stay the same across restarts that reload
+    them. A worker that dies is started again, replaying its append log.
+    maxmemory is split evenly between the workers.
+    """
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, workers=None, max_clients=64,
+                 password=None, append_log=None, append_fsync='everysec', snapshot_compress=False,
+                 maxmemory=None, maxmemory_policy='noeviction', slowlog_threshold=SLOWLOG_THRESHOLD):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError("Sharded mode needs a platform with os.fork")
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.max_clients = max_clients
+        self._password = password
+        self._append_log = append_log
+        self._append_fsync = append_fsync
+        self._snapshot_compress = snapshot_compress
+        self._maxmemory = parse_memory(maxmemory) // self.workers if maxmemory is not None else None
+        self._maxmemory_policy = maxmemory_policy
+        self._slowlog_threshold = slowlog_threshold
+        # Internal listeners are bound up front so every worker knows every
+        # peer's address, and a restarted worker comes back on the same one
+        self._internal = [self._bind('127.0.0.1', 0) for _ in range(self.workers)]
+        self._peers = [sock.getsockname() for sock in self._internal]
+        if REUSE_PORT:
+            # Workers bind the public port themselves; fail here rather than
+            # in every worker if something else already holds it
+            self._bind(host, port, reuse_port=True).close()
+            self._public = None
+        else:
+            self._public = self._bind(host, port)
+        self._children = {}  # pid -> shard index
+        self._stopping = False
+
+    def _bind(self, host, port, reuse_port=False):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        sock.listen(LISTEN_BACKLOG)
+        return sock
+
+    def run(self):
+        current_time = datetime.datetime.now().strftime("%H:%M:%S")
+        table = Table(title="[bold red]RedDB[/bold red] is running (sharded)..")
+        table.add_row("Start Time:", f"[bold blue]{current_time}[/bold blue]")
+        table.add_row("Port:", f"[bold yellow]{self.host}:[/bold yellow][bold green]{self.port}[/bold green]")
+        table.add_row("Workers:", f"[bold cyan]{self.workers}[/bold cyan]")
+        table.add_row(
+            "Password protection:",
+            "[bold green]Enabled[/bold green]" if self._password else "[bold red]Disabled[/bold red]"
+        )
+        console.print(table)
+
+        for index in range(self.workers):
+            self._spawn(index)
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        try:
+            while self._children:
+                pid, status = os.wait()
+                index = self._children.pop(pid, None)
+                if index is not None and not self._stopping:
+                    console.print(f"Worker {index} exited with status {status}, restarting")
+                    time.sleep(RESTART_DELAY)
+                    self._spawn(index)
+        except KeyboardInterrupt:
+            self.stop()
+            while self._children:
+                self._children.pop(os.wait()[0], None)
+
+    def stop(self):
+        self._stopping = True
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid:
+            self._children[pid] = index
+            return
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            self._run_worker(index)
+        finally:
+            os._exit(1)
+
+    def _run_worker(self, index):
+        gevent.reinit()
+        for shard, sock in enumerate(self._internal):
+            if shard != index:
+                sock.close()
+        internal = gevent.socket.socket(fileno=self._internal[index].detach())
+        public = self._public if self._public is not None else self._bind(self.host, self.port, reuse_port=True)
+        public = gevent.socket.socket(fileno=public.detach())
+
+        append_log = shard_filename(self._append_log, index) if self._append_log else None
+        server = Server(password=self._password, append_log=append_log, append_fsync=self._append_fsync,
+                        snapshot_compress=self._snapshot_compress, listener=internal,
+                        dump_prefix=f"reddb_shard{index}", maxmemory=self._maxmemory,
+                        maxmemory_policy=self._maxmemory_policy,
+                        slowlog_threshold=self._slowlog_threshold)
+        router = ShardRouter(index, server, self._peers)
+        front = StreamServer(public, router.connection_handler, spawn=Pool(self.max_clients))
+        server._server.start()
+        front.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run NimbleDB with one worker process per shard")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=None, help="defaults to the number of CPU cores")
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--append-log', default=None)
+    parser.add_argument('--maxmemory', default=None, help="memory ceiling for all workers, e.g. 2gb")
+    parser.add_argument('--maxmemory-policy', default='noeviction', choices=MAXMEMORY_POLICIES)
+    parser.add_argument('--slowlog-threshold', type=int, default=SLOWLOG_THRESHOLD,
+                        help="microseconds before a command is logged as slow; negative disables")
+    args = parser.parse_args()
+    ShardedServer(args.host, args.port, args.workers, password=args.password,
+                  append_log=args.append_log, maxmemory=args.maxmemory,
+                  maxmemory_policy=args.maxmemory_policy,
+                  slowlog_threshold=args.slowlog_threshold).run()
@@ -0,0 +1,287 @@
+import struct
+import zlib
+from collections import deque
+
+from hashType import *
+from listType import *
+from zsetType import *
+
+SNAPSHOT_MAGIC = b'NIMBLEDB'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_EXTENSION = '.ndb'
+FLAG_COMPRESSED = 0x01
+CHUNK_SIZE = 65536
+
+# Record types
+RECORD_DATABASE = 1
+RECORD_KEY = 2
+RECORD_END = 255
+
+# Value types stored in key records. Counters keep their native type so
+# they load back without a parse on the next INCR; their payload is text.
+# Values a server in raw_values mode stored as bytes are kept byte for byte.
+# A hash payload is its field count followed by each length-prefixed field
+# and value, every value a string or an int tagged by a leading type byte.
+# A list payload is its item count followed by each length-prefixed item,
+# and a sorted set payload its member count followed by each length-prefixed
+# member and its score as a double.
+VALUE_STRING = 0
+VALUE_INT = 1
+VALUE_FLOAT = 2
+VALUE_HASH = 3
+VALUE_LIST = 4
+VALUE_ZSET = 5
+VALUE_BYTES = 6
+
+_HEADER = struct.Struct('<8sBB')  # magic, version, flags
+_LENGTH = struct.Struct('<I')
+_SCORE = struct.Struct('<d')
+_DATABASE = struct.Struct('<Bq')  # type, db_id
+_KEY = struct.Struct('<BBdI')  # type, value type, expire_at (0 = none), key length
+_END = struct.Struct('<BIQ')  # type, crc32 of every record before it, key count
+
+
+class SnapshotError(Exception): pass
+
+
+def is_snapshot(filename):
+    """Check whether a file starts with the binary snapshot header"""
+    with open(filename, 'rb') as f:
+        return f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+class SnapshotWriter(object):
+    """
+    Streaming writer for the binary snapshot format. After a fixed header
+    the file holds length-prefixed records: a database record opens each
+    database section and is followed by one record per key, holding the
+    key, its value and its absolute expiry time. An end record carries a
+    CRC32 of everything before it and the number of keys written. Records
+    are encoded into a small buffer that is written out (and optionally
+    zlib-compressed) every CHUNK_SIZE bytes, so memory use does not grow
+    with the size of the database.
+    """
+    def __init__(self, fileobj, compress=False):
+        self._file = fileobj
+        self._compressor = zlib.compressobj() if compress else None
+        self._buf = bytearray()
+        self._crc = 0
+        self.keys_written = 0
+        fileobj.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                   FLAG_COMPRESSED if compress else 0))
+
+    def begin_database(self, db_id):
+        self._record(_DATABASE.pack(RECORD_DATABASE, db_id))
+
+    def write_key(self, key, value, expire_at=None):
+        key = key.encode('utf-8')
+        if value.__class__ is int:
+            value_type, value = VALUE_INT, str(value).encode('ascii')
+        elif value.__class__ is float:
+            value_type, value = VALUE_FLOAT, repr(value).encode('ascii')
+        elif is_hash(value):
+            value_type, value = VALUE_HASH, self._encode_hash(value)
+        elif is_list(value):
+            value_type, value = VALUE_LIST, self._encode_list(value)
+        elif is_zset(value):
+            value_type, value = VALUE_ZSET, self._encode_zset(value)
+        elif value.__class__ is bytes:
+            value_type = VALUE_BYTES
+        else:
+            value_type, value = VALUE_STRING, value.encode('utf-8')
+        self._record(b''.join((_KEY.pack(RECORD_KEY, value_type, expire_at or 0.0, len(key)),
+                               key, _LENGTH.pack(len(value)), value)))
+        self.keys_written += 1
+
+    def _encode_hash(self, h):
+        parts = [_LENGTH.pack(hash_len(h))]
+        for field, value in hash_items(h):
+            field = field.encode('utf-8')
+            if value.__class__ is int:
+                value = bytes((VALUE_INT,)) + str(value).encode('ascii')
+            else:
+                value = bytes((VALUE_STRING,)) + value.encode('utf-8')
+            parts += (_LENGTH.pack(len(field)), field, _LENGTH.pack(len(value)), value)
+        return b''.join(parts)
+
+    def _encode_list(self, items):
+        parts = [_LENGTH.pack(len(items))]
+        for item in items:
+            item = item.encode('utf-8')
+            parts += (_LENGTH.pack(len(item)), item)
+        return b''.join(parts)
+
+    def _encode_zset(self, zset):
+        parts = [_LENGTH.pack(len(zset))]
+        for member, score in zset:
+            member = member.encode('utf-8')
+            parts += (_LENGTH.pack(len(member)), member, _SCORE.pack(score))
+        return b''.join(parts)
+
+    def close(self):
+        self._flush()
+        self._buf += self._frame(_END.pack(RECORD_END, self._crc, self.keys_written))
+        self._flush(final=True)
+
+    def _record(self, body):
+        self._buf += self._frame(body)
+        if len(self._buf) >= CHUNK_SIZE:
+            self._flush()
+
+    def _frame(self, body):
+        return _LENGTH.pack(len(body)) + body
+
+    def _flush(self, final=False):
+        data = bytes(self._buf)
+        self._buf.clear()
+        if not final:
+            self._crc = zlib.crc32(data, self._crc)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+            if final:
+                data += self._compressor.flush()
+        self._file.write(data)
+
+
+class SnapshotReader(object):
+    """
+    Streaming reader for files written by SnapshotWriter. Iterating yields
+    ('database', db_id) at the start of each section and
+    ('key', key, value, expire_at) for each key, with expire_at None for
+    persistent keys. The checksum and key count are verified when the end
+    record is reached; SnapshotError is raised if they don't match or the
+    file ends early.
+    """
+    def __init__(self, fileobj):
+        self._file = fileobj
+        header = fileobj.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise SnapshotError("File is too short to be a snapshot")
+        magic, version, flags = _HEADER.unpack(header)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotError("Not a NimbleDB snapshot")
+        if version > SNAPSHOT_VERSION:
+            raise SnapshotError(f"Unsupported snapshot version {version}")
+        self.version = version
+        self.compressed = bool(flags & FLAG_COMPRESSED)
+        self._decompressor = zlib.decompressobj() if self.compressed else None
+
+    def _chunks(self):
+        try:
+            while True:
+                data = self._file.read(CHUNK_SIZE)
+                if not data:
+                    break
+                if self._decompressor is not None:
+                    data = self._decompressor.decompress(data)
+                yield data
+            if self._decompressor is not None:
+                yield self._decompressor.flush()
+        except zlib.error as e:
+            raise SnapshotError(f"Corrupt compressed data: {e}")
+
+    def __iter__(self):
+        buf = bytearray()
+        pos = 0
+        crc = 0
+        keys = 0
+        for chunk in self._chunks():
+            # Drop consumed records, folding them into the running checksum
+            crc = zlib.crc32(memoryview(buf)[:pos], crc)
+            del buf[:pos]
+            pos = 0
+            buf += chunk
+
+            while pos + _LENGTH.size <= len(buf):
+                length, = _LENGTH.unpack_from(buf, pos)
+                start = pos + _LENGTH.size
+                if start + length > len(buf):
+                    break
+                record_type = buf[start]
+
+                if record_type == RECORD_KEY:
+                    _, value_type, expire_at, key_length = _KEY.unpack_from(buf, start)
+                    offset = start + _KEY.size
+                    key = buf[offset:offset + key_length].decode('utf-8')
+                    offset += key_length
+                    value_length, = _LENGTH.unpack_from(buf, offset)
+                    offset += _LENGTH.size
+                    if value_type == VALUE_HASH:
+                        value = _decode_hash(buf, offset)
+                    elif value_type == VALUE_LIST:
+                        value = _decode_list(buf, offset)
+                    elif value_type == VALUE_ZSET:
+                        value = _decode_zset(buf, offset)
+                    elif value_type == VALUE_BYTES:
+                        value = bytes(buf[offset:offset + value_length])
+                    else:
+                        value = buf[offset:offset + value_length].decode('utf-8')
+                    if value_type == VALUE_INT:
+                        value = int(value)
+                    elif value_type == VALUE_FLOAT:
+                        value = float(value)
+                    elif value_type not in (VALUE_STRING, VALUE_BYTES, VALUE_HASH, VALUE_LIST, VALUE_ZSET):
+                        raise SnapshotError(f"Unknown value type {value_type}")
+                    keys += 1
+                    yield ('key', key, value, expire_at or None)
+                elif record_type == RECORD_DATABASE:
+                    _, db_id = _DATABASE.unpack_from(buf, start)
+                    yield ('database', db_id)
+                elif record_type == RECORD_END:
+                    _, expected_crc, expected_keys = _END.unpack_from(buf, start)
+                    crc = zlib.crc32(memoryview(buf)[:pos], crc)
+                    if crc != expected_crc:
+                        raise SnapshotError("Snapshot checksum mismatch")
+                    if keys != expected_keys:
+                        raise SnapshotError(f"Snapshot holds {keys} keys, expected {expected_keys}")
+                    return
+                else:
+                    raise SnapshotError(f"Unknown record type {record_type}")
+                pos = start + length
+
+        raise SnapshotError("Snapshot is truncated")
+
+
+def _decode_hash(buf, offset):
+    count, = _LENGTH.unpack_from(buf, offset)
+    offset += _LENGTH.size
+    items = []
+    for _ in range(count):
+        length, = _LENGTH.unpack_from(buf, offset)
+        offset += _LENGTH.size
+        field = buf[offset:offset + length].decode('utf-8')
+        offset += length
+        length, = _LENGTH.unpack_from(buf, offset)
+        offset += _LENGTH.size
+        value = buf[offset + 1:offset + length].decode('utf-8')
+        if buf[offset] == VALUE_INT:
+            value = int(value)
+        offset += length
+        items.append((field, value))
+    return new_hash(items)
+
+
+def _decode_list(buf, offset):
+    count, = _LENGTH.unpack_from(buf, offset)
+    offset += _LENGTH.size
+    items = deque()
+    for _ in range(count):
+        length, = _LENGTH.unpack_from(buf, offset)
+        offset += _LENGTH.size
+        items.append(buf[offset:offset + length].decode('utf-8'))
+        offset += length
+    return items
+
+
+def _decode_zset(buf, offset):
+    count, = _LENGTH.unpack_from(buf, offset)
+    offset += _LENGTH.size
+    zset = SortedSet()
+    for _ in range(count):
+        length, = _LENGTH.unpack_from(buf, offset)
+        offset += _LENGTH.size
+        member = buf[offset:offset + length].decode('utf-8')
+        score, = _SCORE.unpack_from(buf, offset + length)
+        offset += length + _SCORE.size
+        zset.add(member, score)
+    return zset
@@ -0,0 +1,247 @@
+import math
+import random
+import sys
+
+ZSET_MAX_LEVEL = 32
+ZSET_LEVEL_P = 0.25  # Chance a node reaches each level above the first
+ZSET_OVERHEAD = 256  # Estimated bytes of the set, its dict and the skiplist header
+ZSET_MEMBER_OVERHEAD = 200  # Estimated bytes of a node and dict slot per member
+_FLOAT_SIZE = sys.getsizeof(0.0)
+
+
+class _Node(object):
+    __slots__ = ('member', 'score', 'backward', 'forward', 'span')
+
+    def __init__(self, level, score, member):
+        self.member = member
+        self.score = score
+        self.backward = None
+        self.forward = [None] * level
+        self.span = [0] * level  # Nodes skipped by each forward link, for ranks
+
+
+class SortedSet(object):
+    """
+    Members ordered by score, then by member for equal scores. A skiplist
+    in the style of Redis keeps the order: every forward link records how
+    many nodes it jumps, so finding a member's rank or the member at a rank
+    takes O(log n) like finding a score does. A dict on the side answers
+    score lookups in O(1) and gives the key to find a member's node.
+    """
+    __slots__ = ('scores', '_header', '_level')
+
+    def __init__(self):
+        self.scores = {}
+        self._header = _Node(ZSET_MAX_LEVEL, None, None)
+        self._level = 1
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __iter__(self):
+        """(member, score) pairs in ascending order"""
+        node = self._header.forward[0]
+        while node is not None:
+            yield node.member, node.score
+            node = node.forward[0]
+
+    def copy(self):
+        """An independent SortedSet with the same members and scores"""
+        zset = SortedSet()
+        for member, score in self:
+            zset.add(member, score)
+        return zset
+
+    def add(self, member, score):
+        """Set a member's score; returns True if the member is new"""
+        old = self.scores.get(member)
+        if old is not None:
+            if old == score:
+                return False
+            self._delete(old, member)
+            # _insert sizes new levels by the members in the skiplist
+            del self.scores[member]
+        self._insert(score, member)
+        self.scores[member] = score
+        return old is None
+
+    def remove(self, member):
+        """Remove a member; returns True if it was there"""
+        score = self.scores.pop(member, None)
+        if score is None:
+            return False
+        self._delete(score, member)
+        return True
+
+    def rank(self, member):
+        """0-based position of a member in ascending order, or None"""
+        score = self.scores.get(member)
+        if score is None:
+            return None
+        rank = 0
+        node = self._header
+        for i in range(self._level - 1, -1, -1):
+            while True:
+                nxt = node.forward[i]
+                if nxt is None or nxt.score > score or (nxt.score == score and nxt.member > member):
+                    break
+                rank += node.span[i]
+                node = nxt
+            if node.member == member and node is not self._header:
+                return rank - 1
+        return None
+
+    def range_by_rank(self, start, stop, reverse=False):
+        """(member, score) pairs from rank start to stop inclusive; negative ranks count from the end"""
+        length = len(self.scores)
+        if start < 0:
+            start = max(length + start, 0)
+        if stop < 0:
+            stop += length
+        stop = min(stop, length - 1)
+        if start > stop:
+            return []
+        result = []
+        if reverse:
+            node = self._node_at(length - start)
+            for _ in range(stop - start + 1):
+                result.append((node.member, node.score))
+                node = node.backward
+        else:
+            node = self._node_at(start + 1)
+            for _ in range(stop - start + 1):
+                result.append((node.member, node.score))
+                node = node.forward[0]
+        return result
+
+    def range_by_score(self, low, high, low_open=False, high_open=False, offset=0, count=-1):
+        """(member, score) pairs with low <= score <= high in ascending order, the ends open if asked"""
+        node = self._header
+        for i in range(self._level - 1, -1, -1):
+            while True:
+                nxt = node.forward[i]
+                if nxt is None or nxt.score > low or (nxt.score == low and not low_open):
+                    break
+                node = nxt
+        node = node.forward[0]
+        while node is not None and offset > 0:
+            node = node.forward[0]
+            offset -= 1
+        result = []
+        while node is not None and count:
+            if node.score > high or (high_open and node.score == high):
+                break
+            result.append((node.member, node.score))
+            node = node.forward[0]
+            count -= 1
+        return result
+
+    def _node_at(self, rank):
+        """Node at a 1-based rank"""
+        traversed = 0
+        node = self._header
+        for i in range(self._level - 1, -1, -1):
+            while node.forward[i] is not None and traversed + node.span[i] <= rank:
+                traversed += node.span[i]
+                node = node.forward[i]
+            if traversed == rank:
+                return node
+        return None
+
+    def _insert(self, score, member):
+        update = [None] * ZSET_MAX_LEVEL
+        rank = [0] * ZSET_MAX_LEVEL
+        node = self._header
+        for i in range(self._level - 1, -1, -1):
+            rank[i] = 0 if i == self._level - 1 else rank[i + 1]
+            while True:
+                nxt = node.forward[i]
+                if nxt is None or nxt.score > score or (nxt.score == score and nxt.member >= member):
+                    break
+                rank[i] += node.span[i]
+                node = nxt
+            update[i] = node
+
+        level = _random_level()
+        if level > self._level:
+            for i in range(self._level, level):
+                update[i] = self._header
+                self._header.span[i] = len(self.scores)
+            self._level = level
+
+        node = _Node(level, score, member)
+        for i in range(level):
+            prev = update[i]
+            node.forward[i] = prev.forward[i]
+            prev.forward[i] = node
+            node.span[i] = prev.span[i] - (rank[0] - rank[i])
+            prev.span[i] = rank[0] - rank[i] + 1
+        for i in range(level, self._level):
+            update[i].span[i] += 1
+
+        node.backward = None if update[0] is self._header else update[0]
+        if node.forward[0] is not None:
+            node.forward[0].backward = node
+
+    def _delete(self, score, member):
+        update = [None] * ZSET_MAX_LEVEL
+        node = self._header
+        for i in range(self._level - 1, -1, -1):
+            while True:
+                nxt = node.forward[i]
+                if nxt is None or nxt.score > score or (nxt.score == score and nxt.member >= member):
+                    break
+                node = nxt
+            update[i] = node
+        node = node.forward[0]
+
+        for i in range(self._level):
+            if update[i].forward[i] is node:
+                update[i].span[i] += node.span[i] - 1
+                update[i].forward[i] = node.forward[i]
+            else:
+                update[i].span[i] -= 1
+        if node.forward[0] is not None:
+            node.forward[0].backward = node.backward
+        while self._level > 1 and self._header.forward[self._level - 1] is None:
+            self._level -= 1
+
+
+def _random_level():
+    level = 1
+    while level < ZSET_MAX_LEVEL and random.random() < ZSET_LEVEL_P:
+        level += 1
+    return level
+
+
+def is_zset(value):
+    return value.__class__ is SortedSet
+
+
+def zset_sizeof(zset):
+    return ZSET_OVERHEAD + sum(map(member_sizeof, zset.scores))
+
+
+def member_sizeof(member):
+    return sys.getsizeof(member) + _FLOAT_SIZE + ZSET_MEMBER_OVERHEAD
+
+
+def parse_score(value):
+    """A score or increment as a float; infinities are allowed, NaN and junk give None"""
+    if value.__class__ in (int, float):
+        value = float(value)
+    else:
+        if not value or value != value.strip() or '_' in value:
+            return None
+        try:
+            value = float(value)
+        except ValueError:
+            return None
+    return None if math.isnan(value) else value
+
+
+def parse_score_bound(value):
+    """A ZRANGEBYSCORE bound as (score, open): '5', '(5', '-inf' or '+inf'"""
+    is_open = value.startswith('(')
+    score = parse_score(value[1:] if is_open else value)
+    return None if score is None else (score, is_open)